@@ -0,0 +1,135 @@
+"""
+Like throughput benchmark.
+
+By default drives LikeCounter in-process while its flush loop runs, then
+checks that every increment reached SQLite. With --url it instead sends
+POST /like/{index} over keep-alive connections to a running server.
+
+    python benchmarks/like_throughput.py --seconds 5 --videos 100
+    python benchmarks/like_throughput.py --url http://127.0.0.1:8000 --connections 32
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import like_counter
+from like_counter import LikeCounter
+
+async def bench_counter(args) -> dict:
+    db_path = os.path.join(tempfile.mkdtemp(prefix="likes-bench-"), "likes.db")
+    counter = LikeCounter(db_path)
+    await counter.start()
+
+    broadcasts = []
+    async def on_deltas(totals):
+        broadcasts.append(len(totals))
+
+    flusher = asyncio.create_task(counter.run(on_deltas))
+    keys = [f"/static/video{i}.mp4" for i in range(args.videos)]
+    deadline = time.perf_counter() + args.seconds
+    sent = 0
+
+    async def producer():
+        nonlocal sent
+        rng = random.Random()
+        while time.perf_counter() < deadline:
+            # One batch of clicks per loop iteration, like requests between awaits
+            for _ in range(args.batch):
+                counter.incr(rng.choice(keys))
+            sent += args.batch
+            await asyncio.sleep(0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(producer() for _ in range(args.producers)))
+    elapsed = time.perf_counter() - started
+    flusher.cancel()
+    await counter.close()
+
+    with sqlite3.connect(db_path) as db:
+        stored = db.execute("SELECT COALESCE(SUM(likes), 0) FROM likes").fetchone()[0]
+    return {
+        "mode": "counter",
+        "likes": sent,
+        "seconds": round(elapsed, 3),
+        "likes_per_second": round(sent / elapsed),
+        "flushes": counter.flushes,
+        "delta_broadcasts": len(broadcasts),
+        "persisted": stored,
+        "lost": sent - stored,
+    }
+
+async def bench_http(args) -> dict:
+    parts = urlsplit(args.url)
+    host, port = parts.hostname, parts.port or 80
+    deadline = time.perf_counter() + args.seconds
+    latencies = []
+    errors = 0
+
+    async def connection():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(host, port)
+        rng = random.Random()
+        try:
+            while time.perf_counter() < deadline:
+                index = rng.randrange(args.videos)
+                request = (
+                    f"POST /like/{index} HTTP/1.1\r\nHost: {host}\r\n"
+                    "Content-Length: 0\r\n\r\n"
+                ).encode()
+                sent_at = time.perf_counter()
+                writer.write(request)
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":")[1])
+                body = await reader.readexactly(length)
+                latencies.append(time.perf_counter() - sent_at)
+                if not head.startswith(b"HTTP/1.1 200") or b'"success":true' not in body:
+                    errors += 1
+        finally:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connection() for _ in range(args.connections)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2) if latencies else None
+
+    return {
+        "mode": "http",
+        "likes": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "likes_per_second": round(len(latencies) / elapsed),
+        "p50_ms": percentile(0.50),
+        "p99_ms": percentile(0.99),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--videos", type=int, default=100, help="Number of videos liked at random")
+    parser.add_argument("--producers", type=int, default=8, help="Concurrent producers (counter mode)")
+    parser.add_argument("--batch", type=int, default=64, help="Likes per producer step (counter mode)")
+    parser.add_argument("--url", help="Benchmark a running server instead of the counter")
+    parser.add_argument("--connections", type=int, default=32, help="Keep-alive connections (HTTP mode)")
+    args = parser.parse_args()
+
+    result = asyncio.run(bench_http(args) if args.url else bench_counter(args))
+    result["flush_interval"] = like_counter.LIKE_FLUSH_INTERVAL
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Playlist engine benchmark.
+
+Fills a ChannelScheduler's catalog with --videos records, then times
+building the main channel's playlist, drawing from it, like updates and
+catalog churn (one video removed and one added per step) while drawing.
+With --seed the draws are reproducible, so two runs print the same
+`order_digest`.
+
+    python benchmarks/playlist_bench.py --videos 100000 --draws 100000
+    python benchmarks/playlist_bench.py --strategy shuffle --seed 42
+"""
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import Catalog, VideoRecord
+from channels import DEFAULT_CHANNEL, ChannelScheduler
+
+async def on_switch(*args):
+    pass
+
+def per_op_us(seconds: float, ops: int) -> float:
+    return round(seconds / ops * 1e6, 2)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--videos", type=int, default=100_000)
+    parser.add_argument("--draws", type=int, default=100_000)
+    parser.add_argument("--strategy", default="weighted", choices=("sequential", "shuffle", "weighted"))
+    parser.add_argument("--seed", default="bench")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    catalog = Catalog()
+    for i in range(args.videos):
+        catalog.add(VideoRecord(f"/static/video{i}.mp4", 10, likes=int(rng.paretovariate(1.2)) - 1))
+    scheduler = ChannelScheduler(lambda: catalog, catalog.by_url, on_switch, strategy=args.strategy, seed=args.seed)
+    catalog.listeners.append(scheduler.catalog_changed)
+    channel = scheduler.set_channel(DEFAULT_CHANNEL)
+
+    started = time.perf_counter()
+    scheduler.next_video(channel)
+    build = time.perf_counter() - started
+
+    digest = hashlib.blake2b(digest_size=8)
+    started = time.perf_counter()
+    for _ in range(args.draws):
+        video, _, _ = scheduler.next_video(channel)
+        digest.update(video.id.encode())
+    draw = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(args.draws):
+        video = catalog[rng.randrange(len(catalog))]
+        catalog.update(video, likes=video.likes + 1)
+    like = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for i in range(args.draws):
+        catalog.remove(catalog[rng.randrange(len(catalog))].url)
+        catalog.add(VideoRecord(f"/uploads/new{i}.mp4", 10))
+        scheduler.next_video(channel)
+    churn = time.perf_counter() - started
+
+    print(json.dumps({
+        "strategy": args.strategy,
+        "videos": args.videos,
+        "draws": args.draws,
+        "build_ms": round(build * 1000, 1),
+        "draw_us": per_op_us(draw, args.draws),
+        "like_update_us": per_op_us(like, args.draws),
+        "churn_step_us": per_op_us(churn, args.draws),
+        "order_digest": digest.hexdigest(),
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,464 @@
+"""
+SSE fan-out and upload throughput benchmark.
+
+Starts the app as a subprocess in a scratch directory, with every video's
+duration forced to --switch-interval so broadcasts come quickly. Thousands
+of raw asyncio SSE clients (spread over --client-processes processes) then
+measure broadcast-to-receive latency while the harness samples the
+server's RSS and CPU time. The upload benchmark posts files to /uploads
+against local disk and, when moto is installed, a local S3 stand-in.
+
+Results are printed as JSON (and written to --output) so runs can be
+compared between commits.
+
+    python benchmarks/sse_load.py --clients 2000 --seconds 20
+    python benchmarks/sse_load.py --skip-sse --upload-count 40 --upload-mb 8
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import shutil
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from typing import List, Optional
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOST = "127.0.0.1"
+
+# Server side
+
+def serve(port: int, switch_interval: float):
+    """Run the app with every video's duration forced to switch_interval."""
+    sys.path.insert(0, REPO_ROOT)
+    import uvicorn
+    import main
+
+    # Runs after main's startup handler has built the catalog
+    async def force_durations():
+        for video in main.catalog:
+            main.catalog.update(video, duration=switch_interval)
+    main.app.router.on_startup.append(force_durations)
+
+    uvicorn.run(main.app, host=HOST, port=port, log_level="warning")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+def start_server(workdir: str, port: int, switch_interval: float, env: dict, logs: bool = False) -> subprocess.Popen:
+    server_env = dict(os.environ)
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "S3_BUCKET_NAME", "S3_ENDPOINT_URL"):
+        server_env.pop(name, None)
+    server_env.update({
+        "PYTHONPATH": REPO_ROOT,
+        "PACKAGING_ENABLED": "false",
+        "FFPROBE_BIN": "benchmark-no-ffprobe",  # Keep the forced durations
+        "STATE_BACKEND": "memory",
+    })
+    server_env.update(env)
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "serve", "--port", str(port), "--switch-interval", str(switch_interval)],
+        cwd=workdir,
+        env=server_env,
+        stdout=None if logs else subprocess.DEVNULL,
+        stderr=None if logs else subprocess.DEVNULL
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+def stop_server(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def make_workdir(videos: int) -> str:
+    """Scratch directory with placeholder static videos (never decoded)."""
+    workdir = tempfile.mkdtemp(prefix="channels-bench-")
+    os.makedirs(os.path.join(workdir, "static"))
+    os.makedirs(os.path.join(workdir, "uploads"))
+    shutil.copytree(REPO_ROOT, os.path.join(workdir, "browser"), ignore=lambda d, names: [n for n in names if not n.endswith(".html")])
+    for i in range(videos):
+        with open(os.path.join(workdir, "static", f"bench{i}.mp4"), "wb") as f:
+            f.write(b"\0" * 1024)
+    return workdir
+
+def process_rss(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def process_cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def http_request(port: int, method: str, path: str, body: Optional[bytes] = None) -> dict:
+    import http.client
+    connection = http.client.HTTPConnection(HOST, port, timeout=30)
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    data = json.loads(response.read() or b"null")
+    connection.close()
+    return data
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda p: round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 3)
+    return {
+        "p50_ms": pick(0.50), "p90_ms": pick(0.90), "p99_ms": pick(0.99), "p999_ms": pick(0.999),
+        "max_ms": round(values[-1] * 1000, 3), "samples": len(values),
+    }
+
+# SSE clients
+
+async def sse_client(port: int, path: str, connected, measure_from, latencies: list, broadcasts: set, counts: dict):
+    try:
+        reader, writer = await asyncio.open_connection(HOST, port)
+    except OSError:
+        counts["errors"] += 1
+        return
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {HOST}\r\nAccept: text/event-stream\r\n\r\n".encode())
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        with connected.get_lock():
+            connected.value += 1
+        while True:
+            line = await reader.readline()
+            if not line:
+                counts["disconnects"] += 1
+                break
+            received = time.time()
+            # Chunked framing lines and named events are skipped
+            if not line.startswith(b"data: "):
+                continue
+            event = json.loads(line[6:])
+            if "server_time_ms" not in event or measure_from.value == 0:
+                continue
+            sent_at = event["server_time_ms"] / 1000
+            if sent_at < measure_from.value:
+                continue
+            latencies.append(received - sent_at)
+            broadcasts.add((event["channel"], sent_at))
+            counts["events"] += 1
+    except (OSError, asyncio.IncompleteReadError):
+        counts["errors"] += 1
+    finally:
+        writer.close()
+
+def client_process(port: int, paths: List[str], connected, measure_from, stop, results):
+    async def run():
+        latencies, broadcasts = [], set()
+        counts = {"events": 0, "errors": 0, "disconnects": 0}
+        tasks = []
+        for path in paths:
+            tasks.append(asyncio.create_task(sse_client(port, path, connected, measure_from, latencies, broadcasts, counts)))
+            if len(tasks) % 100 == 0:
+                await asyncio.sleep(0.01)  # Ramp up instead of a SYN flood
+        # One poll of the shared stop flag instead of a timeout per read
+        while not stop.is_set():
+            await asyncio.sleep(0.2)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        results.put({"latencies": latencies, "broadcasts": list(broadcasts), **counts})
+
+    asyncio.run(run())
+
+def raise_fd_limit(needed: int):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, needed), hard))
+
+def bench_sse(args) -> dict:
+    raise_fd_limit(args.clients + 1024)
+    workdir = make_workdir(args.videos)
+    port = free_port()
+    server = start_server(workdir, port, args.switch_interval, {}, args.server_logs)
+    try:
+        paths = ["/video-updates"]
+        for i in range(1, args.channels):
+            channel_id = f"bench{i}"
+            http_request(port, "PUT", f"/channels/{channel_id}",
+                         json.dumps({"videos": [f"/static/bench{j}.mp4" for j in range(args.videos)]}).encode())
+            paths.append(f"/channels/{channel_id}/video-updates")
+
+        time.sleep(1)
+        baseline_rss = process_rss(server.pid)
+
+        context = multiprocessing.get_context("spawn")
+        connected = context.Value("i", 0)
+        measure_from = context.Value("d", 0.0)
+        stop = context.Event()
+        results = context.Queue()
+        workers = []
+        per_process = [[] for _ in range(args.client_processes)]
+        for i in range(args.clients):
+            per_process[i % args.client_processes].append(paths[i % len(paths)])
+        for client_paths in per_process:
+            worker = context.Process(target=client_process, args=(port, client_paths, connected, measure_from, stop, results))
+            worker.start()
+            workers.append(worker)
+
+        ramp_started = time.time()
+        while connected.value < args.clients and time.time() - ramp_started < args.connect_timeout:
+            time.sleep(0.1)
+        connect_seconds = time.time() - ramp_started
+        time.sleep(1)
+        connected_rss = process_rss(server.pid)
+
+        cpu_before = process_cpu_seconds(server.pid)
+        measure_from.value = time.time()
+        time.sleep(args.seconds)
+        cpu_used = process_cpu_seconds(server.pid) - cpu_before
+        peak_rss = process_rss(server.pid)
+        hub_stats = http_request(port, "GET", "/broadcast/stats")
+
+        stop.set()
+        latencies, broadcasts = [], set()
+        counts = {"events": 0, "errors": 0, "disconnects": 0}
+        for _ in workers:
+            result = results.get(timeout=60)
+            latencies += result["latencies"]
+            broadcasts.update(tuple(b) for b in result["broadcasts"])
+            for key in counts:
+                counts[key] += result[key]
+        for worker in workers:
+            worker.join(timeout=10)
+    finally:
+        stop_server(server)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "clients": args.clients,
+        "connected": connected.value,
+        "connect_seconds": round(connect_seconds, 3),
+        "channels": len(paths),
+        "switch_interval": args.switch_interval,
+        "measure_seconds": args.seconds,
+        "broadcasts": len(broadcasts),
+        "events_received": counts["events"],
+        "errors": counts["errors"],
+        "disconnects": counts["disconnects"],
+        "latency": percentiles(latencies),
+        "memory": {
+            "baseline_rss_bytes": baseline_rss,
+            "connected_rss_bytes": connected_rss,
+            "peak_rss_bytes": peak_rss,
+            "bytes_per_connection": round((connected_rss - baseline_rss) / max(connected.value, 1)),
+        },
+        "cpu": {
+            "server_cpu_seconds": round(cpu_used, 4),
+            "cpu_ms_per_broadcast": round(cpu_used * 1000 / max(len(broadcasts), 1), 4),
+            "cpu_us_per_delivered_event": round(cpu_used * 1e6 / max(counts["events"], 1), 3),
+        },
+        "hubs": hub_stats.get("hubs", {}),
+    }
+
+# Uploads
+
+def multipart_body(filename: str, payload: bytes) -> (bytes, str):
+    boundary = uuid.uuid4().hex
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="video"; filename="{filename}"\r\n'
+        "Content-Type: video/mp4\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    return head + payload + tail, boundary
+
+async def http_request_async(port: int, head: str, body: bytes = b"") -> (int, Optional[dict]):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    try:
+        writer.write(head.encode())
+        writer.write(body)
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    head, _, data = response.partition(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    return status, json.loads(data) if data else None
+
+async def upload_once(port: int, payload: bytes) -> (float, float, Optional[dict]):
+    """
+    Returns:
+        (seconds until the upload was accepted, seconds until it was stored,
+        the finished job or None)
+    """
+    # Unique content, or every upload after the first is deduplicated
+    body, boundary = multipart_body(f"bench_{uuid.uuid4().hex[:8]}.mp4", uuid.uuid4().bytes + payload)
+    started = time.perf_counter()
+    status, result = await http_request_async(port, (
+        f"POST /uploads HTTP/1.1\r\nHost: {HOST}\r\nConnection: close\r\n"
+        f"Content-Type: multipart/form-data; boundary={boundary}\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n"
+    ), body)
+    accepted = time.perf_counter() - started
+    if status == 503:
+        return accepted, accepted, {"status": "rejected"}
+    if status not in (200, 202):
+        return accepted, accepted, None
+
+    # Storing happens in an upload job; poll it until it finishes
+    job = result
+    if not (result.get("duplicate") and result.get("url")):
+        while True:
+            _, job = await http_request_async(port, (
+                f"GET {result['status_url']} HTTP/1.1\r\nHost: {HOST}\r\nConnection: close\r\n\r\n"
+            ))
+            if job is None or job["status"] in ("ready", "failed"):
+                break
+            await asyncio.sleep(0.05)
+    return accepted, time.perf_counter() - started, job
+
+async def run_uploads(port: int, count: int, concurrency: int, size: int) -> dict:
+    payload = os.urandom(size)
+    semaphore = asyncio.Semaphore(concurrency)
+    accept_latencies, latencies, stored = [], [], {"s3": 0, "local": 0}
+    errors = rejected = 0
+
+    async def one():
+        nonlocal errors, rejected
+        async with semaphore:
+            accepted, elapsed, job = await upload_once(port, payload)
+        if job is not None and job["status"] == "rejected":
+            rejected += 1
+            return
+        if job is None or job["status"] != "ready":
+            errors += 1
+            return
+        accept_latencies.append(accepted)
+        latencies.append(elapsed)
+        stored["local" if job["url"].startswith("/") else "s3"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(count)))
+    elapsed = time.perf_counter() - started
+    return {
+        "uploads": count,
+        "concurrency": concurrency,
+        "size_bytes": size,
+        "errors": errors,
+        "rejected": rejected,
+        "stored": stored,
+        "seconds": round(elapsed, 3),
+        "uploads_per_second": round(len(latencies) / elapsed, 2),
+        "mb_per_second": round(len(latencies) * size / elapsed / 1e6, 2),
+        "accept_latency": percentiles(accept_latencies),
+        "latency": percentiles(latencies),
+    }
+
+def bench_uploads(args) -> dict:
+    results = {}
+    targets = [("local", None)]
+    try:
+        from moto.server import ThreadedMotoServer
+        targets.append(("s3", ThreadedMotoServer))
+    except ImportError:
+        results["s3"] = {"skipped": "moto is not installed"}
+
+    for target, moto_server_class in targets:
+        workdir = make_workdir(1)
+        port = free_port()
+        env = {}
+        moto_server = None
+        if moto_server_class is not None:
+            import boto3
+            moto_port = free_port()
+            moto_server = moto_server_class(ip_address=HOST, port=moto_port)
+            moto_server.start()
+            env = {
+                "AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "bench",
+                "S3_BUCKET_NAME": "bench", "S3_ENDPOINT_URL": f"http://{HOST}:{moto_port}",
+                "S3_SYNC_INTERVAL": "3600",
+            }
+            boto3.client(
+                "s3", endpoint_url=env["S3_ENDPOINT_URL"], region_name="us-east-1",
+                aws_access_key_id="bench", aws_secret_access_key="bench"
+            ).create_bucket(Bucket="bench")
+        server = start_server(workdir, port, args.switch_interval, env, args.server_logs)
+        try:
+            results[target] = asyncio.run(run_uploads(port, args.upload_count, args.upload_concurrency, int(args.upload_mb * 1024 * 1024)))
+        finally:
+            stop_server(server)
+            if moto_server is not None:
+                moto_server.stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("serve")
+        parser.add_argument("--port", type=int, required=True)
+        parser.add_argument("--switch-interval", type=float, required=True)
+        args = parser.parse_args()
+        serve(args.port, args.switch_interval)
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=1000, help="Concurrent SSE connections")
+    parser.add_argument("--client-processes", type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)))
+    parser.add_argument("--channels", type=int, default=1, help="Spread clients over this many channels")
+    parser.add_argument("--videos", type=int, default=5, help="Placeholder videos in rotation")
+    parser.add_argument("--switch-interval", type=float, default=0.5, help="Seconds between broadcasts")
+    parser.add_argument("--seconds", type=float, default=10.0, help="Measurement window")
+    parser.add_argument("--connect-timeout", type=float, default=60.0)
+    parser.add_argument("--upload-count", type=int, default=20)
+    parser.add_argument("--upload-concurrency", type=int, default=4)
+    parser.add_argument("--upload-mb", type=float, default=4.0)
+    parser.add_argument("--skip-sse", action="store_true")
+    parser.add_argument("--skip-uploads", action="store_true")
+    parser.add_argument("--server-logs", action="store_true", help="Show the server's log output")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = {
+        "benchmark": "sse_load",
+        "git_revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+    }
+    if not args.skip_sse:
+        report["sse"] = bench_sse(args)
+    if not args.skip_uploads:
+        report["uploads"] = bench_uploads(args)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+Broadcast hub for fanning out events to many subscribers.
+
+Each event is encoded exactly once per wire format in use (SSE text for
+EventSource clients, msgpack for WebSocket clients) and handed to every
+subscriber's bounded buffer without awaiting, so a stalled browser can never
+delay the broadcast for everyone else.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, Optional, Set
+
+import msgpack
+
+import metrics
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Hub settings
+SUBSCRIBER_BUFFER_SIZE = int(os.getenv("SUBSCRIBER_BUFFER_SIZE", "8"))
+# "skip" coalesces a slow subscriber's backlog to the latest frame of each
+# kind (a newer video event supersedes an older one; queued likes deltas are
+# merged into one), "evict" disconnects it so the browser reconnects and resyncs.
+SLOW_SUBSCRIBER_POLICY = os.getenv("SLOW_SUBSCRIBER_POLICY", "skip")
+
+def encode_sse(data: str, event: Optional[str] = None) -> bytes:
+    """
+    Encode a payload as a single server-sent event frame.
+
+    Args:
+        data: Event payload (must not contain newlines)
+        event: Optional SSE event name
+
+    Returns:
+        The encoded frame, ready to be written to the wire
+    """
+    if event:
+        return f"event: {event}\ndata: {data}\n\n".encode("utf-8")
+    return f"data: {data}\n\n".encode("utf-8")
+
+def encode_msgpack(data: str, event: Optional[str] = None) -> bytes:
+    """
+    Encode a JSON payload as a binary WebSocket message.
+
+    Args:
+        data: Event payload as a JSON string
+        event: Optional event name; plain events are "video" updates
+
+    Returns:
+        msgpack bytes of {"type": event, "data": payload}
+    """
+    return msgpack.packb({"type": event or "video", "data": json.loads(data)})
+
+# Wire formats a subscriber can receive
+ENCODERS = {
+    "sse": encode_sse,
+    "msgpack": encode_msgpack,
+}
+
+def merge_likes(older: str, newer: str) -> str:
+    """Combine two `likes` payloads; each only carries the videos flushed in its tick."""
+    return json.dumps({"likes": {**json.loads(older)["likes"], **json.loads(newer)["likes"]}})
+
+# Event kinds whose queued payloads are merged, never superseded
+MERGERS = {
+    "likes": merge_likes,
+}
+
+class Subscriber:
+    """
+    A single client's bounded buffer of pre-encoded frames, each tagged with
+    its kind ("video", "likes", or a WebSocket reply) and, for kinds in
+    MERGERS, its payload.
+    """
+    __slots__ = ("_buffer", "_waiter", "maxsize", "codec", "closed", "drops")
+
+    def __init__(self, maxsize: int, codec: str = "sse"):
+        self._buffer = deque()
+        self._waiter: Optional[asyncio.Future] = None
+        self.maxsize = maxsize
+        self.codec = codec
+        self.closed = False
+        self.drops = 0
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def push(
+        self,
+        frame: bytes,
+        policy: str = SLOW_SUBSCRIBER_POLICY,
+        kind: str = "video",
+        data: Optional[str] = None
+    ) -> bool:
+        """
+        Queue a frame without blocking.
+
+        Args:
+            kind: What the frame carries; on overflow a frame is only dropped
+                when a newer one of the same kind supersedes it
+            data: The frame's payload, needed for kinds in MERGERS
+
+        Returns:
+            False if the subscriber overflowed and had to be skipped or evicted
+        """
+        if self.closed:
+            return False
+
+        overflowed = len(self._buffer) >= self.maxsize
+        if overflowed and policy == "evict":
+            self.drops += len(self._buffer)
+            self._buffer.clear()
+            self.close()
+            return False
+
+        self._buffer.append((kind, frame, data if kind in MERGERS else None))
+        if overflowed:
+            self._coalesce()
+        self._wake()
+        return not overflowed
+
+    def _coalesce(self):
+        """
+        Shrink an overflowing buffer to the newest frame of each kind, in
+        order, with the payloads of kinds in MERGERS merged into it. If that
+        is still too many, the oldest other frames go too: the latest video
+        event and the merged likes are never dropped, so a slow client still
+        switches to the current video and keeps every like total.
+        """
+        newest: Dict[str, list] = {}
+        kept = deque()
+        for kind, frame, data in reversed(self._buffer):
+            entry = newest.get(kind)
+            if entry is None:
+                newest[kind] = entry = [kind, frame, data]
+                kept.appendleft(entry)
+            elif data is not None and entry[2] is not None:
+                entry[2] = MERGERS[kind](data, entry[2])
+                entry[1] = None  # Re-encoded below
+        for entry in kept:
+            if entry[1] is None:
+                entry[1] = ENCODERS[self.codec](entry[2], entry[0])
+        while len(kept) > self.maxsize:
+            stale = next((entry for entry in kept if entry[0] != "video" and entry[0] not in MERGERS), None)
+            if stale is None:
+                break
+            kept.remove(stale)
+        self.drops += len(self._buffer) - len(kept)
+        self._buffer = deque(tuple(entry) for entry in kept)
+
+    async def get(self) -> Optional[bytes]:
+        """
+        Wait for the next frame. Returns None once the subscriber is closed.
+        """
+        while not self._buffer:
+            if self.closed:
+                return None
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self._buffer.popleft()[1]
+
+    def close(self):
+        """Close the subscriber and wake any pending reader."""
+        self.closed = True
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+class BroadcastHub:
+    """
+    Fans pre-encoded frames out to a set of bounded subscribers.
+    """
+
+    def __init__(self, buffer_size: int = SUBSCRIBER_BUFFER_SIZE, policy: str = SLOW_SUBSCRIBER_POLICY):
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.subscribers: Set[Subscriber] = set()
+        # Subscribers grouped by wire format, so each format is encoded once
+        self._by_codec: Dict[str, Set[Subscriber]] = {}
+        self.published = 0
+        self.drops = 0
+        self.evictions = 0
+        self.last_fanout_seconds = 0.0
+        self.max_fanout_seconds = 0.0
+        self.total_fanout_seconds = 0.0
+
+    def __len__(self) -> int:
+        return len(self.subscribers)
+
+    def subscribe(self, codec: str = "sse") -> Subscriber:
+        """Register a new subscriber that receives frames in the given format."""
+        subscriber = Subscriber(self.buffer_size, codec)
+        self.subscribers.add(subscriber)
+        self._by_codec.setdefault(codec, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        """Remove a subscriber, closing it if still open."""
+        self._discard(subscriber)
+        subscriber.close()
+
+    def _discard(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+        group = self._by_codec.get(subscriber.codec)
+        if group is not None:
+            group.discard(subscriber)
+            if not group:
+                del self._by_codec[subscriber.codec]
+
+    def publish(self, data: str, event: Optional[str] = None) -> int:
+        """
+        Encode a payload once per wire format and queue it for every subscriber.
+
+        Args:
+            data: Event payload, usually a JSON string
+            event: Optional SSE event name
+
+        Returns:
+            Number of subscribers the frame was delivered to
+        """
+        started = time.perf_counter()
+
+        evicted = []
+        dropped = 0
+        for codec, group in self._by_codec.items():
+            frame = ENCODERS[codec](data, event)
+            for subscriber in group:
+                if not subscriber.push(frame, self.policy, event or "video", data):
+                    dropped += 1
+                    if subscriber.closed:
+                        evicted.append(subscriber)
+
+        for subscriber in evicted:
+            self._discard(subscriber)
+        self.drops += dropped
+        self.evictions += len(evicted)
+
+        elapsed = time.perf_counter() - started
+        self.published += 1
+        metrics.BROADCASTS.inc()
+        metrics.FANOUT_SECONDS.observe(elapsed)
+        if dropped:
+            metrics.SUBSCRIBER_DROPS.inc(dropped)
+            metrics.SUBSCRIBER_EVICTIONS.inc(len(evicted))
+        self.last_fanout_seconds = elapsed
+        self.total_fanout_seconds += elapsed
+        if elapsed > self.max_fanout_seconds:
+            self.max_fanout_seconds = elapsed
+
+        if evicted:
+            logger.warning(f"Evicted {len(evicted)} slow subscribers")
+
+        return len(self.subscribers)
+
+    def stats(self) -> dict:
+        """Return a snapshot of hub counters."""
+        return {
+            "subscribers": len(self.subscribers),
+            "buffer_size": self.buffer_size,
+            "policy": self.policy,
+            "published": self.published,
+            "drops": self.drops,
+            "evictions": self.evictions,
+            "last_fanout_ms": round(self.last_fanout_seconds * 1000, 3),
+            "max_fanout_ms": round(self.max_fanout_seconds * 1000, 3),
+            "avg_fanout_ms": round(self.total_fanout_seconds * 1000 / self.published, 3) if self.published else 0.0,
+        }
@@ -0,0 +1,261 @@
+"""
+Compact, indexed video catalog.
+
+Videos are slotted records with a stable ID derived from their URL, so the
+same video has the same ID in every worker and across restarts. Records are
+kept in rotation order and indexed by ID, URL, content hash, source and
+likes. Rotation
+order is insertion order, and every record carries an insertion sequence
+number, so ordered lists stay sorted and can be searched and paginated by
+bisection.
+
+Listeners are told about every added, removed and updated record, so
+structures derived from the catalog (like channel playlists) can follow it
+without rescanning.
+"""
+import hashlib
+import itertools
+from bisect import bisect_left, bisect_right, insort
+from operator import attrgetter
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Where a video is stored
+SOURCES = ("static", "uploads", "s3")
+
+_seq_key = attrgetter("seq")
+
+def _likes_key(record: "VideoRecord") -> Tuple[int, int]:
+    return (-record.likes, record.seq)
+
+def video_id_for(url: str) -> str:
+    """Stable 16-character ID for a video URL."""
+    return hashlib.blake2b(url.encode("utf-8"), digest_size=8).hexdigest()
+
+def source_for(url: str) -> str:
+    if url.startswith("/static/"):
+        return "static"
+    if url.startswith("/uploads/"):
+        return "uploads"
+    return "s3"
+
+class VideoRecord:
+    """
+    One catalog entry. Metadata fields stay None until the video is probed,
+    and thumbnail fields until its thumbnails are rendered.
+    """
+    __slots__ = (
+        "id", "url", "source", "seq", "duration", "likes", "etag", "hls_url",
+        "width", "height", "codec", "audio_codec", "bitrate", "format",
+        "poster_url", "sprite", "content_hash",
+    )
+
+    # Fields included in API responses, in order
+    FIELDS = (
+        "id", "url", "source", "duration", "likes", "etag", "hls_url",
+        "width", "height", "codec", "audio_codec", "bitrate", "format",
+        "poster_url", "sprite",
+    )
+
+    def __init__(self, url: str, duration: float, likes: int = 0, etag: Optional[str] = None):
+        self.id = video_id_for(url)
+        self.url = url
+        self.source = source_for(url)
+        self.seq = -1  # Assigned when the record joins a catalog
+        self.duration = duration
+        self.likes = likes
+        self.etag = etag
+        self.hls_url = None
+        self.width = None
+        self.height = None
+        self.codec = None
+        self.audio_codec = None
+        self.bitrate = None
+        self.format = None
+        self.poster_url = None
+        self.sprite = None  # Sprite sheet URL and tile geometry
+        self.content_hash = None  # "sha256:<hex>" when known, for deduplicating uploads
+
+    def to_dict(self) -> dict:
+        """Serializable view, leaving out fields that are not known yet."""
+        data = {}
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                data[field] = value
+        return data
+
+class Catalog:
+    """
+    Ordered collection of VideoRecords with secondary indexes.
+
+    `version` changes whenever the catalog or any record in it changes, so
+    callers can cache anything derived from it. Each listener is called with
+    ("add" | "remove" | "update", record) or ("clear", None) after the change.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._order: List[VideoRecord] = []
+        self._by_id: Dict[str, VideoRecord] = {}
+        self._by_url: Dict[str, VideoRecord] = {}
+        self._by_hash: Dict[str, VideoRecord] = {}
+        self._by_source: Dict[str, List[VideoRecord]] = {source: [] for source in SOURCES}
+        self._by_likes: List[VideoRecord] = []
+        self._seqs = itertools.count()
+        self.listeners: List[Callable[[str, Optional[VideoRecord]], None]] = []
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __iter__(self) -> Iterator[VideoRecord]:
+        return iter(self._order)
+
+    def __getitem__(self, position: int) -> VideoRecord:
+        return self._order[position]
+
+    def get(self, video_id: str) -> Optional[VideoRecord]:
+        return self._by_id.get(video_id)
+
+    def by_url(self, url: str) -> Optional[VideoRecord]:
+        return self._by_url.get(url)
+
+    def by_hash(self, content_hash: str) -> Optional[VideoRecord]:
+        return self._by_hash.get(content_hash)
+
+    def position(self, record: VideoRecord) -> int:
+        """Rotation index of a record, or -1 if it is not in the catalog."""
+        i = bisect_left(self._order, record.seq, key=_seq_key)
+        if i < len(self._order) and self._order[i] is record:
+            return i
+        return -1
+
+    def clear(self):
+        self._order.clear()
+        self._by_id.clear()
+        self._by_url.clear()
+        self._by_hash.clear()
+        for records in self._by_source.values():
+            records.clear()
+        self._by_likes.clear()
+        self.version += 1
+        self._notify("clear", None)
+
+    def add(self, record: VideoRecord) -> VideoRecord:
+        """
+        Append a record to the rotation, replacing any record with the same URL.
+
+        Returns:
+            The record
+        """
+        if record.url in self._by_url:
+            self.remove(record.url)
+        record.seq = next(self._seqs)
+        # New records always have the highest sequence number
+        self._order.append(record)
+        self._by_source[record.source].append(record)
+        self._by_id[record.id] = record
+        self._by_url[record.url] = record
+        if record.content_hash is not None:
+            self._by_hash.setdefault(record.content_hash, record)
+        insort(self._by_likes, record, key=_likes_key)
+        self.version += 1
+        self._notify("add", record)
+        return record
+
+    def remove(self, url: str) -> Optional[VideoRecord]:
+        record = self._by_url.pop(url, None)
+        if record is None:
+            return None
+        del self._by_id[record.id]
+        self._unhash(record)
+        self._discard(self._order, record, _seq_key)
+        self._discard(self._by_source[record.source], record, _seq_key)
+        self._discard(self._by_likes, record, _likes_key)
+        self.version += 1
+        self._notify("remove", record)
+        return record
+
+    def update(self, record: VideoRecord, **fields):
+        """Set fields on a record, keeping the indexes in step."""
+        indexed = self._by_id.get(record.id) is record
+        if indexed and "likes" in fields:
+            self._discard(self._by_likes, record, _likes_key)
+        if indexed and "content_hash" in fields:
+            self._unhash(record)
+        for name, value in fields.items():
+            setattr(record, name, value)
+        if indexed:
+            if "likes" in fields:
+                insort(self._by_likes, record, key=_likes_key)
+            if "content_hash" in fields and record.content_hash is not None:
+                self._by_hash.setdefault(record.content_hash, record)
+            self.version += 1
+            self._notify("update", record)
+
+    def page(
+        self,
+        limit: int,
+        cursor: Optional[str] = None,
+        source: Optional[str] = None,
+        sort: str = "catalog"
+    ) -> Tuple[List[VideoRecord], Optional[str]]:
+        """
+        One page of records.
+
+        Args:
+            limit: Maximum number of records
+            cursor: next_cursor from the previous page, or None for the first
+            source: Only return records from this source
+            sort: "catalog" for rotation order, "likes" for most liked first
+
+        Returns:
+            (records, next_cursor); next_cursor is None on the last page
+
+        Raises:
+            ValueError for an unknown source or sort, or a malformed cursor
+        """
+        if source is not None and source not in SOURCES:
+            raise ValueError(f"Unknown source: {source}")
+
+        if sort == "catalog":
+            records = self._order if source is None else self._by_source[source]
+            start = 0
+            if cursor:
+                start = bisect_right(records, int(cursor), key=_seq_key)
+            items = records[start:start + limit]
+            more = start + limit < len(records)
+            next_cursor = str(items[-1].seq) if more and items else None
+            return items, next_cursor
+
+        if sort == "likes":
+            start = 0
+            if cursor:
+                likes, _, seq = cursor.partition(".")
+                start = bisect_right(self._by_likes, (-int(likes), int(seq)), key=_likes_key)
+            if source is None:
+                items = self._by_likes[start:start + limit]
+                more = start + limit < len(self._by_likes)
+            else:
+                # Scan the likes index, skipping other sources
+                matches = (r for r in itertools.islice(self._by_likes, start, None) if r.source == source)
+                items = list(itertools.islice(matches, limit + 1))
+                more = len(items) > limit
+                items = items[:limit]
+            next_cursor = f"{items[-1].likes}.{items[-1].seq}" if more and items else None
+            return items, next_cursor
+
+        raise ValueError(f"Unknown sort: {sort}")
+
+    def _notify(self, change: str, record: Optional[VideoRecord]):
+        for listener in self.listeners:
+            listener(change, record)
+
+    def _unhash(self, record: VideoRecord):
+        if record.content_hash is not None and self._by_hash.get(record.content_hash) is record:
+            del self._by_hash[record.content_hash]
+
+    @staticmethod
+    def _discard(records: List[VideoRecord], record: VideoRecord, key):
+        i = bisect_left(records, key(record), key=key)
+        if i < len(records) and records[i] is record:
+            del records[i]
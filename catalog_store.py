@@ -0,0 +1,129 @@
+"""
+Compact on-disk snapshot of the catalog.
+
+The catalog is saved as msgpack: one array of field values per record, in
+rotation order, plus the (size, mtime) signatures of the local files it was
+built from. Loading it takes milliseconds even for large catalogs, so
+startup does not wait on probing, hashing or S3 listings; the directory
+watchers and the S3 sync then apply only what changed since it was written.
+"""
+import os
+import asyncio
+import logging
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import msgpack
+
+from catalog import VideoRecord
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Snapshot settings
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+CATALOG_SNAPSHOT_PATH = os.path.join(CACHE_DIR, "catalog.msgpack")
+CATALOG_SNAPSHOT_INTERVAL = float(os.getenv("CATALOG_SNAPSHOT_INTERVAL", "5"))
+
+SNAPSHOT_VERSION = 1
+# Persisted record fields. ID and source derive from the URL, and likes
+# live in the like counter's database.
+SNAPSHOT_FIELDS = (
+    "url", "duration", "etag", "hls_url", "width", "height", "codec", "audio_codec",
+    "bitrate", "format", "poster_url", "sprite", "content_hash",
+)
+
+# directory -> file name -> (size, mtime_ns)
+FileSignatures = Dict[str, Dict[str, Tuple[int, int]]]
+
+def dump_snapshot(records: Iterable[VideoRecord], files: FileSignatures) -> bytes:
+    """Serialize records and file signatures."""
+    return msgpack.packb({
+        "version": SNAPSHOT_VERSION,
+        "fields": SNAPSHOT_FIELDS,
+        "records": [[getattr(record, field) for field in SNAPSHOT_FIELDS] for record in records],
+        "files": files,
+    })
+
+def parse_snapshot(data: bytes) -> Tuple[List[VideoRecord], FileSignatures]:
+    """
+    Rebuild records and file signatures from a snapshot.
+
+    Raises:
+        ValueError for an unreadable snapshot or an unknown format version
+    """
+    try:
+        snapshot = msgpack.unpackb(data)
+    except Exception as e:
+        raise ValueError(f"Unreadable catalog snapshot: {e}")
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"Unknown catalog snapshot version {snapshot.get('version')}")
+
+    # Fields are matched by name, so snapshots survive fields being added
+    fields = [field if field in SNAPSHOT_FIELDS else None for field in snapshot["fields"]]
+    records = []
+    for values in snapshot["records"]:
+        row = dict(zip(fields, values))
+        record = VideoRecord(row["url"], row["duration"], etag=row.get("etag"))
+        for field in SNAPSHOT_FIELDS[3:]:
+            setattr(record, field, row.get(field))
+        records.append(record)
+    files = {
+        directory: {name: tuple(signature) for name, signature in names.items()}
+        for directory, names in snapshot["files"].items()
+    }
+    return records, files
+
+class CatalogSnapshot:
+    """
+    Loads the catalog snapshot at startup and rewrites it when the catalog changes.
+    """
+
+    def __init__(self, path: str = CATALOG_SNAPSHOT_PATH, interval: float = CATALOG_SNAPSHOT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.saved_version = None
+
+    def load(self) -> Optional[Tuple[List[VideoRecord], FileSignatures]]:
+        """
+        Returns:
+            (records, file signatures), or None if there is no usable snapshot
+        """
+        try:
+            with open(self.path, "rb") as f:
+                return parse_snapshot(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Ignoring catalog snapshot {self.path}: {e}")
+            return None
+
+    def write(self, data: bytes):
+        """Atomically replace the snapshot file (runs in a worker thread)."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    async def save(self, version: int, records: Iterable[VideoRecord], files: FileSignatures):
+        """Write a snapshot unless this catalog version is already saved."""
+        if version == self.saved_version:
+            return
+        # Serialize on the loop so the records can't change mid-write
+        data = dump_snapshot(records, files)
+        await asyncio.to_thread(self.write, data)
+        self.saved_version = version
+
+    async def run(self, state: Callable[[], Tuple[int, Iterable[VideoRecord], FileSignatures]]):
+        """
+        Save the catalog every interval while it keeps changing, until cancelled.
+
+        Args:
+            state: Returns (catalog version, records, file signatures)
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save(*state())
+            except Exception as e:
+                logger.error(f"Saving the catalog snapshot failed: {e}")
@@ -0,0 +1,121 @@
+"""
+Incremental S3 catalog sync with a persisted manifest.
+
+The manifest records key, ETag, size and LastModified for every video in the
+bucket. At startup it is loaded from disk so the rotation can start without
+waiting on S3; a background refresh then pages through the bucket and hands
+only the added, changed and removed objects to the caller.
+"""
+import os
+import json
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+import s3_utils
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Sync settings
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+S3_MANIFEST_PATH = os.path.join(CACHE_DIR, "s3_manifest.json")
+S3_SYNC_INTERVAL = float(os.getenv("S3_SYNC_INTERVAL", "300"))
+
+class CatalogDelta(NamedTuple):
+    added: List[dict]
+    changed: List[dict]
+    removed: List[dict]
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+def diff_manifests(old: Dict[str, dict], new: Dict[str, dict]) -> CatalogDelta:
+    """
+    Compare two manifests keyed by S3 key.
+
+    Returns:
+        The objects added, changed (different ETag or size) and removed
+    """
+    added = [entry for key, entry in new.items() if key not in old]
+    changed = [
+        entry for key, entry in new.items()
+        if key in old and (old[key]["etag"], old[key]["size"]) != (entry["etag"], entry["size"])
+    ]
+    removed = [entry for key, entry in old.items() if key not in new]
+    return CatalogDelta(added, changed, removed)
+
+class S3CatalogSync:
+    """
+    Keeps a local manifest of the bucket in step with S3.
+    """
+
+    def __init__(self, manifest_path: str = S3_MANIFEST_PATH, interval: float = S3_SYNC_INTERVAL):
+        self.manifest_path = manifest_path
+        self.interval = interval
+        self.manifest: Dict[str, dict] = {}
+
+    def load(self) -> List[dict]:
+        """
+        Load the cached manifest from disk.
+
+        Returns:
+            The cached video entries, in key order
+        """
+        try:
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+        except json.JSONDecodeError as e:
+            logger.error(f"Ignoring corrupt S3 manifest {self.manifest_path}: {e}")
+            self.manifest = {}
+        return [self.manifest[key] for key in sorted(self.manifest)]
+
+    def save(self):
+        """Atomically write the manifest to disk."""
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, separators=(",", ":"))
+        os.replace(tmp_path, self.manifest_path)
+
+    async def sync(self, on_delta: Optional[Callable[[CatalogDelta], Awaitable[None]]] = None) -> CatalogDelta:
+        """
+        Page through the bucket and apply the differences to the manifest.
+
+        Args:
+            on_delta: Applies a non-empty delta before the manifest takes it in
+
+        Raises:
+            Any S3 error or error from `on_delta`, leaving the manifest
+            untouched so the same delta comes up again on the next sync
+        """
+        listing = await s3_utils.run_in_s3_executor(s3_utils.list_s3_videos_or_raise)
+        new_manifest = {entry["key"]: entry for entry in listing}
+        delta = diff_manifests(self.manifest, new_manifest)
+        if delta and on_delta is not None:
+            await on_delta(delta)
+        self.manifest = new_manifest
+        if delta:
+            await asyncio.to_thread(self.save)
+            logger.info(
+                f"S3 catalog sync: {len(delta.added)} added, "
+                f"{len(delta.changed)} changed, {len(delta.removed)} removed"
+            )
+        return delta
+
+    async def run(self, on_delta: Callable[[CatalogDelta], Awaitable[None]]):
+        """
+        Sync immediately, then every `interval` seconds, passing deltas to `on_delta`.
+        """
+        if not all([s3_utils.AWS_ACCESS_KEY_ID, s3_utils.AWS_SECRET_ACCESS_KEY, s3_utils.S3_BUCKET_NAME]):
+            logger.warning("S3 credentials not configured, catalog sync disabled")
+            return
+
+        while True:
+            try:
+                await self.sync(on_delta)
+            except Exception as e:
+                logger.error(f"Error syncing S3 catalog: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,385 @@
+"""
+Multi-channel playback scheduling driven by a single timer heap.
+
+Every channel has its own playlist and position, but no task of its own:
+one scheduler coroutine keeps a heap of (due time, channel) entries and
+sleeps until the earliest one. Each switch is scheduled from the previous
+planned switch time rather than from when it actually ran, so timing errors
+never accumulate, and a channel costs one small slotted object plus one
+heap entry.
+
+Each channel also draws its next few videos ahead of time. The look-ahead
+is a promise: videos are played in the order they were announced unless
+they stop being playable, so clients can prefetch them before the switch.
+
+Videos are drawn in playlist order, or with PLAYLIST_STRATEGY=shuffle or
+weighted, at random from a per-channel Playlist (see playlist.py) that the
+catalog keeps up to date as videos come, go and collect likes.
+"""
+import os
+import re
+import math
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import metrics
+from catalog import Catalog, VideoRecord
+from playlist import Playlist
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Channel that follows the whole catalog and backs /video-updates
+DEFAULT_CHANNEL = "main"
+CHANNEL_ID_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+
+# How long to wait before retrying a channel with nothing to play
+EMPTY_RETRY_SECONDS = 1.0
+
+# How many upcoming videos each channel announces ahead of time
+SCHEDULE_LOOKAHEAD = int(os.getenv("SCHEDULE_LOOKAHEAD", "3"))
+
+# Playlist order settings
+PLAYLIST_STRATEGIES = ("sequential", "shuffle", "weighted")
+PLAYLIST_STRATEGY = os.getenv("PLAYLIST_STRATEGY", "sequential")
+# Weighted: every doubling of a video's likes adds this to its base weight of 1
+PLAYLIST_LIKE_WEIGHT = float(os.getenv("PLAYLIST_LIKE_WEIGHT", "1"))
+# Videos added while the server runs are weighted this many times higher...
+PLAYLIST_RECENCY_BOOST = float(os.getenv("PLAYLIST_RECENCY_BOOST", "4"))
+# ...for this many seconds
+PLAYLIST_RECENCY_SECONDS = float(os.getenv("PLAYLIST_RECENCY_SECONDS", "3600"))
+# How many recently drawn videos can't be drawn again
+PLAYLIST_NO_REPEAT = int(os.getenv("PLAYLIST_NO_REPEAT", "10"))
+# Seed for a reproducible order; each channel derives its own from it
+PLAYLIST_SEED = os.getenv("PLAYLIST_SEED") or None
+# Playlist weights are integers, so a weight of 1 is this many units
+WEIGHT_SCALE = 1000
+
+class Channel:
+    """
+    A playlist and its playback position.
+
+    `urls` is None for channels that follow the whole catalog.
+    """
+    __slots__ = ("id", "urls", "position", "token", "started_at", "ends_at", "upcoming", "playlist", "indexes")
+
+    def __init__(self, channel_id: str, urls: Optional[List[str]] = None):
+        self.id = channel_id
+        self.urls = urls
+        self.position = -1      # Index on air; -1 until the first switch
+        self.token = 0          # Matches the channel's live heap entry
+        self.started_at = 0.0   # Planned loop time the video on air started
+        self.ends_at = 0.0      # Planned loop time of the next switch
+        # (video, index, total) drawn after the video on air, in play order
+        self.upcoming: Deque[Tuple[VideoRecord, int, int]] = deque()
+        # Random strategies: URLs to draw from, built on the first draw
+        self.playlist: Optional[Playlist[str]] = None
+        self.indexes: Dict[str, int] = {}  # URL -> first index in `urls`
+
+class ChannelScheduler:
+    """
+    Switches every channel's video from one timer heap.
+    """
+
+    def __init__(
+        self,
+        catalog: Callable[[], Catalog],
+        lookup: Callable[[str], Optional[VideoRecord]],
+        on_switch: Callable[[Channel, VideoRecord, int, int], Awaitable[None]],
+        lookahead: int = SCHEDULE_LOOKAHEAD,
+        strategy: str = PLAYLIST_STRATEGY,
+        seed: Optional[str] = PLAYLIST_SEED
+    ):
+        """
+        Args:
+            catalog: Returns the full ordered catalog
+            lookup: Returns the catalog record for a URL, or None if it is gone
+            on_switch: Called with (channel, video, index, total) at every switch
+            lookahead: How many videos to draw ahead of the one on air
+            strategy: "sequential", "shuffle" or "weighted"
+            seed: Seed for the random strategies, or None for an unseeded order
+
+        Raises:
+            ValueError for an unknown strategy
+        """
+        if strategy not in PLAYLIST_STRATEGIES:
+            raise ValueError(f"Unknown playlist strategy: {strategy}")
+        self.catalog = catalog
+        self.lookup = lookup
+        self.on_switch = on_switch
+        self.lookahead = lookahead
+        self.strategy = strategy
+        self.seed = seed
+        self.channels: Dict[str, Channel] = {}
+        self.running = False
+        self._heap: List[Tuple[float, int, str]] = []
+        self._tokens = itertools.count(1)
+        self._changed: Optional[asyncio.Event] = None
+
+    def __len__(self) -> int:
+        return len(self.channels)
+
+    def set_channel(self, channel_id: str, urls: Optional[List[str]] = None) -> Channel:
+        """
+        Create a channel or replace its playlist.
+
+        An unchanged playlist is left alone. A changed URL list is applied to
+        the channel's Playlist as a diff, so its no-repeat window and recency
+        boosts survive, and look-ahead entries still in the list stay
+        announced.
+        """
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = Channel(channel_id, urls)
+            self.channels[channel_id] = channel
+            if self.running:
+                self._schedule(channel, asyncio.get_running_loop().time())
+            return channel
+        if urls == channel.urls:
+            return channel
+
+        following_catalog = channel.urls is None or urls is None
+        channel.urls = urls
+        if following_catalog:
+            # Switching to or from the whole catalog: nothing carries over
+            channel.upcoming.clear()
+            channel.playlist = None
+            return channel
+
+        indexes: Dict[str, int] = {}
+        for index, url in enumerate(urls):
+            indexes.setdefault(url, index)
+        if channel.playlist is not None:
+            for url in channel.indexes.keys() - indexes.keys():
+                channel.playlist.remove(url)
+            for url in indexes.keys() - channel.indexes.keys():
+                video = self.lookup(url)
+                channel.playlist.add(url, 0 if video is None else self._weight(video))
+            channel.indexes = indexes
+
+        # Keep the look-ahead up to the first video that left the list
+        upcoming = deque()
+        for video, _, _ in channel.upcoming:
+            if video.url not in indexes:
+                break
+            upcoming.append((video, indexes[video.url], len(urls)))
+        channel.upcoming = upcoming
+        return channel
+
+    def remove_channel(self, channel_id: str):
+        """Remove a channel; its heap entry is skipped when it comes due."""
+        self.channels.pop(channel_id, None)
+
+    def next_video(self, channel: Channel) -> Optional[Tuple[VideoRecord, int, int]]:
+        """
+        Advance a channel to the first video of its look-ahead.
+
+        Returns:
+            (video, index, total), or None if the playlist is empty
+        """
+        self._fill(channel)
+        if not channel.upcoming:
+            return None
+        video, index, total = channel.upcoming.popleft()
+        if channel.urls is None:
+            # The catalog may have changed since this entry was drawn
+            catalog = self.catalog()
+            total = len(catalog)
+            if self.strategy != "sequential":
+                index = catalog.position(video)
+        channel.position = index
+        return video, index, total
+
+    def upcoming(self, channel: Channel) -> List[Tuple[VideoRecord, int, int, float]]:
+        """
+        The videos that will follow the one on air.
+
+        Returns:
+            (video, index, total, planned start loop time) for each, in play order
+        """
+        self._fill(channel)
+        schedule = []
+        start = channel.ends_at
+        for video, index, total in itertools.islice(channel.upcoming, self.lookahead):
+            schedule.append((video, index, total, start))
+            start += video.duration
+        return schedule
+
+    def _fill(self, channel: Channel):
+        """Drop look-ahead entries that are no longer playable, then top it up."""
+        for i, (video, index, total) in enumerate(channel.upcoming):
+            if not self._playable(channel, video, index, total):
+                # Later entries were drawn relative to this one
+                for _ in range(len(channel.upcoming) - i):
+                    channel.upcoming.pop()
+                break
+
+        # One extra, so the next switch still has lookahead entries behind it
+        while len(channel.upcoming) <= self.lookahead:
+            after = channel.upcoming[-1][1] if channel.upcoming else channel.position
+            selected = self._draw(channel, after)
+            if selected is None:
+                break
+            channel.upcoming.append(selected)
+
+    def catalog_changed(self, change: str, video: Optional[VideoRecord]):
+        """
+        Keep the channels' playlists in step with the catalog.
+
+        Args:
+            change: "add", "remove", "update" or "clear", as reported by the catalog
+            video: The record that changed, None for "clear"
+        """
+        for channel in self.channels.values():
+            playlist = channel.playlist
+            if playlist is None:
+                continue  # Built from the catalog on the next draw
+            if change == "clear":
+                channel.playlist = None
+            elif channel.urls is None:
+                if change == "remove":
+                    playlist.remove(video.url)
+                else:
+                    playlist.add(video.url, self._weight(video), new=change == "add")
+            elif video.url in channel.indexes:
+                # Listed URLs stay in the playlist, with no weight while they are missing
+                weight = 0 if change == "remove" else self._weight(video)
+                playlist.add(video.url, weight, new=change == "add")
+
+    def _draw(self, channel: Channel, after: int) -> Optional[Tuple[VideoRecord, int, int]]:
+        """The first playable video after playlist index `after`, or a random one."""
+        if self.strategy != "sequential":
+            return self._draw_random(channel)
+
+        if channel.urls is None:
+            playlist = self.catalog()
+            if not playlist:
+                return None
+            index = (after + 1) % len(playlist)
+            return playlist[index], index, len(playlist)
+
+        # Skip URLs that have left the catalog
+        total = len(channel.urls)
+        index = after
+        for _ in range(total):
+            index = (index + 1) % total
+            video = self.lookup(channel.urls[index])
+            if video is not None:
+                return video, index, total
+        return None
+
+    def _draw_random(self, channel: Channel) -> Optional[Tuple[VideoRecord, int, int]]:
+        playlist = channel.playlist or self._build_playlist(channel)
+        url = playlist.draw()
+        if url is None:
+            return None
+        video = self.lookup(url)
+        if channel.urls is None:
+            catalog = self.catalog()
+            return video, catalog.position(video), len(catalog)
+        return video, channel.indexes[url], len(channel.urls)
+
+    def _build_playlist(self, channel: Channel) -> Playlist[str]:
+        if channel.urls is None:
+            items = [(video.url, self._weight(video)) for video in self.catalog()]
+        else:
+            channel.indexes = {}
+            for index, url in enumerate(channel.urls):
+                channel.indexes.setdefault(url, index)
+            items = []
+            for url in channel.indexes:
+                video = self.lookup(url)
+                items.append((url, 0 if video is None else self._weight(video)))
+        channel.playlist = Playlist(
+            items,
+            no_repeat=PLAYLIST_NO_REPEAT,
+            boost=PLAYLIST_RECENCY_BOOST,
+            boost_seconds=PLAYLIST_RECENCY_SECONDS,
+            rng=random.Random(f"{self.seed}:{channel.id}") if self.seed is not None else None
+        )
+        return channel.playlist
+
+    def _weight(self, video: VideoRecord) -> int:
+        if self.strategy == "weighted" and video.likes > 0:
+            return round(WEIGHT_SCALE * (1 + PLAYLIST_LIKE_WEIGHT * math.log2(1 + video.likes)))
+        return WEIGHT_SCALE
+
+    def _playable(self, channel: Channel, video: VideoRecord, index: int, total: int) -> bool:
+        if channel.urls is None:
+            if self.strategy != "sequential":
+                # Random draws don't depend on the position, which shifts as videos come and go
+                return self.lookup(video.url) is video
+            playlist = self.catalog()
+            return index < len(playlist) and playlist[index] is video
+        return (
+            total == len(channel.urls)
+            and channel.urls[index] == video.url
+            and self.lookup(video.url) is video
+        )
+
+    async def run(self):
+        """Run every channel's schedule until cancelled."""
+        loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self.running = True
+        now = loop.time()
+        for channel in self.channels.values():
+            self._schedule(channel, now)
+
+        try:
+            while True:
+                if not self._heap:
+                    self._changed.clear()
+                    await self._changed.wait()
+                    continue
+
+                due, token, channel_id = self._heap[0]
+                delay = due - loop.time()
+                if delay > 0:
+                    # Sleep until the earliest switch, or until a channel is added
+                    self._changed.clear()
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                heapq.heappop(self._heap)
+                channel = self.channels.get(channel_id)
+                if channel is None or channel.token != token:
+                    continue
+                metrics.SCHEDULER_DRIFT_SECONDS.observe(loop.time() - due)
+
+                duration = await self._switch(channel, due)
+                if duration is None:
+                    self._schedule(channel, loop.time() + EMPTY_RETRY_SECONDS)
+                else:
+                    # Chain from the planned time, but never schedule into the past
+                    self._schedule(channel, max(due + duration, loop.time()))
+        finally:
+            self.running = False
+
+    async def _switch(self, channel: Channel, due: float) -> Optional[float]:
+        selected = self.next_video(channel)
+        if selected is None:
+            return None
+        video, index, total = selected
+        # Clients seek relative to the planned time, so leader hiccups don't skew them
+        channel.started_at = due
+        channel.ends_at = due + video.duration
+        try:
+            await self.on_switch(channel, video, index, total)
+        except Exception as e:
+            logger.error(f"Error switching channel {channel.id}: {e}")
+        return video.duration
+
+    def _schedule(self, channel: Channel, due: float):
+        channel.token = next(self._tokens)
+        heapq.heappush(self._heap, (due, channel.token, channel.id))
+        if self._changed is not None:
+            self._changed.set()
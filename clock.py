@@ -0,0 +1,20 @@
+"""
+Millisecond server clock for playback synchronization.
+
+Timestamps are Unix epoch milliseconds, but they are derived from the
+monotonic clock (the same clock as the asyncio loop) anchored once to wall
+time at import. System clock adjustments therefore never make a running
+server's timestamps jump, and scheduler due times convert exactly.
+"""
+import time
+
+_WALL_ANCHOR = time.time()
+_MONOTONIC_ANCHOR = time.monotonic()
+
+def loop_time_to_ms(loop_time: float) -> int:
+    """Convert an asyncio loop / time.monotonic() timestamp to epoch milliseconds."""
+    return int((_WALL_ANCHOR + (loop_time - _MONOTONIC_ANCHOR)) * 1000)
+
+def now_ms() -> int:
+    """Current server time in epoch milliseconds."""
+    return loop_time_to_ms(time.monotonic())
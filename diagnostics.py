@@ -0,0 +1,387 @@
+"""
+On-demand diagnostics for a running server.
+
+Everything here is switched on by an admin request and costs nothing until
+then, so it can be used in production without a restart:
+
+- SamplingProfiler: samples every thread's Python stack from a background
+  thread for a fixed time and returns collapsed stacks (flamegraph.pl,
+  speedscope, inferno) or a speedscope profile.
+- MemoryTracer: tracemalloc snapshots, each diffed against the previous one.
+- SlowCallbackTracker: times every event loop callback, like asyncio debug
+  mode's slow_callback_duration warning but without debug mode's overhead,
+  and keeps the slowest recent ones with the task and stack they ran in.
+- dump_tasks / dump_threads: the current stack of every task and thread.
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+import tracemalloc
+from collections import Counter, deque
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Admin endpoints are disabled unless a token is set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_MAX_SECONDS = 60.0
+PROFILE_MIN_INTERVAL = 0.001
+
+# Leaf frames of threads that are only waiting, left out of profiles by default
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),  # concurrent.futures workers waiting for work
+}
+
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+# A frame as (function, file, first line)
+Frame = Tuple[str, str, int]
+
+@lru_cache(maxsize=8192)
+def _frame_key(code) -> Frame:
+    filename = code.co_filename
+    # Paths relative to sys.path keep frame names short and host-independent
+    for root in sorted(sys.path, key=len, reverse=True):
+        if root and filename.startswith(root + os.sep):
+            filename = filename[len(root) + 1:]
+            break
+    return getattr(code, "co_qualname", code.co_name), filename, code.co_firstlineno
+
+class SamplingProfiler:
+    """
+    Wall-clock sampling profiler for all threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def run(self, seconds: float, interval: float, include_idle: bool = False) -> "Profile":
+        """
+        Sample stacks until `seconds` have passed (blocks; run it in a thread).
+
+        Raises:
+            RuntimeError if another profile is being taken
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already being taken")
+        try:
+            seconds = min(max(seconds, interval), PROFILE_MAX_SECONDS)
+            interval = max(interval, PROFILE_MIN_INTERVAL)
+            own = threading.get_ident()
+            names = {}
+            samples: Dict[int, Counter] = {}
+            started = time.perf_counter()
+            deadline = started + seconds
+            next_sample = started
+            count = 0
+            while True:
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+                if now < next_sample:
+                    time.sleep(next_sample - now)
+                next_sample += interval
+                count += 1
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(_frame_key(frame.f_code))
+                        frame = frame.f_back
+                    if not include_idle and (os.path.basename(stack[0][1]), stack[0][0]) in IDLE_FRAMES:
+                        continue
+                    stack.reverse()
+                    samples.setdefault(thread_id, Counter())[tuple(stack)] += 1
+                if len(names) != threading.active_count():
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+            elapsed = time.perf_counter() - started
+            thread_names = {
+                thread_id: names.get(thread_id, f"thread-{thread_id}") for thread_id in samples
+            }
+            return Profile(samples, thread_names, count, elapsed, elapsed / max(count, 1))
+        finally:
+            self._lock.release()
+
+class Profile:
+    """
+    Stacks sampled by SamplingProfiler, with exporters.
+    """
+
+    def __init__(self, samples: Dict[int, Counter], thread_names: Dict[int, str], count: int, seconds: float, interval: float):
+        self.samples = samples  # thread id -> stack (root first) -> sample count
+        self.thread_names = thread_names
+        self.count = count
+        self.seconds = seconds
+        self.interval = interval  # Achieved mean interval
+
+    def collapsed(self) -> str:
+        """One `thread;frame;...;frame count` line per distinct stack."""
+        lines = []
+        for thread_id, stacks in self.samples.items():
+            root = self.thread_names[thread_id].replace(";", ":").replace(" ", "_")
+            for stack, count in stacks.most_common():
+                frames = ";".join(f"{name} ({filename}:{line})".replace(";", ":") for name, filename, line in stack)
+                lines.append(f"{root};{frames} {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self) -> dict:
+        """A speedscope file with one sampled profile per thread, weighted in seconds."""
+        frames: List[dict] = []
+        index: Dict[Frame, int] = {}
+        profiles = []
+        for thread_id, stacks in self.samples.items():
+            samples, weights = [], []
+            for stack, count in stacks.items():
+                ids = []
+                for frame in stack:
+                    if frame not in index:
+                        index[frame] = len(frames)
+                        name, filename, line = frame
+                        frames.append({"name": name, "file": filename, "line": line})
+                    ids.append(index[frame])
+                samples.append(ids)
+                weights.append(count * self.interval)
+            profiles.append({
+                "type": "sampled",
+                "name": self.thread_names[thread_id],
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            })
+        return {
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": f"channels {self.seconds:.1f}s wall-clock profile",
+            "activeProfileIndex": 0,
+            "exporter": "channels diagnostics",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+class MemoryTracer:
+    """
+    tracemalloc snapshots, each compared with the previous one.
+    """
+
+    def __init__(self):
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 16):
+        """Start tracing allocations; the first snapshot becomes the baseline."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.baseline = self._snapshot()
+
+    def stop(self):
+        tracemalloc.stop()
+        self.baseline = None
+
+    def diff(self, group_by: str = "lineno", limit: int = 25) -> dict:
+        """
+        Compare a new snapshot with the previous one, which it then replaces.
+
+        Args:
+            group_by: "lineno", "filename" or "traceback"
+            limit: Number of largest changes to return
+        """
+        snapshot = self._snapshot()
+        stats = snapshot.compare_to(self.baseline, group_by)
+        self.baseline = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "size_diff_bytes": sum(stat.size_diff for stat in stats),
+            "top": [
+                {
+                    "size_diff": stat.size_diff,
+                    "size": stat.size,
+                    "count_diff": stat.count_diff,
+                    "count": stat.count,
+                    "traceback": [f"{frame.filename}:{frame.lineno}" for frame in reversed(stat.traceback)],
+                }
+                for stat in stats[:limit]
+            ],
+        }
+
+    def collapsed(self) -> str:
+        """
+        Allocation growth since the previous snapshot as collapsed stacks
+        weighted by bytes, for a memory flamegraph. Replaces the baseline.
+        """
+        snapshot = self._snapshot()
+        stats = snapshot.compare_to(self.baseline, "traceback")
+        self.baseline = snapshot
+        lines = []
+        for stat in stats:
+            if stat.size_diff <= 0:
+                continue
+            frames = ";".join(f"{frame.filename}:{frame.lineno}".replace(";", ":") for frame in reversed(stat.traceback))
+            lines.append(f"{frames} {stat.size_diff}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+
+class SlowCallbackTracker:
+    """
+    Times every event loop callback while enabled and records slow ones.
+
+    Handle._run is wrapped for the whole process, the same hook asyncio's
+    debug mode uses for its slow callback warnings. Only the loop thread
+    runs handles, so the recorded state needs no lock.
+    """
+
+    def __init__(self, history: int = 200):
+        self.threshold: Optional[float] = None
+        self.slow = deque(maxlen=history)
+        self.callbacks = 0
+        self.slow_total = 0
+        self.enabled_at: Optional[float] = None
+        self._original_run = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._original_run is not None
+
+    def enable(self, threshold: float):
+        """Start recording callbacks slower than `threshold` seconds."""
+        self.threshold = threshold
+        if self._original_run is not None:
+            return
+        self.slow.clear()
+        self.callbacks = self.slow_total = 0
+        self.enabled_at = time.time()
+        original = self._original_run = asyncio.Handle._run
+        tracker = self
+
+        def timed_run(handle):
+            started = time.perf_counter()
+            try:
+                original(handle)
+            finally:
+                elapsed = time.perf_counter() - started
+                tracker.callbacks += 1
+                if elapsed >= tracker.threshold:
+                    tracker._record(handle, elapsed)
+
+        asyncio.Handle._run = timed_run
+
+    def disable(self):
+        if self._original_run is not None:
+            asyncio.Handle._run = self._original_run
+            self._original_run = None
+
+    def report(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "threshold_ms": self.threshold * 1000 if self.threshold is not None else None,
+            "enabled_at": self.enabled_at,
+            "callbacks": self.callbacks,
+            "slow_callbacks": self.slow_total,
+            "slowest": sorted(self.slow, key=lambda entry: entry["duration_ms"], reverse=True),
+        }
+
+    def _record(self, handle: asyncio.Handle, elapsed: float):
+        self.slow_total += 1
+        callback = handle._callback
+        entry = {"at": time.time(), "duration_ms": round(elapsed * 1000, 3), "callback": _callback_name(callback)}
+        # For a task step, say which task ran and where it stopped
+        task = getattr(callback, "__self__", None)
+        if isinstance(task, asyncio.Task):
+            entry["task"] = task.get_name()
+            entry["coroutine"] = getattr(task.get_coro(), "__qualname__", repr(task.get_coro()))
+            # Where the step ended, which is usually just after the slow code
+            entry["stack"] = [
+                f"{frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+                for frame in await_stack(task.get_coro())
+            ]
+        self.slow.append(entry)
+
+def _callback_name(callback) -> str:
+    name = getattr(callback, "__qualname__", None) or repr(callback)
+    func = getattr(callback, "__func__", callback)
+    code = getattr(func, "__code__", None)
+    if code is not None:
+        return f"{name} ({code.co_filename}:{code.co_firstlineno})"
+    return name
+
+def await_stack(coro) -> list:
+    """
+    Frames of a suspended coroutine and everything it awaits, outermost
+    first. Task.get_stack stops at the task's own coroutine, because
+    suspended frames are not linked to the frames they await.
+    """
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is not None:
+            frames.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    return frames
+
+def dump_tasks() -> List[dict]:
+    """Every asyncio task of the running loop with its current await stack."""
+    tasks = []
+    for task in asyncio.all_tasks():
+        coro = task.get_coro()
+        tasks.append({
+            "name": task.get_name(),
+            "coroutine": getattr(coro, "__qualname__", repr(coro)),
+            "done": task.done(),
+            "stack": [
+                f"{frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+                for frame in await_stack(coro)
+            ],
+        })
+    tasks.sort(key=lambda task: task["name"])
+    return tasks
+
+def dump_threads() -> List[dict]:
+    """Every thread with its current stack, innermost frame last."""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    return [
+        {
+            "name": names.get(thread_id, f"thread-{thread_id}"),
+            "stack": [f"{entry.filename}:{entry.lineno} in {entry.name}" for entry in traceback.extract_stack(frame)],
+        }
+        for thread_id, frame in sys._current_frames().items()
+    ]
+
+def format_dump(tasks: List[dict], threads: List[dict]) -> str:
+    """Tasks and threads as a plain-text dump, like py-spy dump."""
+    lines = [f"{len(tasks)} tasks", ""]
+    for task in tasks:
+        lines.append(f"Task {task['name']} ({task['coroutine']}){' done' if task['done'] else ''}")
+        lines.extend(f"    {frame}" for frame in task["stack"])
+        lines.append("")
+    lines += [f"{len(threads)} threads", ""]
+    for thread in threads:
+        lines.append(f"Thread {thread['name']}")
+        lines.extend(f"    {frame}" for frame in thread["stack"])
+        lines.append("")
+    return "\n".join(lines)
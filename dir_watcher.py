@@ -0,0 +1,267 @@
+"""
+Incremental watching of the local video directories.
+
+Each directory's video files are tracked by (size, mtime). On Linux the
+watcher sleeps on inotify, called through ctypes so there is no extra
+dependency, and only re-stats the names the kernel reports: files when they
+are closed after writing or moved in, and files that appear through link()
+once a debounce window has passed without writes to them. Where inotify
+is unavailable it rescans the directory every WATCH_POLL_INTERVAL seconds.
+Either way, only added, changed and removed files are reported.
+"""
+import os
+import errno
+import ctypes
+import struct
+import asyncio
+import logging
+import ctypes.util
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Watch settings
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", "5"))
+# Events are collected for this long before being applied, so a burst of
+# writes becomes one delta
+WATCH_DEBOUNCE = 0.2
+WATCH_BACKEND = os.getenv("WATCH_BACKEND", "auto")  # auto, inotify or poll
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = (
+    IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+class FileDelta(NamedTuple):
+    added: List[str]
+    changed: List[str]
+    removed: List[str]
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+class Inotify:
+    """
+    Minimal non-blocking inotify handle watching one directory.
+    """
+    _libc = None
+
+    def __init__(self, directory: str):
+        self.gone = False
+        libc = self._load_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, os.strerror(error))
+
+    @classmethod
+    def _load_libc(cls):
+        if cls._libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            cls._libc = libc
+        return cls._libc
+
+    def read(self) -> Tuple[Set[str], Set[str], Set[str], bool]:
+        """
+        Drain pending events.
+
+        Returns:
+            (names that changed, files created without being written yet,
+            files written to, whether a full rescan is needed)
+        """
+        names = set()
+        created = set()
+        written = set()
+        rescan = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return names, created - written - names, written, rescan
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    # The watch is gone with the directory
+                    self.gone = True
+                    rescan = True
+                elif mask & IN_Q_OVERFLOW:
+                    rescan = True
+                elif not name or mask & IN_ISDIR:
+                    continue
+                elif mask & IN_CREATE:
+                    created.add(os.fsdecode(name))
+                elif mask & IN_MODIFY:
+                    written.add(os.fsdecode(name))
+                else:
+                    names.add(os.fsdecode(name))
+
+    def close(self):
+        os.close(self.fd)
+
+class DirectoryWatcher:
+    """
+    Tracks the video files in one directory.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        extensions: Tuple[str, ...],
+        files: Optional[Dict[str, Tuple[int, int]]] = None,
+        poll_interval: float = WATCH_POLL_INTERVAL
+    ):
+        """
+        Args:
+            directory: Directory to watch
+            extensions: Lower-case file extensions to track
+            files: Known file name -> (size, mtime_ns), e.g. from a catalog snapshot
+            poll_interval: Rescan interval when inotify is unavailable
+        """
+        self.directory = directory
+        self.extensions = extensions
+        self.files: Dict[str, Tuple[int, int]] = dict(files or {})
+        self.poll_interval = poll_interval
+
+    def scan(self) -> FileDelta:
+        """Compare the whole directory with the known files."""
+        return self._diff(self._stat(self._listing() | set(self.files)))
+
+    def check(self, names: Iterable[str]) -> FileDelta:
+        """Re-stat some names and report how they differ from the known files."""
+        return self._diff(self._stat(names))
+
+    def _listing(self) -> Set[str]:
+        try:
+            with os.scandir(self.directory) as entries:
+                return {entry.name for entry in entries}
+        except FileNotFoundError:
+            return set()
+
+    def _stat(self, names: Iterable[str]) -> Dict[str, Optional[Tuple[int, int]]]:
+        """(size, mtime_ns) of each video file name, None if it is gone. Safe to run in a thread."""
+        signatures = {}
+        for name in names:
+            if name.startswith(".") or not name.lower().endswith(self.extensions):
+                continue  # Hidden files include in-progress uploads
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+                signatures[name] = (st.st_size, st.st_mtime_ns)
+            except (FileNotFoundError, NotADirectoryError):
+                signatures[name] = None
+        return signatures
+
+    def _diff(self, signatures: Dict[str, Optional[Tuple[int, int]]]) -> FileDelta:
+        """Update the known files, on the event loop so readers never see them mid-change."""
+        delta = FileDelta([], [], [])
+        for name in sorted(signatures):
+            signature = signatures[name]
+            known = self.files.get(name)
+            if signature == known:
+                continue
+            if signature is None:
+                del self.files[name]
+                delta.removed.append(name)
+            else:
+                self.files[name] = signature
+                (delta.added if known is None else delta.changed).append(name)
+        return delta
+
+    async def _scan_async(self) -> FileDelta:
+        known = set(self.files)
+        signatures = await asyncio.to_thread(lambda: self._stat(self._listing() | known))
+        return self._diff(signatures)
+
+    async def run(self, on_delta: Callable[[FileDelta], Awaitable[None]]):
+        """Report changes until cancelled."""
+        inotify = None
+        if WATCH_BACKEND != "poll":
+            try:
+                inotify = Inotify(self.directory)
+            except (OSError, AttributeError) as e:
+                # AttributeError: no inotify in this libc
+                if WATCH_BACKEND == "inotify" or getattr(e, "errno", None) not in (errno.ENOENT, None):
+                    logger.warning(f"inotify unavailable for {self.directory}, polling instead: {e}")
+        if inotify is None:
+            await self._poll(on_delta)
+        else:
+            try:
+                await self._watch(inotify, on_delta)
+            finally:
+                inotify.close()
+
+    async def _poll(self, on_delta: Callable[[FileDelta], Awaitable[None]]):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self._report(await self._scan_async(), on_delta)
+
+    async def _watch(self, inotify: Inotify, on_delta: Callable[[FileDelta], Awaitable[None]]):
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        loop.add_reader(inotify.fd, ready.set)
+        try:
+            # Catch anything that changed before the watch was in place
+            await self._report(await self._scan_async(), on_delta)
+            # Created files not written to yet. One that stays untouched for a
+            # whole debounce window appeared complete, e.g. through link(), and
+            # gets no IN_CLOSE_WRITE; the others are reported when closed.
+            pending: Set[str] = set()
+            while not inotify.gone:
+                if pending:
+                    try:
+                        await asyncio.wait_for(ready.wait(), WATCH_DEBOUNCE)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await ready.wait()
+                await asyncio.sleep(WATCH_DEBOUNCE)
+                ready.clear()
+                names, created, written, rescan = inotify.read()
+                names |= pending - written
+                pending = created
+                if rescan:
+                    pending = set()
+                    delta = await self._scan_async()
+                else:
+                    delta = self._diff(await asyncio.to_thread(self._stat, names))
+                await self._report(delta, on_delta)
+        finally:
+            loop.remove_reader(inotify.fd)
+        logger.warning(f"{self.directory} was moved or deleted, polling instead")
+        await self._poll(on_delta)
+
+    async def _report(self, delta: FileDelta, on_delta: Callable[[FileDelta], Awaitable[None]]):
+        if not delta:
+            return
+        logger.info(
+            f"{self.directory}: {len(delta.added)} added, {len(delta.changed)} changed, "
+            f"{len(delta.removed)} removed"
+        )
+        try:
+            await on_delta(delta)
+        except Exception as e:
+            logger.error(f"Applying changes in {self.directory} failed: {e}")
@@ -0,0 +1,287 @@
+"""
+Background HLS/CMAF packaging of uploaded videos.
+
+Each upload is transcoded by ffmpeg into an adaptive bitrate ladder of
+fragmented-MP4 (CMAF) HLS renditions. Jobs run in a process pool behind an
+asyncio job queue, and the master playlist URL is only published into the
+catalog once every rendition has been written (and uploaded to S3 when the
+source lives there).
+"""
+import os
+import json
+import uuid
+import shutil
+import asyncio
+import logging
+import mimetypes
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import s3_utils
+from catalog import VideoRecord
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Packaging settings
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+PACKAGING_ENABLED = os.getenv("PACKAGING_ENABLED", "true").lower() == "true"
+PACKAGING_WORKERS = int(os.getenv("PACKAGING_WORKERS", "2"))
+PACKAGED_DIR = os.getenv("PACKAGED_DIR", "packaged")
+HLS_SEGMENT_SECONDS = int(os.getenv("HLS_SEGMENT_SECONDS", "4"))
+# Comma-separated height:video_kbps pairs, highest first
+HLS_LADDER = os.getenv("HLS_LADDER", "1080:5000,720:2800,480:1400,360:800")
+# Finished jobs kept for status requests
+PACKAGING_JOB_HISTORY = int(os.getenv("PACKAGING_JOB_HISTORY", "256"))
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+PACKAGED_INDEX_PATH = os.path.join(CACHE_DIR, "packaged.json")
+
+mimetypes.add_type("application/vnd.apple.mpegurl", ".m3u8")
+mimetypes.add_type("video/iso.segment", ".m4s")
+
+FINISHED_STATUSES = ("ready", "failed")
+
+def parse_ladder(ladder: str) -> List[Tuple[int, int]]:
+    """Parse HLS_LADDER into (height, video_kbps) pairs, highest first."""
+    rungs = []
+    for rung in ladder.split(","):
+        height, _, kbps = rung.strip().partition(":")
+        rungs.append((int(height), int(kbps)))
+    return sorted(rungs, reverse=True)
+
+def select_renditions(ladder: List[Tuple[int, int]], source_height: Optional[int]) -> List[Tuple[int, int]]:
+    """Drop rungs that would upscale the source, keeping at least the smallest."""
+    if not source_height:
+        return ladder
+    renditions = [rung for rung in ladder if rung[0] <= source_height]
+    return renditions or [ladder[-1]]
+
+def build_ffmpeg_command(
+    source: str,
+    output_dir: str,
+    renditions: List[Tuple[int, int]],
+    has_audio: bool,
+    segment_seconds: int = HLS_SEGMENT_SECONDS
+) -> List[str]:
+    """
+    Build one ffmpeg invocation that encodes every rendition in a single pass.
+    """
+    count = len(renditions)
+    split = f"[0:v]split={count}" + "".join(f"[v{i}]" for i in range(count))
+    scales = [f"[v{i}]scale=-2:{height}[v{i}out]" for i, (height, _) in enumerate(renditions)]
+
+    command = [
+        FFMPEG_BIN, "-y", "-v", "error", "-i", source,
+        "-filter_complex", ";".join([split] + scales),
+    ]
+    stream_map = []
+    for i, (_, kbps) in enumerate(renditions):
+        command += [
+            "-map", f"[v{i}out]",
+            f"-c:v:{i}", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+            f"-b:v:{i}", f"{kbps}k", f"-maxrate:v:{i}", f"{int(kbps * 1.07)}k", f"-bufsize:v:{i}", f"{kbps * 2}k",
+        ]
+        if has_audio:
+            command += ["-map", "a:0", f"-c:a:{i}", "aac", f"-b:a:{i}", "128k"]
+            stream_map.append(f"v:{i},a:{i},name:{i}")
+        else:
+            stream_map.append(f"v:{i},name:{i}")
+
+    command += [
+        # Keyframes on segment boundaries so every rendition switches cleanly
+        "-force_key_frames", f"expr:gte(t,n_forced*{segment_seconds})",
+        "-f", "hls",
+        "-hls_time", str(segment_seconds),
+        "-hls_playlist_type", "vod",
+        "-hls_segment_type", "fmp4",
+        "-hls_fmp4_init_filename", "init_%v.m4s",
+        "-hls_segment_filename", os.path.join(output_dir, "%v", "seg_%05d.m4s"),
+        "-master_pl_name", "master.m3u8",
+        "-var_stream_map", " ".join(stream_map),
+        os.path.join(output_dir, "%v", "index.m3u8"),
+    ]
+    return command
+
+def package_video(source: str, output_dir: str, renditions: List[Tuple[int, int]], has_audio: bool) -> str:
+    """
+    Package a video into HLS renditions. Runs in a worker process.
+
+    Returns:
+        Path of the master playlist
+
+    Raises:
+        RuntimeError if ffmpeg fails
+    """
+    tmp_dir = f"{output_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    for i in range(len(renditions)):
+        os.makedirs(os.path.join(tmp_dir, str(i)), exist_ok=True)
+
+    result = subprocess.run(
+        build_ffmpeg_command(source, tmp_dir, renditions, has_audio),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    if result.returncode != 0:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise RuntimeError(result.stderr.strip() or f"ffmpeg exited with {result.returncode}")
+
+    # Publish the finished package in one rename
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp_dir, output_dir)
+    return os.path.join(output_dir, "master.m3u8")
+
+class HLSPackager:
+    """
+    Queue of packaging jobs executed in a process pool.
+    """
+
+    def __init__(self, workers: int = PACKAGING_WORKERS, output_root: str = PACKAGED_DIR, history: int = PACKAGING_JOB_HISTORY):
+        self.workers = workers
+        self.output_root = output_root
+        self.history = history
+        self.ladder = parse_ladder(HLS_LADDER)
+        self.jobs: "OrderedDict[str, dict]" = OrderedDict()
+        # source video URL -> published master playlist URL
+        self.published: Dict[str, str] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._tasks: List[asyncio.Task] = []
+        self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(PACKAGED_INDEX_PATH) as f:
+                self.published = json.load(f)
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError as e:
+            logger.error(f"Ignoring corrupt packaging index {PACKAGED_INDEX_PATH}: {e}")
+
+    def _save_index(self):
+        os.makedirs(os.path.dirname(PACKAGED_INDEX_PATH) or ".", exist_ok=True)
+        tmp_path = f"{PACKAGED_INDEX_PATH}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.published, f, separators=(",", ":"))
+        os.replace(tmp_path, PACKAGED_INDEX_PATH)
+
+    def prune(self, by_url: Callable[[str], Optional[VideoRecord]]):
+        """
+        Forget published packages of videos no longer in the catalog, and
+        delete the ones served from local disk.
+        """
+        gone = [url for url in self.published if by_url(url) is None]
+        if not gone:
+            return
+        for url in gone:
+            output_dir = self._output_dir_for(self.published.pop(url))
+            if output_dir is not None:
+                shutil.rmtree(output_dir, ignore_errors=True)
+        self._save_index()
+        logger.info(f"Dropped {len(gone)} packages of removed videos")
+
+    def _output_dir_for(self, manifest_url: str) -> Optional[str]:
+        """The local directory of a package published as `/{output_root}/{job_id}/master.m3u8`."""
+        prefix = f"/{self.output_root}/"
+        if not manifest_url.startswith(prefix):
+            return None  # Uploaded to S3
+        job_id = manifest_url[len(prefix):].split("/", 1)[0]
+        if not job_id or job_id in (".", ".."):
+            return None
+        return os.path.join(self.output_root, job_id)
+
+    def start(self):
+        """Start the process pool and the queue consumers."""
+        if not PACKAGING_ENABLED:
+            logger.info("HLS packaging disabled")
+            return
+        # Checked once here, so uploads aren't queued for jobs that can only fail
+        if shutil.which(FFMPEG_BIN) is None:
+            logger.error(f"{FFMPEG_BIN} not found in PATH, HLS packaging disabled")
+            return
+        self._queue = asyncio.Queue()
+        # Spawned workers stay independent of the server's threads and sockets
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def submit(
+        self,
+        video: VideoRecord,
+        source: str,
+        on_ready: Callable[[VideoRecord, str], Awaitable[None]]
+    ) -> Optional[str]:
+        """
+        Queue a catalog entry for packaging.
+
+        Args:
+            video: Catalog record; its metadata picks the renditions
+            source: Local path or URL ffmpeg can read the original from
+            on_ready: Called with the record and master playlist URL when done
+
+        Returns:
+            Job ID, or None if packaging is disabled
+        """
+        if self._queue is None:
+            return None
+        job_id = uuid.uuid4().hex[:12]
+        self.jobs[job_id] = {"id": job_id, "video_id": video.id, "video_url": video.url, "status": "queued"}
+        self._queue.put_nowait((job_id, video, source, on_ready))
+        return job_id
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job_id, video, source, on_ready = await self._queue.get()
+            job = self.jobs[job_id]
+            job["status"] = "packaging"
+            output_dir = os.path.join(self.output_root, job_id)
+            renditions = select_renditions(self.ladder, video.height)
+            try:
+                await loop.run_in_executor(
+                    self._pool, package_video, source, output_dir, renditions, bool(video.audio_codec)
+                )
+                manifest_url = await self._publish(job_id, video, output_dir)
+                self.published[video.url] = manifest_url
+                await asyncio.to_thread(self._save_index)
+                job.update(status="ready", hls_url=manifest_url)
+                await on_ready(video, manifest_url)
+                logger.info(f"Packaged {video.url} into {len(renditions)} renditions: {manifest_url}")
+            except Exception as e:
+                job.update(status="failed", error=str(e))
+                logger.error(f"Packaging failed for {video.url}: {e}")
+            finally:
+                self._trim()
+                self._queue.task_done()
+
+    def _trim(self):
+        """Forget the oldest finished jobs beyond the history size."""
+        excess = len(self.jobs) - self.history
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self.jobs.items() if job["status"] in FINISHED_STATUSES][:excess]:
+            del self.jobs[job_id]
+
+    async def _publish(self, job_id: str, video: VideoRecord, output_dir: str) -> str:
+        """Upload the package next to an S3 source, or serve it from local disk."""
+        if video.source != "s3":
+            return f"/{self.output_root}/{job_id}/master.m3u8"
+
+        prefix = f"{s3_utils.S3_PACKAGED_PREFIX}{job_id}"
+        success, result = await s3_utils.upload_directory_to_s3(output_dir, prefix)
+        if not success:
+            raise RuntimeError(result)
+        await asyncio.to_thread(shutil.rmtree, output_dir, True)
+        return f"{result}/master.m3u8"
@@ -0,0 +1,266 @@
+"""
+Streaming upload ingestion.
+
+Uploads are parsed straight from the request body with python-multipart
+instead of being spooled by Starlette first. Each chunk of the video is
+hashed, counted against MAX_UPLOAD_SIZE_MB and handed to a sink that writes
+it to a hidden file, so the upload is read once, and an oversized one is
+rejected as soon as it crosses the limit. Nothing is published until the
+caller commits the sink, which lets it drop content that is already in the
+catalog instead of storing it again.
+"""
+import os
+import uuid
+import shutil
+import asyncio
+import hashlib
+import logging
+from typing import Callable, List, Optional, Tuple
+
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import Request
+
+import s3_utils
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+MAX_UPLOAD_BYTES = s3_utils.MAX_UPLOAD_SIZE_MB * 1024 * 1024
+# Local sinks hand chunks to the OS in batches of about this size
+WRITE_BATCH_BYTES = 1024 * 1024
+# Form fields other than the file are small; cap them all the same
+MAX_FIELD_BYTES = 1024
+
+class UploadTooLarge(Exception):
+    """The upload is bigger than the configured limit."""
+
+def unique_name(filename: str) -> str:
+    """The file name with a random suffix, for storing it without collisions."""
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}_{uuid.uuid4().hex[:8]}{ext}"
+
+class LocalSink:
+    """
+    Writes an upload to a temporary file next to its final path.
+    """
+
+    def __init__(self, directory: str, filename: str):
+        self.directory = directory
+        self.filename = filename
+        os.makedirs(directory, exist_ok=True)
+        self.tmp_path = os.path.join(directory, f".{uuid.uuid4().hex}.part")
+        self._fd = os.open(self.tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        self._chunks: List[bytes] = []
+        self._buffered = 0
+
+    async def write(self, chunk: bytes):
+        self._chunks.append(chunk)
+        self._buffered += len(chunk)
+        if self._buffered >= WRITE_BATCH_BYTES:
+            await self._flush()
+
+    async def finish(self) -> str:
+        """
+        Write out everything received.
+
+        Returns:
+            The temporary file's path, valid until commit or abort
+        """
+        await self._flush()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        return self.tmp_path
+
+    async def commit(self, directory: Optional[str] = None) -> Tuple[str, str]:
+        """
+        Publish the file under its name, never replacing an existing file.
+
+        Args:
+            directory: Where to publish it, if not the directory it was written to
+
+        Returns:
+            (url, local path)
+        """
+        await self.finish()
+        directory = directory or self.directory
+        source = self.tmp_path
+        if directory != self.directory:
+            # Move the hidden file over first, so the name appears complete
+            os.makedirs(directory, exist_ok=True)
+            source = os.path.join(directory, os.path.basename(self.tmp_path))
+            try:
+                os.link(self.tmp_path, source)
+            except OSError:
+                # On another filesystem
+                await asyncio.to_thread(shutil.copyfile, self.tmp_path, source)
+            os.remove(self.tmp_path)
+            self.tmp_path = source
+        name = self.filename
+        while True:
+            path = os.path.join(directory, name)
+            try:
+                # A hard link fails instead of overwriting, unlike rename
+                os.link(source, path)
+                break
+            except FileExistsError:
+                name = unique_name(self.filename)
+        os.remove(source)
+        return f"/{directory}/{name}", path
+
+    async def abort(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+    async def _flush(self):
+        chunks, self._chunks, self._buffered = self._chunks, [], 0
+        if chunks:
+            await asyncio.to_thread(_write_all, self._fd, chunks)
+
+def _write_all(fd: int, chunks: List[bytes]):
+    # One writev per batch, without joining the chunks first
+    while chunks:
+        written = os.writev(fd, chunks)
+        while chunks and written >= len(chunks[0]):
+            written -= len(chunks[0])
+            chunks.pop(0)
+        if written:
+            chunks[0] = chunks[0][written:]
+
+class IngestedUpload:
+    """
+    A fully received upload whose sink is not committed or aborted yet.
+    """
+    __slots__ = ("filename", "content_type", "size", "content_hash", "sink", "fields")
+
+    def __init__(self, filename: str, content_type: str, size: int, content_hash: str, sink, fields: dict):
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.content_hash = content_hash  # "sha256:<hex>", like media_probe content keys
+        self.sink = sink
+        self.fields = fields  # Other form fields, as strings
+
+async def ingest_upload(
+    request: Request,
+    open_sink: Callable[[str, str], object],
+    file_field: str = "video",
+    max_bytes: int = MAX_UPLOAD_BYTES
+) -> IngestedUpload:
+    """
+    Receive a multipart upload, streaming its file part into a sink.
+
+    Args:
+        request: The multipart/form-data request
+        open_sink: Called with (filename, content type) to create the sink
+        file_field: Name of the form field carrying the file
+        max_bytes: Largest accepted file
+
+    Returns:
+        The upload; the caller must commit or abort its sink
+
+    Raises:
+        UploadTooLarge as soon as the file exceeds max_bytes
+        ValueError for a malformed request or a file type that is not a video
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise ValueError("Expected a multipart/form-data upload")
+    # Reject before reading anything when the client announces the size
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes + 64 * 1024:
+        raise UploadTooLarge(f"Upload exceeds {max_bytes} bytes")
+
+    # python-multipart callbacks are synchronous, so they only queue events
+    # that are handled after each chunk
+    events: List[tuple] = []
+    header = {"name": b"", "value": b""}
+
+    def on_header_field(data, start, end):
+        header["name"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        header["value"] += data[start:end]
+
+    def on_header_end():
+        events.append(("header", header["name"].lower(), header["value"]))
+        header["name"] = header["value"] = b""
+
+    callbacks = {
+        "on_part_begin": lambda: events.append(("begin",)),
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": lambda: events.append(("headers",)),
+        # A view into the received chunk instead of a copy
+        "on_part_data": lambda data, start, end: events.append(("data", memoryview(data)[start:end])),
+        "on_part_end": lambda: events.append(("end",)),
+    }
+    parser = MultipartParser(params[b"boundary"], callbacks)
+
+    fields = {}
+    digest = hashlib.sha256()
+    size = 0
+    sink = None
+    upload = None
+    part_headers = {}
+    part_name = None
+    part_data = bytearray()
+    in_file = False
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for event in events:
+                kind = event[0]
+                if kind == "begin":
+                    part_headers = {}
+                    part_data = bytearray()
+                elif kind == "header":
+                    part_headers[event[1]] = event[2]
+                elif kind == "headers":
+                    _, options = parse_options_header(part_headers.get(b"content-disposition", b""))
+                    part_name = options.get(b"name", b"").decode("utf-8", "replace")
+                    in_file = part_name == file_field and b"filename" in options
+                    if in_file:
+                        if sink is not None:
+                            raise ValueError("Only one file can be uploaded at a time")
+                        filename = os.path.basename(options[b"filename"].decode("utf-8", "replace"))
+                        if not s3_utils.is_valid_video_file(filename):
+                            raise ValueError("Invalid file type. Only video files are allowed.")
+                        file_type = part_headers.get(b"content-type", b"video/mp4").decode("latin-1")
+                        sink = open_sink(filename, file_type)
+                elif kind == "data":
+                    data = event[1]
+                    if in_file:
+                        size += len(data)
+                        if size > max_bytes:
+                            raise UploadTooLarge(f"Upload exceeds {max_bytes} bytes")
+                        digest.update(data)
+                        await sink.write(data)
+                    else:
+                        part_data += data
+                        if len(part_data) > MAX_FIELD_BYTES:
+                            raise ValueError(f"Form field {part_name} is too large")
+                elif kind == "end":
+                    if in_file:
+                        upload = IngestedUpload(filename, file_type, size, f"sha256:{digest.hexdigest()}", sink, fields)
+                    else:
+                        fields[part_name] = part_data.decode("utf-8", "replace")
+                    in_file = False
+            events.clear()
+        parser.finalize()
+    except BaseException:
+        if sink is not None:
+            await sink.abort()
+        raise
+
+    if upload is None:
+        if sink is not None:
+            await sink.abort()
+        raise ValueError(f"No {file_field} file in the upload")
+    return upload
@@ -0,0 +1,152 @@
+"""
+Durable, write-coalescing like counters.
+
+Increments are absorbed in memory and flushed in batches to SQLite in WAL
+mode, so a like storm costs one dictionary update per click and one
+transaction per flush interval. Changed totals are reported at a fixed tick
+so viewers get one coalesced like-delta event instead of one per click.
+The database is shared by every worker on the machine.
+"""
+import os
+import sqlite3
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Optional
+
+from state_backend import STATE_DIR
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Counter settings
+LIKES_DB_PATH = os.getenv("LIKES_DB_PATH", os.path.join(STATE_DIR, "likes.db"))
+LIKE_FLUSH_INTERVAL = float(os.getenv("LIKE_FLUSH_INTERVAL", "0.25"))
+LIKE_BROADCAST_INTERVAL = float(os.getenv("LIKE_BROADCAST_INTERVAL", "1.0"))
+
+# SQLite caps the number of bound parameters per statement
+READBACK_BATCH_SIZE = 500
+
+class LikeCounter:
+    """
+    In-memory like counts backed by batched SQLite writes.
+
+    A key's total is the last value read from the database plus any local
+    increments that have not been flushed yet.
+    """
+
+    def __init__(self, db_path: str = LIKES_DB_PATH):
+        self.db_path = db_path
+        self.persisted: Dict[str, int] = {}
+        self.pending: Dict[str, int] = {}
+        self.inflight: Dict[str, int] = {}
+        self.increments = 0
+        self.flushes = 0
+        self._db: Optional[sqlite3.Connection] = None
+        # SQLite connections stay on the thread that opened them
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="likes-db")
+
+    async def start(self):
+        """Open the database and load every persisted total."""
+        self.persisted = await self._run(self._open)
+        logger.info(f"Loaded like counts for {len(self.persisted)} videos")
+
+    async def close(self):
+        """Flush outstanding increments and close the database."""
+        await self.flush()
+        await self._run(self._db.close)
+        self._executor.shutdown(wait=True)
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        """
+        Record a like without touching the database.
+
+        Returns:
+            The key's new total
+        """
+        self.pending[key] = self.pending.get(key, 0) + amount
+        self.increments += amount
+        return self.get(key)
+
+    def get(self, key: str) -> int:
+        return self.persisted.get(key, 0) + self.inflight.get(key, 0) + self.pending.get(key, 0)
+
+    def observe(self, totals: Dict[str, int]):
+        """Apply totals reported by another worker."""
+        for key, total in totals.items():
+            if total > self.persisted.get(key, 0):
+                self.persisted[key] = total
+
+    async def flush(self) -> Dict[str, int]:
+        """
+        Write pending increments in one transaction.
+
+        Returns:
+            Persisted totals of every key in the batch
+        """
+        if not self.pending:
+            return {}
+        self.inflight, self.pending = self.pending, {}
+        try:
+            totals = await self._run(self._write_batch, self.inflight)
+        except Exception as e:
+            # Keep the increments for the next flush
+            logger.error(f"Error flushing likes: {e}")
+            for key, amount in self.inflight.items():
+                self.pending[key] = self.pending.get(key, 0) + amount
+            self.inflight = {}
+            return {}
+        self.inflight = {}
+        self.persisted.update(totals)
+        self.flushes += 1
+        return totals
+
+    async def run(self, on_deltas: Callable[[Dict[str, int]], Awaitable[None]]):
+        """
+        Flush every LIKE_FLUSH_INTERVAL and report changed totals every
+        LIKE_BROADCAST_INTERVAL until cancelled.
+
+        Only persisted totals are reported, so workers that apply them with
+        observe() never count an unflushed increment twice.
+        """
+        loop = asyncio.get_running_loop()
+        next_broadcast = loop.time() + LIKE_BROADCAST_INTERVAL
+        changed: Dict[str, int] = {}
+        while True:
+            await asyncio.sleep(LIKE_FLUSH_INTERVAL)
+            changed.update(await self.flush())
+            if changed and loop.time() >= next_broadcast:
+                next_broadcast = loop.time() + LIKE_BROADCAST_INTERVAL
+                totals, changed = changed, {}
+                try:
+                    await on_deltas(totals)
+                except Exception as e:
+                    logger.error(f"Error broadcasting like deltas: {e}")
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open(self) -> Dict[str, int]:
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(self.db_path, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS likes (key TEXT PRIMARY KEY, likes INTEGER NOT NULL)")
+        self._db.commit()
+        return dict(self._db.execute("SELECT key, likes FROM likes"))
+
+    def _write_batch(self, batch: Dict[str, int]) -> Dict[str, int]:
+        keys = list(batch)
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO likes (key, likes) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET likes = likes + excluded.likes",
+                batch.items()
+            )
+        # Read back so increments from other workers are reflected too
+        totals = {}
+        for i in range(0, len(keys), READBACK_BATCH_SIZE):
+            chunk = keys[i:i + READBACK_BATCH_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            totals.update(self._db.execute(f"SELECT key, likes FROM likes WHERE key IN ({placeholders})", chunk))
+        return totals
@@ -1,20 +1,40 @@
-from fastapi import FastAPI, File, UploadFile, Form, Request, BackgroundTasks, HTTPException
-from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, Response, PlainTextResponse
 from fastapi.templating import Jinja2Templates
+from pydantic import BaseModel
 import uvicorn
+import msgpack
 import asyncio
 import json
 import os
-import time
-import shutil
-import uuid
-from typing import List, Dict, Set, Optional
-from datetime import datetime
+import hashlib
+import hmac
+import functools
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple
 import logging
 
 # Import S3 utilities
 import s3_utils
+import ingest
+import clock
+import video_files
+import page_cache
+import metrics
+import diagnostics
+import s3_proxy
+import state_backend
+from catalog import Catalog, VideoRecord
+from catalog_sync import CatalogDelta, S3CatalogSync
+from catalog_store import CatalogSnapshot
+from dir_watcher import DirectoryWatcher, FileDelta
+from media_probe import MediaProber
+from hls_packager import HLSPackager
+from thumbnails import THUMBS_ENABLED, Thumbnailer
+from upload_jobs import UploadBusy, UploadJobs
+from broadcast import ENCODERS, BroadcastHub, Subscriber
+from like_counter import LikeCounter
+from channels import CHANNEL_ID_PATTERN, DEFAULT_CHANNEL, Channel, ChannelScheduler
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -22,255 +42,996 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Synchronized Video Streaming")
 
-# Mount static files directory
-app.mount("/static", StaticFiles(directory="static"), name="static")
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
-# Templates (now in browser directory)
+# Templates (now in browser directory), rendered once and served precompressed
 templates = Jinja2Templates(directory="browser")
+pages = page_cache.PageCache(templates.env, "browser")
 
-# In-memory video storage
-videos = []
-current_index = 0
-connected_clients: Set[asyncio.Queue] = set()
+# In-memory video catalog
+catalog = Catalog()
+# One hub per channel with connected clients
+hubs: Dict[str, BroadcastHub] = {}
+backend = state_backend.create_backend()
+s3_sync = S3CatalogSync()
+prober = MediaProber()
+packager = HLSPackager()
+thumbnailer = Thumbnailer(prober.file_key)
+s3_proxy_cache = s3_proxy.S3Proxy()
+like_counter = LikeCounter()
+background_tasks: List[asyncio.Task] = []
+
+# How often non-leader workers retry the schedule leader lock
+LEADER_POLL_INTERVAL = float(os.getenv("LEADER_POLL_INTERVAL", "1.0"))
 
 # Video file extensions to recognize
 VIDEO_EXTENSIONS = (".mp4", ".webm", ".ogg", ".mov", ".avi", ".mkv")
 
-# Initialize with videos from static, uploads, and S3
-def init_videos():
-    global videos
-    videos = []  # Clear existing videos
+# /videos page sizes
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Default durations until ffprobe reads the real ones
+DEFAULT_DURATIONS = {"static": 10, "uploads": 30}
+
+# Local video directories, watched for files added outside /uploads
+watchers = {directory: DirectoryWatcher(directory, VIDEO_EXTENSIONS) for directory in DEFAULT_DURATIONS}
+catalog_snapshot = CatalogSnapshot()
+
+# Received uploads wait here to be stored; uploads bound for S3 are staged on local disk
+upload_jobs = UploadJobs(lambda job, upload: store_upload(job, upload))
+UPLOAD_STAGING_DIR = os.path.join(os.getenv("CACHE_DIR", ".cache"), "incoming")
+
+# Initialize from the catalog snapshot, then apply whatever changed in
+# static, uploads and S3 since it was written (everything on first start)
+def init_videos() -> List[VideoRecord]:
+    """Returns the records that still need probing or thumbnails."""
+    catalog.clear()  # Clear existing videos
     
-    # Scan static directory for videos
-    logger.info("Scanning static directory for videos...")
-    if os.path.exists("static"):
-        for filename in os.listdir("static"):
-            if filename.lower().endswith(VIDEO_EXTENSIONS):
-                videos.append({
-                    "url": f"/static/{filename}",
-                    "duration": 10,  # Default duration for static videos
-                    "likes": 0
-                })
-                logger.info(f"Added static video: {filename}")
+    restored = catalog_snapshot.load()
+    if restored is not None:
+        records, files = restored
+        for video in records:
+            video.likes = like_counter.get(video.url)
+            catalog.add(video)
+        for directory, watcher in watchers.items():
+            watcher.files = dict(files.get(directory, {}))
+        logger.info(f"Loaded {len(catalog)} videos from the catalog snapshot")
     
-    # Scan uploads directory for videos
-    logger.info("Scanning uploads directory for videos...")
-    if os.path.exists("uploads"):
-        for filename in os.listdir("uploads"):
-            if filename.lower().endswith(VIDEO_EXTENSIONS):
-                videos.append({
-                    "url": f"/uploads/{filename}",
-                    "duration": 30,  # Default duration for uploaded videos
-                    "likes": 0
-                })
-                logger.info(f"Added uploaded video: {filename}")
+    # Only stat calls: files whose size and mtime match the snapshot are kept as they are
+    fresh = []
+    for directory, watcher in watchers.items():
+        for entry in file_delta_entries(directory, watcher.scan()):
+            if catalog.by_url(entry.url) is None:
+                catalog.add(entry)
+                logger.info(f"Added {directory} video: {entry.url}")
+            fresh.append(entry)
     
-    # Get videos from S3
-    logger.info("Fetching videos from S3...")
-    try:
-        s3_videos = s3_utils.list_videos_from_s3()
-        for video in s3_videos:
-            videos.append({
-                "url": video["url"],
-                "duration": 30,  # Default duration for S3 videos
-                "likes": 0
-            })
+    # Reconcile S3 videos with the cached manifest; the background sync applies later changes
+    manifest = s3_sync.load()
+    listed = set()
+    for video in manifest:
+        listed.add(video["url"])
+        entry = catalog.by_url(video["url"])
+        if entry is None:
+            fresh.append(catalog.add(s3_video_entry(video)))
             logger.info(f"Added S3 video: {video['key']}")
-    except Exception as e:
-        logger.error(f"Error fetching S3 videos: {e}")
+        elif entry.etag != video["etag"]:
+            catalog.update(entry, etag=video["etag"], content_hash=None)
+            fresh.append(entry)
+    for video in list(catalog):
+        if video.source == "s3" and video.url not in listed:
+            catalog.remove(video.url)
+    
+    # Attach HLS renditions packaged in earlier runs
+    packager.prune(catalog.by_url)
+    for video in catalog:
+        if video.url in packager.published and video.hls_url != packager.published[video.url]:
+            catalog.update(video, hls_url=packager.published[video.url])
     
     # If no videos found, add placeholder message
-    if not videos:
+    if not len(catalog):
         logger.warning("No videos found in static, uploads, or S3!")
         
-    logger.info(f"Initialized with {len(videos)} videos")
+    logger.info(f"Initialized with {len(catalog)} videos")
+    
+    # Videos from the snapshot that were never fully prepared get another try
+    pending = {id(video) for video in fresh}
+    fresh += [
+        video for video in catalog
+        if id(video) not in pending and (
+            video.width is None
+            or (THUMBS_ENABLED and video.poster_url is None)
+            or (video.content_hash is None and video.source != "s3")
+        )
+    ]
+    return fresh
+
+# Catalog records for files a directory watcher reported. Removed files leave
+# the catalog straight away; the returned records are new or changed files,
+# which callers probe before (re)adding them.
+def file_delta_entries(directory: str, delta: FileDelta) -> List[VideoRecord]:
+    for name in delta.removed:
+        if catalog.remove(f"/{directory}/{name}") is not None:
+            logger.info(f"Removed {directory} video: {name}")
+    entries = []
+    for name in delta.added + delta.changed:
+        url = f"/{directory}/{name}"
+        entry = catalog.by_url(url)
+        if entry is None:
+            entry = VideoRecord(url, DEFAULT_DURATIONS[directory], like_counter.get(url))
+        elif name in delta.changed:
+            # New content: probing hashes it again
+            catalog.update(entry, content_hash=None)
+        entries.append(entry)
+    return entries
+
+# Apply a watcher's changes to the live rotation
+async def apply_file_delta(directory: str, delta: FileDelta):
+    fresh = file_delta_entries(directory, delta)
+    await prepare_videos(fresh)
+    for entry in fresh:
+        if catalog.by_url(entry.url) is None:
+            catalog.add(entry)
+            logger.info(f"Added {directory} video: {entry.url}")
+    if fresh or delta.removed:
+        logger.info(f"Catalog updated from {directory}, now {len(catalog)} videos")
+
+# Catalog state written to the snapshot
+def catalog_snapshot_state():
+    files = {directory: dict(watcher.files) for directory, watcher in watchers.items()}
+    return catalog.version, list(catalog), files
+
+# Catalog record for an object listed from S3
+def s3_video_entry(video: dict) -> VideoRecord:
+    # Default duration for S3 videos
+    return VideoRecord(video["url"], 30, like_counter.get(video["url"]), video["etag"])
+
+# Where ffprobe can read a video, and its ETag if it lives in S3
+def video_source(video: VideoRecord) -> Tuple[str, Optional[str]]:
+    if video.source != "s3":
+        return video.url.lstrip("/"), None
+    return video.url, video.etag
+
+# Content hash of a video, for deduplicating uploads. Local files were just
+# hashed by the prober; S3 objects carry the hash they were uploaded with.
+async def video_content_hash(video: VideoRecord) -> Optional[str]:
+    source, etag = video_source(video)
+    try:
+        if etag is None:
+            return await prober.file_key(source)
+        if video.content_hash is not None:
+            return video.content_hash  # Set at upload, and an object never changes in place
+        return await s3_utils.run_in_s3_executor(s3_utils.get_object_content_hash, s3_utils.key_for_url(video.url))
+    except Exception as e:
+        logger.error(f"Cannot hash {video.url}: {e}")
+        return None
+
+# Replace default durations with probed metadata, in parallel and off the event loop
+async def probe_videos(entries: List[VideoRecord], local_copies: Optional[Dict[str, str]] = None):
+    sources = [video_source(video) for video in entries]
+    if local_copies:
+        # Read S3 videos from a local copy, still keyed by their ETag
+        sources = [(local_copies.get(video.url, source), etag) for video, (source, etag) in zip(entries, sources)]
+    results = await prober.probe_many(sources)
+    hashes = await asyncio.gather(*(video_content_hash(video) for video in entries))
+    probed = 0
+    for video, result, content_hash in zip(entries, results, hashes):
+        fields = dict(result or {})
+        if content_hash is not None and content_hash != video.content_hash:
+            fields["content_hash"] = content_hash
+        if fields:
+            catalog.update(video, **fields)
+        if result:
+            probed += 1
+    logger.info(f"Probed {probed}/{len(entries)} videos")
+
+# Render posters and sprite sheets, using probed durations where known
+async def thumbnail_videos(entries: List[VideoRecord], local_copies: Optional[Dict[str, str]] = None):
+    results = await thumbnailer.render_many(
+        [video_source(video) + (video.duration, video.width, video.height) for video in entries],
+        local_copies
+    )
+    rendered = 0
+    for video, result in zip(entries, results):
+        if result:
+            catalog.update(video, **result)
+            rendered += 1
+    logger.info(f"Rendered thumbnails for {rendered}/{len(entries)} videos")
+
+# Probe newly loaded videos, then render their thumbnails. `local_copies`
+# maps S3 video URLs to local copies of their bytes, read instead of S3.
+async def prepare_videos(entries: List[VideoRecord], local_copies: Optional[Dict[str, str]] = None):
+    await probe_videos(entries, local_copies)
+    await thumbnail_videos(entries, local_copies)
+
+# Publish a finished HLS package into the catalog
+async def publish_hls(video: VideoRecord, manifest_url: str):
+    catalog.update(video, hls_url=manifest_url)
+
+# Hot-swap S3 changes into the rotation
+async def apply_s3_delta(delta: CatalogDelta):
+    # Probe new and changed objects before they go into rotation
+    fresh = []
+    for video in delta.changed + delta.added:
+        entry = catalog.by_url(video["url"])
+        if entry is not None:
+            # Known already, e.g. an upload of this worker: its hash is still good
+            if entry.etag != video["etag"]:
+                catalog.update(entry, etag=video["etag"], content_hash=None)
+        else:
+            entry = s3_video_entry(video)
+        fresh.append(entry)
+    await probe_videos(fresh)
     
-    # Log all videos for debugging
-    for i, video in enumerate(videos):
-        logger.info(f"Video {i+1}: {video['url']}")
+    for video in delta.removed:
+        catalog.remove(video["url"])
+    for entry in fresh:
+        if catalog.by_url(entry.url) is None:
+            catalog.add(entry)
+    logger.info(f"Catalog updated from S3, now {len(catalog)} videos")
+    await thumbnail_videos(fresh)
+
+# Video files, with range and validator support; disk I/O runs in threads
+@app.api_route("/static/{path:path}", methods=["GET", "HEAD"])
+async def get_static_file(path: str, request: Request):
+    return await video_files.serve_file(request, "static", path)
+
+@app.api_route("/uploads/{path:path}", methods=["GET", "HEAD"])
+async def get_uploaded_file(path: str, request: Request):
+    return await video_files.serve_file(request, "uploads", path)
+
+@app.api_route("/packaged/{path:path}", methods=["GET", "HEAD"])
+async def get_packaged_file(path: str, request: Request):
+    return await video_files.serve_file(request, packager.output_root, path)
+
+# S3 videos and their HLS packages through the local cache (S3_PROXY_MODE).
+# Only catalog videos and packaged renditions are served, not the whole bucket.
+@app.api_route("/s3/{key:path}", methods=["GET", "HEAD"])
+async def get_s3_object(key: str, request: Request):
+    if not s3_proxy.S3_PROXY_MODE:
+        raise HTTPException(status_code=404, detail="Not Found")
+    video = catalog.by_url(s3_utils.get_object_url(key))
+    if video is None and not key.startswith(s3_utils.S3_PACKAGED_PREFIX):
+        raise HTTPException(status_code=404, detail="Not Found")
+    etag = video.etag if video is not None else None
+    # Served from disk, or from the shared copy in progress if not cached yet
+    response = await s3_proxy_cache.respond(request, key, etag)
+    if response is None:
+        raise HTTPException(status_code=502, detail="Could not fetch the video from S3")
+    return response
+
+# Posters and sprite sheets; evicted ones are rendered again on request
+@app.api_route("/thumbs/{name}", methods=["GET", "HEAD"])
+async def get_thumbnail(name: str, request: Request):
+    if await thumbnailer.path_for(name) is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return await video_files.serve_file(request, thumbnailer.root, name)
 
 # Main page
-@app.get("/", response_class=HTMLResponse)
+@app.api_route("/", methods=["GET", "HEAD"], response_class=HTMLResponse)
 async def get_index(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    return await pages.response(request, "index.html")
 
 # Ambient TV version
-@app.get("/ambient", response_class=HTMLResponse)
+@app.api_route("/ambient", methods=["GET", "HEAD"], response_class=HTMLResponse)
 async def get_ambient(request: Request):
-    return templates.TemplateResponse("ambient.html", {"request": request})
+    # Revalidated on every load, so the preload hint follows the current video
+    headers = {"cache-control": "no-cache", **preload_headers(DEFAULT_CHANNEL)}
+    return await pages.response(request, "ambient.html", headers=headers)
 
 # Upload page
-@app.get("/upload", response_class=HTMLResponse)
+@app.api_route("/upload", methods=["GET", "HEAD"], response_class=HTMLResponse)
 async def get_upload_page(request: Request):
-    return templates.TemplateResponse("upload.html", {"request": request})
+    return await pages.response(request, "upload.html", {"max_upload_mb": s3_utils.MAX_UPLOAD_SIZE_MB})
 
-# SSE endpoint for video updates
-@app.get("/video-updates")
-async def video_updates(request: Request):
+# Catalog entry as clients see it, with proxied URLs for S3 videos
+def client_video_dict(video: VideoRecord) -> dict:
+    data = video.to_dict()
+    data["url"] = s3_proxy.client_url(video.url)
+    if video.hls_url is not None:
+        data["hls_url"] = s3_proxy.client_url(video.hls_url)
+    return data
+
+# Build the broadcast payload for a video
+# Timestamps are server epoch milliseconds; clients map them to their own
+# clock with the offset measured through /time
+def video_event(
+    channel_id: str,
+    video: VideoRecord,
+    index: int,
+    total: int,
+    start_ms: int,
+    upcoming: List[dict] = ()
+) -> str:
+    server_time_ms = clock.now_ms()
+    return json.dumps({
+        "channel": channel_id,
+        "id": video.id,
+        "video_url": s3_proxy.client_url(video.url),
+        "hls_url": s3_proxy.client_url(video.hls_url),
+        "start_time": start_ms // 1000,
+        "start_time_ms": start_ms,
+        "server_time_ms": server_time_ms,
+        "position_ms": max(0, server_time_ms - start_ms),
+        "duration": video.duration,
+        "likes": like_counter.get(video.url),
+        "index": index,
+        "total": total,
+        "upcoming": list(upcoming)
+    })
+
+# Announce a scheduled video so clients can prefetch it before it starts
+def upcoming_entry(video: VideoRecord, index: int, start_ms: int) -> dict:
+    return {
+        "id": video.id,
+        "video_url": s3_proxy.client_url(video.url),
+        "hls_url": s3_proxy.client_url(video.hls_url),
+        "start_time_ms": start_ms,
+        "duration": video.duration,
+        "index": index
+    }
+
+# Link header hinting the browser to preload a channel's next video
+@lru_cache(maxsize=64)
+def preload_link(message: str) -> Optional[str]:
+    upcoming = json.loads(message).get("upcoming")
+    if not upcoming:
+        return None
+    return f"<{upcoming[0]['video_url']}>; rel=preload; as=video"
+
+def preload_headers(channel_id: str) -> Dict[str, str]:
+    message = backend.current.get(channel_id)
+    link = preload_link(message) if message else None
+    return {"Link": link} if link else {}
+
+# Refresh the clock fields of a stored event for a client joining mid-video
+def restamp_event(message: str) -> str:
+    data = json.loads(message)
+    if "start_time_ms" in data:
+        data["server_time_ms"] = clock.now_ms()
+        data["position_ms"] = max(0, data["server_time_ms"] - data["start_time_ms"])
+    return json.dumps(data)
+
+# Subscribe a client to a channel's broadcast hub, creating the hub on demand
+def join_channel(channel_id: str, codec: str) -> Tuple[BroadcastHub, Subscriber]:
+    hub = hubs.get(channel_id)
+    if hub is None:
+        hub = hubs[channel_id] = BroadcastHub()
+    subscriber = hub.subscribe(codec)
+    # Per-client logging is debug-only; /metrics tracks connections
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Client connected to {channel_id}. Channel clients: {len(hub)}")
+    
+    # Send the leader's current broadcast immediately upon connection,
+    # with the position the client should seek to
+    if channel_id in backend.current:
+        subscriber.push(ENCODERS[codec](restamp_event(backend.current[channel_id])))
+    return hub, subscriber
+
+# Unsubscribe a client, dropping the hub once its channel has no clients
+def leave_channel(channel_id: str, hub: BroadcastHub, subscriber: Subscriber):
+    hub.unsubscribe(subscriber)
+    if not hub.subscribers and hubs.get(channel_id) is hub:
+        del hubs[channel_id]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Client disconnected from {channel_id}. Channel clients: {len(hub)}")
+
+# SSE stream of a channel's video updates
+def channel_stream(channel_id: str) -> StreamingResponse:
     async def event_generator():
-        # Create a queue for this client
-        queue = asyncio.Queue()
-        connected_clients.add(queue)
-        logger.info(f"Client connected. Total clients: {len(connected_clients)}")
-        
+        hub, subscriber = join_channel(channel_id, "sse")
         try:
-            # Send current video immediately upon connection
-            if videos:
-                current_video = videos[current_index]
-                await queue.put(json.dumps({
-                    "video_url": current_video["url"],
-                    "start_time": int(time.time()),
-                    "duration": current_video["duration"],
-                    "likes": current_video["likes"],
-                    "index": current_index,
-                    "total": len(videos)
-                }))
-            
-            # Keep connection open and wait for updates
+            # Keep connection open and wait for updates. Disconnects cancel
+            # this generator, and a None frame means the hub evicted us.
             while True:
-                if await request.is_disconnected():
+                frame = await subscriber.get()
+                if frame is None:
                     break
-                
-                # Wait for the next update
-                data = await queue.get()
-                yield f"data: {data}\n\n"
+                yield frame
                 
         except asyncio.CancelledError:
-            logger.info("Connection closed by client")
+            pass  # Connection closed by client
         finally:
-            connected_clients.remove(queue)
-            logger.info(f"Client disconnected. Remaining clients: {len(connected_clients)}")
+            leave_channel(channel_id, hub, subscriber)
     
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    # Hint the next video at connect time; later ones arrive in each event
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers=preload_headers(channel_id)
+    )
+
+# WebSocket session on a channel. The server sends the same broadcasts as
+# the SSE stream, msgpack-encoded as {"type": "video" | "likes", "data": ...}.
+# Clients may send msgpack messages in-band:
+#   {"type": "like", "id": video_id}  -> {"type": "liked", "id", "likes"}
+#   {"type": "ping", "t0": client_ms} -> {"type": "pong", "t0", "t1", "t2"}
+async def channel_socket(websocket: WebSocket, channel_id: str):
+    await websocket.accept()
+    hub, subscriber = join_channel(channel_id, "msgpack")
+    
+    # Only this task writes to the socket; replies go through the buffer too
+    async def send_frames():
+        while True:
+            frame = await subscriber.get()
+            if frame is None:
+                break
+            await websocket.send_bytes(frame)
+        await websocket.close()
+    
+    sender = asyncio.create_task(send_frames())
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            t1 = clock.now_ms()
+            try:
+                request = msgpack.unpackb(message.get("bytes") or b"")
+                kind = request["type"]
+            except (ValueError, TypeError, KeyError, msgpack.UnpackException):
+                continue
+            # A newer pong supersedes an older one; a "liked" only one for the same video
+            if kind == "ping":
+                reply = {"type": "pong", "t0": request.get("t0"), "t1": t1, "t2": clock.now_ms()}
+                reply_kind = "pong"
+            elif kind == "like":
+                reply = {"type": "liked", "id": request.get("id"), "likes": like(request.get("id"))}
+                reply_kind = f"liked:{reply['id']}"
+            else:
+                continue
+            subscriber.push(msgpack.packb(reply), kind=reply_kind)
+    except (WebSocketDisconnect, RuntimeError):
+        pass  # Closed by the client, or by send_frames after an eviction
+    finally:
+        sender.cancel()
+        leave_channel(channel_id, hub, subscriber)
+
+# SSE endpoint for video updates on the main channel
+@app.get("/video-updates")
+async def video_updates():
+    return channel_stream(DEFAULT_CHANNEL)
+
+# SSE endpoint for video updates on any channel
+@app.get("/channels/{channel_id}/video-updates")
+async def channel_video_updates(channel_id: str):
+    if channel_id not in scheduler.channels:
+        raise HTTPException(status_code=404, detail="Unknown channel")
+    return channel_stream(channel_id)
+
+# WebSocket endpoint for video updates on the main channel
+@app.websocket("/ws")
+async def video_updates_socket(websocket: WebSocket):
+    await channel_socket(websocket, DEFAULT_CHANNEL)
+
+# WebSocket endpoint for video updates on any channel
+@app.websocket("/channels/{channel_id}/ws")
+async def channel_video_updates_socket(websocket: WebSocket, channel_id: str):
+    if channel_id not in scheduler.channels:
+        await websocket.close(code=4404)
+        return
+    await channel_socket(websocket, channel_id)
+
+# What a channel is playing and what comes next, as of the last switch
+def channel_schedule(channel_id: str) -> JSONResponse:
+    message = backend.current.get(channel_id)
+    now_playing = json.loads(restamp_event(message)) if message else None
+    upcoming = now_playing.pop("upcoming", []) if now_playing else []
+    return JSONResponse(
+        {
+            "channel": channel_id,
+            "server_time_ms": clock.now_ms(),
+            "now_playing": now_playing,
+            "upcoming": upcoming
+        },
+        headers={"Cache-Control": "no-cache", **preload_headers(channel_id)}
+    )
+
+# Schedule of the main channel
+@app.get("/schedule")
+async def get_schedule():
+    return channel_schedule(DEFAULT_CHANNEL)
+
+# Schedule of any channel
+@app.get("/channels/{channel_id}/schedule")
+async def get_channel_schedule(channel_id: str):
+    if channel_id not in scheduler.channels:
+        raise HTTPException(status_code=404, detail="Unknown channel")
+    return channel_schedule(channel_id)
+
+# Channel definitions
+class ChannelDefinition(BaseModel):
+    videos: List[str]
+
+# List channels
+@app.get("/channels")
+async def list_channels():
+    return {"channels": [
+        {
+            "id": channel.id,
+            "videos": len(channel.urls) if channel.urls is not None else len(catalog),
+            "position": channel.position,
+            "clients": len(hubs[channel.id]) if channel.id in hubs else 0
+        }
+        for channel in scheduler.channels.values()
+    ]}
+
+# Create or replace a channel's playlist
+@app.put("/channels/{channel_id}")
+async def put_channel(channel_id: str, definition: ChannelDefinition):
+    if not CHANNEL_ID_PATTERN.match(channel_id) or channel_id == DEFAULT_CHANNEL:
+        raise HTTPException(status_code=400, detail="Invalid channel ID")
+    await backend.save_channel(channel_id, definition.videos)
+    scheduler.set_channel(channel_id, definition.videos)
+    await backend.publish(state_backend.CONTROL_CHANNEL, json.dumps({"changed": channel_id}))
+    return {"success": True, "channel": channel_id, "videos": len(definition.videos)}
+
+# Delete a channel
+@app.delete("/channels/{channel_id}")
+async def delete_channel(channel_id: str):
+    if channel_id == DEFAULT_CHANNEL or channel_id not in scheduler.channels:
+        raise HTTPException(status_code=404, detail="Unknown channel")
+    await backend.delete_channel(channel_id)
+    scheduler.remove_channel(channel_id)
+    await backend.publish(state_backend.CONTROL_CHANNEL, json.dumps({"changed": channel_id}))
+    return {"success": True}
+
+# Broadcast hub statistics
+@app.get("/broadcast/stats")
+async def get_broadcast_stats():
+    return {
+        "channels": len(scheduler),
+        "hubs": {channel_id: hub.stats() for channel_id, hub in hubs.items()}
+    }
+
+# NTP-style clock sync. The client sends its clock as t0 and records the
+# receive time t3; offset = ((t1 - t0) + (t2 - t3)) / 2, rtt = (t3 - t0) - (t2 - t1)
+@app.get("/time")
+async def get_time(t0: Optional[float] = None):
+    t1 = clock.now_ms()
+    return JSONResponse(
+        {"t0": t0, "t1": t1, "t2": clock.now_ms()},
+        headers={"Cache-Control": "no-store"}
+    )
 
-# Background task to iterate through videos
-async def video_iterator():
-    global current_index
+# Prometheus metrics
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+# Sample connection gauges at scrape time instead of on every connect
+def collect_connection_metrics():
+    subscribers = [subscriber for hub in hubs.values() for subscriber in hub.subscribers]
+    websockets = sum(1 for subscriber in subscribers if subscriber.codec == "msgpack")
+    metrics.SSE_CLIENTS.set(len(subscribers) - websockets)
+    metrics.WEBSOCKET_CLIENTS.set(websockets)
+    metrics.ACTIVE_HUBS.set(len(hubs))
+    metrics.SCHEDULER_CHANNELS.set(len(scheduler))
+    metrics.sample_queue_depths(len(subscriber) for subscriber in subscribers)
+
+metrics.REGISTRY.add_collector(collect_connection_metrics)
+
+# Admin diagnostics (see diagnostics.py). Every endpoint needs
+# `Authorization: Bearer $ADMIN_TOKEN`, and none exist without a token.
+profiler = diagnostics.SamplingProfiler()
+memory_tracer = diagnostics.MemoryTracer()
+slow_callbacks = diagnostics.SlowCallbackTracker()
+
+def check_admin(request: Request):
+    if not diagnostics.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), diagnostics.ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Admin token required", headers={"WWW-Authenticate": "Bearer"})
+
+# Wall-clock sampling profile of every thread, taken off the event loop.
+# format=collapsed for flamegraph.pl/inferno/speedscope, or speedscope JSON.
+@app.get("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10.0, interval_ms: float = 5.0, format: str = "collapsed", idle: bool = False):
+    check_admin(request)
+    if format not in ("collapsed", "speedscope"):
+        raise HTTPException(status_code=400, detail="format must be collapsed or speedscope")
+    try:
+        profile = await asyncio.to_thread(profiler.run, seconds, interval_ms / 1000, idle)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    logger.info(f"Took a {profile.seconds:.1f}s profile ({profile.count} samples)")
+    if format == "speedscope":
+        return JSONResponse(
+            profile.speedscope(),
+            headers={"Content-Disposition": 'attachment; filename="profile.speedscope.json"'}
+        )
+    return PlainTextResponse(profile.collapsed())
+
+# Start tracing allocations; the first snapshot is the baseline for diffs
+@app.post("/admin/tracemalloc")
+async def admin_tracemalloc_start(request: Request, frames: int = 16):
+    check_admin(request)
+    await asyncio.to_thread(memory_tracer.start, frames)
+    return {"tracing": True, "frames": frames}
+
+# Allocation changes since the previous snapshot (format=json or collapsed)
+@app.get("/admin/tracemalloc")
+async def admin_tracemalloc_diff(request: Request, group_by: str = "lineno", limit: int = 25, format: str = "json"):
+    check_admin(request)
+    if not memory_tracer.tracing:
+        raise HTTPException(status_code=409, detail="Not tracing; POST /admin/tracemalloc first")
+    if group_by not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail="group_by must be lineno, filename or traceback")
+    if format == "collapsed":
+        return PlainTextResponse(await asyncio.to_thread(memory_tracer.collapsed))
+    return await asyncio.to_thread(memory_tracer.diff, group_by, limit)
+
+@app.delete("/admin/tracemalloc")
+async def admin_tracemalloc_stop(request: Request):
+    check_admin(request)
+    memory_tracer.stop()
+    return {"tracing": False}
+
+# Record event loop callbacks slower than threshold_ms
+@app.post("/admin/slow-callbacks")
+async def admin_slow_callbacks_start(request: Request, threshold_ms: float = 50.0):
+    check_admin(request)
+    slow_callbacks.enable(threshold_ms / 1000)
+    return slow_callbacks.report()
+
+@app.get("/admin/slow-callbacks")
+async def admin_slow_callbacks(request: Request):
+    check_admin(request)
+    return slow_callbacks.report()
+
+@app.delete("/admin/slow-callbacks")
+async def admin_slow_callbacks_stop(request: Request):
+    check_admin(request)
+    slow_callbacks.disable()
+    return slow_callbacks.report()
+
+# Stacks of every asyncio task and thread (format=text or json)
+@app.get("/admin/tasks")
+async def admin_tasks(request: Request, format: str = "text"):
+    check_admin(request)
+    tasks, threads = diagnostics.dump_tasks(), diagnostics.dump_threads()
+    if format == "json":
+        return {"tasks": tasks, "threads": threads}
+    return PlainTextResponse(diagnostics.format_dump(tasks, threads))
+
+# Called by the scheduler at every switch (runs on the schedule leader only)
+async def broadcast_switch(channel: Channel, video: VideoRecord, index: int, total: int):
+    # Publish through the state backend; every worker relays it to its clients
+    start_ms = clock.loop_time_to_ms(channel.started_at)
+    upcoming = [
+        upcoming_entry(next_video, next_index, clock.loop_time_to_ms(start))
+        for next_video, next_index, _, start in scheduler.upcoming(channel)
+    ]
+    await backend.publish(channel.id, video_event(channel.id, video, index, total, start_ms, upcoming))
     
-    while True:
-        if not videos:
-            await asyncio.sleep(1)
+    if channel.id == DEFAULT_CHANNEL:
+        logger.info(f"Broadcasting video {index+1}/{total}: {video.url}")
+
+scheduler = ChannelScheduler(lambda: catalog, catalog.by_url, broadcast_switch)
+catalog.listeners.append(scheduler.catalog_changed)
+
+# Sync the scheduler with the shared channel definitions
+async def load_channels():
+    definitions = await backend.load_channels()
+    if DEFAULT_CHANNEL not in scheduler.channels:
+        scheduler.set_channel(DEFAULT_CHANNEL)
+    for channel_id in list(scheduler.channels):
+        if channel_id != DEFAULT_CHANNEL and channel_id not in definitions:
+            scheduler.remove_channel(channel_id)
+    # Only touch channels whose playlist changed, so the others keep their announced look-ahead
+    for channel_id, urls in definitions.items():
+        channel = scheduler.channels.get(channel_id)
+        if channel is None or channel.urls != urls:
+            scheduler.set_channel(channel_id, urls)
+
+# Relay broadcasts from the state backend to this worker's SSE clients
+async def relay_broadcasts():
+    async for channel_id, message in backend.listen():
+        if channel_id == state_backend.CONTROL_CHANNEL:
+            await load_channels()
+            continue
+        if channel_id == state_backend.LIKES_CHANNEL:
+            relay_like_deltas(json.loads(message)["likes"])
             continue
-            
-        current_video = videos[current_index]
-        duration = current_video["duration"]
-        
-        # Broadcast current video to all clients
-        message = json.dumps({
-            "video_url": current_video["url"],
-            "start_time": int(time.time()),
-            "duration": duration,
-            "likes": current_video["likes"],
-            "index": current_index,
-            "total": len(videos)
-        })
-        
-        for client_queue in connected_clients:
-            await client_queue.put(message)
         
-        logger.info(f"Broadcasting video {current_index+1}/{len(videos)}: {current_video['url']}")
+        hub = hubs.get(channel_id)
+        if hub is not None:
+            hub.publish(message)
         
-        # Wait for the duration of the video
-        await asyncio.sleep(duration)
+        # Followers track positions so they can take over as leader
+        channel = scheduler.channels.get(channel_id)
+        if channel is not None and not scheduler.running:
+            channel.position = json.loads(message)["index"]
         
-        # Move to next video
-        current_index = (current_index + 1) % len(videos)
-
-# Upload endpoint for S3
-@app.post("/uploads")
-async def upload_video_to_s3(
-    video: UploadFile = File(...),
-    duration: int = Form(30)
-):
-    # Validate file type
-    if not s3_utils.is_valid_video_file(video.filename):
-        raise HTTPException(status_code=400, detail="Invalid file type. Only video files are allowed.")
+        if s3_proxy.S3_PROXY_MODE and hub is not None:
+            warm_s3_proxy(json.loads(message))
+
+# Copy the next S3 videos into the proxy cache before viewers ask for them
+def warm_s3_proxy(event: dict):
+    objects = []
+    for item in event.get("upcoming", [])[:s3_proxy.S3_PROXY_WARM_AHEAD]:
+        video = catalog.get(item["id"])
+        if video is not None and video.source == "s3":
+            objects.append((s3_utils.key_for_url(video.url), video.etag))
+    s3_proxy_cache.warm(objects)
+
+# Share coalesced like totals with every worker (called once per broadcast tick)
+async def publish_like_deltas(totals: Dict[str, int]):
+    await backend.publish(state_backend.LIKES_CHANNEL, json.dumps({"likes": totals}))
+
+# Push like totals to every connected client as a named `likes` SSE event,
+# which clients that only listen for video switches ignore
+def relay_like_deltas(totals: Dict[str, int]):
+    like_counter.observe(totals)
+    by_id = {}
+    for url in totals:
+        video = catalog.by_url(url)
+        if video is not None:
+            catalog.update(video, likes=like_counter.get(url))
+            by_id[video.id] = video.likes
     
-    # Generate a unique filename to avoid collisions
-    original_filename = video.filename
-    filename_parts = os.path.splitext(original_filename)
-    unique_filename = f"{filename_parts[0]}_{uuid.uuid4().hex[:8]}{filename_parts[1]}"
+    data = json.dumps({"likes": by_id})
+    for hub in hubs.values():
+        hub.publish(data, event="likes")
+
+# Run every channel's schedule once this worker holds the leader lock
+async def lead_schedule():
+    while not await backend.try_acquire_leadership():
+        await asyncio.sleep(LEADER_POLL_INTERVAL)
     
-    # Upload to S3
-    try:
-        success, result = s3_utils.upload_file_to_s3(
-            video.file, 
-            unique_filename, 
-            video.content_type or "video/mp4"
-        )
-        
-        if success:
-            # Add to video list
-            videos.append({
-                "url": result,  # result contains the URL
-                "duration": duration,
-                "likes": 0
-            })
-            
-            logger.info(f"Video uploaded to S3: {unique_filename}")
-            return {"success": True, "message": "Video uploaded successfully", "url": result}
+    # Resume each channel after the last video the previous leader broadcast
+    for channel in scheduler.channels.values():
+        if channel.id not in backend.current:
+            continue
+        # Events carry client URLs, so resolve the video by ID
+        video = catalog.get(json.loads(backend.current[channel.id])["id"])
+        if channel.urls is not None:
+            if video is not None and video.url in channel.urls:
+                channel.position = channel.urls.index(video.url)
         else:
-            # If S3 upload failed but we have credentials, try local upload as fallback
-            if not all([s3_utils.AWS_ACCESS_KEY_ID, s3_utils.AWS_SECRET_ACCESS_KEY, s3_utils.S3_BUCKET_NAME]):
-                logger.warning("S3 credentials not configured, falling back to local upload")
-                return await upload_video_local(video, duration)
-            else:
-                # S3 error with credentials configured
-                logger.error(f"S3 upload failed: {result}")
-                raise HTTPException(status_code=500, detail=f"S3 upload failed: {result}")
+            channel.position = catalog.position(video) if video is not None else -1
+        channel.upcoming.clear()
     
-    except Exception as e:
-        logger.error(f"Error uploading to S3: {str(e)}")
-        # Try local upload as fallback
-        return await upload_video_local(video, duration)
+    await scheduler.run()
 
-# Fallback local upload
-async def upload_video_local(video: UploadFile, duration: int):
-    """Fallback to local upload if S3 fails or is not configured."""
+# Upload endpoint. Only the body is received here, into a staging file;
+# storing it and adding it to the catalog is queued as an upload job, and the
+# response carries the job to follow (see upload_jobs.py).
+@app.post("/uploads", status_code=202)
+async def upload_video(request: Request):
+    use_s3 = all([s3_utils.AWS_ACCESS_KEY_ID, s3_utils.AWS_SECRET_ACCESS_KEY, s3_utils.S3_BUCKET_NAME])
     try:
-        # Ensure uploads directory exists
-        os.makedirs("uploads", exist_ok=True)
-        
-        # Save the uploaded file locally
-        file_path = os.path.join("uploads", video.filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-        
-        # Add to video list
-        videos.append({
-            "url": f"/uploads/{video.filename}",
-            "duration": duration,
-            "likes": 0
-        })
-        
-        logger.info(f"Video uploaded locally: {video.filename}")
-        return {"success": True, "message": "Video uploaded locally", "url": f"/uploads/{video.filename}"}
+        job = upload_jobs.admit("s3" if use_s3 else "local")
+    except UploadBusy as e:
+        # Turned away before the body is read
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
     
+    # Local uploads are staged next to their final name, S3 ones in the cache directory
+    staging_dir = UPLOAD_STAGING_DIR if use_s3 else "uploads"
+    try:
+        upload = await ingest.ingest_upload(request, lambda filename, content_type: ingest.LocalSink(staging_dir, filename))
+    except ingest.UploadTooLarge as e:
+        upload_jobs.release(job, "failed", error=str(e))
+        metrics.UPLOAD_FAILURES.inc()
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        upload_jobs.release(job, "failed", error=str(e))
+        metrics.UPLOAD_FAILURES.inc()
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"Local upload failed: {str(e)}")
+        upload_jobs.release(job, "failed", error=str(e))
+        logger.error(f"Upload failed: {str(e)}")
+        metrics.UPLOAD_FAILURES.inc()
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
+    
+    # Identical content is already in the rotation, or on its way there: keep that copy
+    existing = catalog.by_hash(upload.content_hash)
+    pending_job = upload_jobs.pending.get(upload.content_hash)
+    if existing is not None or pending_job is not None:
+        await upload.sink.abort()
+        if existing is not None:
+            result = {"video_id": existing.id, "url": existing.url, "poster_url": existing.poster_url}
+            upload_jobs.release(job, "ready", duplicate=True, filename=upload.filename, size=upload.size, **result)
+            logger.info(f"Upload {upload.filename} duplicates {existing.url}")
+            return JSONResponse({"success": True, "message": "Video already uploaded", "duplicate": True, "job_id": job["id"], "id": existing.id, "url": existing.url, "poster_url": existing.poster_url})
+        upload_jobs.release(job, "ready", duplicate=True, duplicate_of=pending_job, filename=upload.filename, size=upload.size)
+        logger.info(f"Upload {upload.filename} duplicates upload job {pending_job}")
+        job = upload_jobs.get(pending_job)
+        return JSONResponse({"success": True, "message": "Video already being uploaded", "duplicate": True, **upload_job_links(pending_job), "status": job["status"]})
+    
+    upload_jobs.submit(job, upload)
+    return {"success": True, "message": "Upload received", "duplicate": False, **upload_job_links(job["id"]), "status": job["status"]}
+
+# Where clients follow an upload job
+def upload_job_links(job_id: str) -> dict:
+    return {
+        "job_id": job_id,
+        "status_url": f"/upload/jobs/{job_id}",
+        "events_url": f"/upload/jobs/{job_id}/events",
+    }
+
+# Store a received upload and add it to the rotation (runs in an upload job worker)
+async def store_upload(job: dict, upload: ingest.IngestedUpload) -> dict:
+    etag = None
+    local_copies = {}
+    if job["target"] == "s3":
+        key = ingest.unique_name(upload.filename)
+        path = await upload.sink.finish()
+        transfer = functools.partial(s3_utils.upload_path_to_s3, content_hash=upload.content_hash)
+        success, result = await upload_jobs.transfer(job, transfer, path, key, upload.content_type)
+        if success:
+            url = source = result  # Packaging reads S3 videos by URL
+            etag = await s3_utils.run_in_s3_executor(s3_utils.get_object_etag, key)
+            # Probe and thumbnail from the staging copy instead of downloading it again
+            local_copies[url] = path
+        else:
+            # The file is already on disk, so keep it locally instead
+            logger.warning(f"S3 upload of {upload.filename} failed, storing it locally: {result}")
+            upload_jobs.update(job, target="local", s3_error=result)
+    if job["target"] == "local":
+        url, source = await upload.sink.commit("uploads")
+        # The hash was computed while receiving, so the file is never read for it again
+        prober.remember_file(source, upload.content_hash)
+        # Known to the watcher, which would otherwise report it as a new file
+        watchers["uploads"].check([os.path.basename(source)])
+    
+    # Add to video list, with its real duration when ffprobe can read it
+    try:
+        duration = int(upload.fields.get("duration", 30))  # Only used if ffprobe cannot read the upload
+    except ValueError:
+        duration = 30
+    entry = VideoRecord(url, duration, like_counter.get(url), etag=etag)
+    entry.content_hash = upload.content_hash
+    upload_jobs.update(job, status="processing", bytes_stored=upload.size)
+    try:
+        await prepare_videos([entry], local_copies)
+    except Exception:
+        if job["target"] == "local":
+            # Roll back, so the watcher doesn't count a file the catalog lacks as known
+            try:
+                os.remove(source)
+            except FileNotFoundError:
+                pass
+            watchers["uploads"].check([os.path.basename(source)])
+        raise
+    finally:
+        if local_copies:
+            await upload.sink.abort()  # The staging copy is no longer needed
+    catalog.add(entry)
+    packaging_job = packager.submit(entry, source, publish_hls)
+    
+    logger.info(f"Video uploaded ({job['target']}): {url}")
+    return {"video_id": entry.id, "url": url, "poster_url": entry.poster_url, "packaging_job": packaging_job}
+
+# Upload job status, for polling
+@app.get("/upload/jobs/{job_id}")
+async def get_upload_job(job_id: str):
+    job = upload_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown upload job")
+    return job
+
+# SSE stream of an upload job's progress, ending when the job finishes
+@app.get("/upload/jobs/{job_id}/events")
+async def upload_job_events(job_id: str):
+    if upload_jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Unknown upload job")
+    
+    async def event_generator():
+        async for job in upload_jobs.watch(job_id):
+            if job is None:
+                yield b": keepalive\n\n"
+            else:
+                yield f"data: {json.dumps(job)}\n\n".encode()
+    
+    return StreamingResponse(event_generator(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# Packaging job status
+@app.get("/packaging/jobs/{job_id}")
+async def get_packaging_job(job_id: str):
+    if job_id not in packager.jobs:
+        raise HTTPException(status_code=404, detail="Unknown packaging job")
+    return packager.jobs[job_id]
 
 # Like endpoint
-@app.post("/like/{index}")
-async def like_video(index: int):
-    if 0 <= index < len(videos):
-        videos[index]["likes"] += 1
-        likes = videos[index]["likes"]
-        logger.info(f"Video {index+1} liked. Total likes: {likes}")
+@app.post("/like/{video_id}")
+async def like_video(video_id: str):
+    likes = like(video_id)
+    if likes is not None:
         return {"success": True, "likes": likes}
-    return {"success": False, "message": "Invalid video index"}
+    return {"success": False, "message": "Unknown video"}
+
+# Count a like, returning the new total or None for an unknown video. Likes
+# are counted in memory, then flushed to SQLite and broadcast in batches,
+# which is also when the catalog record picks up the new total.
+def like(video_id: str) -> Optional[int]:
+    video = catalog.get(video_id) if isinstance(video_id, str) else None
+    if video is None:
+        return None
+    return like_counter.incr(video.url)
 
-# Get list of all videos
+# Serialized /videos pages keyed by catalog version, position on air and query
+videos_page_cache: Dict[tuple, Tuple[str, bytes]] = {}
+VIDEOS_PAGE_CACHE_SIZE = 256
+
+# Get a page of the catalog. Responses carry a content ETag, so polling
+# clients that send If-None-Match get a 304 until something changes.
 @app.get("/videos")
-async def get_videos():
-    return {"videos": videos, "current_index": current_index}
+async def get_videos(
+    request: Request,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    source: Optional[str] = None,
+    sort: str = "catalog"
+):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    position = max(scheduler.channels[DEFAULT_CHANNEL].position, 0)
+    key = (catalog.version, position, limit, cursor, source, sort)
+    cached = videos_page_cache.get(key)
+    if cached is None:
+        try:
+            page, next_cursor = catalog.page(limit, cursor, source, sort)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        body = json.dumps({
+            "videos": [client_video_dict(video) for video in page],
+            "next_cursor": next_cursor,
+            "total": len(catalog),
+            "current_index": position,
+            "current_id": catalog[position].id if position < len(catalog) else None
+        }).encode("utf-8")
+        # Content-based, so every worker produces the same tag for the same page
+        etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+        if len(videos_page_cache) >= VIDEOS_PAGE_CACHE_SIZE:
+            videos_page_cache.clear()
+        cached = videos_page_cache[key] = (etag, body)
+    
+    etag, body = cached
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 # Startup event
 @app.on_event("startup")
 async def startup_event():
-    init_videos()
-    asyncio.create_task(video_iterator())
+    await like_counter.start()
+    fresh = init_videos()
+    await backend.start()
+    await load_channels()
+    packager.start()
+    upload_jobs.start()
+    background_tasks.append(asyncio.create_task(relay_broadcasts()))
+    background_tasks.append(asyncio.create_task(lead_schedule()))
+    background_tasks.append(asyncio.create_task(prepare_videos(fresh)))
+    for directory, watcher in watchers.items():
+        background_tasks.append(asyncio.create_task(
+            watcher.run(lambda delta, directory=directory: apply_file_delta(directory, delta))
+        ))
+    background_tasks.append(asyncio.create_task(catalog_snapshot.run(catalog_snapshot_state)))
+    background_tasks.append(asyncio.create_task(s3_sync.run(apply_s3_delta)))
+    background_tasks.append(asyncio.create_task(like_counter.run(publish_like_deltas)))
+    background_tasks.append(asyncio.create_task(metrics.monitor_loop_lag()))
+
+# Shutdown event
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in background_tasks:
+        task.cancel()
+    await upload_jobs.close()
+    await packager.close()
+    await catalog_snapshot.save(*catalog_snapshot_state())
+    await like_counter.close()
+    await backend.close()
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
+    # Multiple workers need a shared backend, e.g. STATE_BACKEND=file
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    # WebSocket clients that offer permessage-deflate get compressed frames
+    ws_per_message_deflate = os.getenv("WS_PER_MESSAGE_DEFLATE", "true").lower() == "true"
+    uvicorn.run(
+        "main:app", host="0.0.0.0", port=8000, reload=workers == 1, workers=workers,
+        ws_per_message_deflate=ws_per_message_deflate
+    )
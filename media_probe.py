@@ -0,0 +1,247 @@
+"""
+Media probing with ffprobe and a persistent content-keyed cache.
+
+Results are cached by content hash for local files and by ETag for S3
+objects, so a file is never probed twice, even across restarts. ffprobe runs
+as a bounded pool of subprocesses and hashing runs in worker threads, so
+large catalogs are probed in parallel without blocking the event loop.
+"""
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Probe settings
+FFPROBE_BIN = os.getenv("FFPROBE_BIN", "ffprobe")
+PROBE_CONCURRENCY = int(os.getenv("PROBE_CONCURRENCY", str(os.cpu_count() or 4)))
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", "30"))
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+PROBE_CACHE_PATH = os.path.join(CACHE_DIR, "probe_cache.json")
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_file(path: str) -> str:
+    """
+    Return the SHA-256 content key of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+def parse_ffprobe_output(output: bytes) -> Optional[dict]:
+    """
+    Extract duration, resolution, codecs and bitrate from ffprobe JSON.
+    """
+    data = json.loads(output or b"{}")
+    fmt = data.get("format", {})
+    video_stream = next(
+        (stream for stream in data.get("streams", []) if stream.get("codec_type") == "video"),
+        {}
+    )
+    audio_stream = next(
+        (stream for stream in data.get("streams", []) if stream.get("codec_type") == "audio"),
+        {}
+    )
+
+    duration = fmt.get("duration") or video_stream.get("duration")
+    if duration is None:
+        return None
+
+    bitrate = fmt.get("bit_rate") or video_stream.get("bit_rate")
+    return {
+        "duration": round(float(duration), 3),
+        "width": video_stream.get("width"),
+        "height": video_stream.get("height"),
+        "codec": video_stream.get("codec_name"),
+        "audio_codec": audio_stream.get("codec_name"),
+        "bitrate": int(bitrate) if bitrate else None,
+        "format": fmt.get("format_name"),
+    }
+
+class MediaProber:
+    """
+    Probes media sources and remembers the results by content key.
+    """
+
+    def __init__(self, cache_path: str = PROBE_CACHE_PATH, concurrency: int = PROBE_CONCURRENCY):
+        self.cache_path = cache_path
+        self.concurrency = concurrency
+        # content key -> probe result
+        self.media: Dict[str, dict] = {}
+        # local path -> {"size", "mtime_ns", "key"}, so unchanged files are not rehashed
+        self.files: Dict[str, dict] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._dirty = False
+        self._ffprobe_missing = False
+        self.load()
+
+    def load(self):
+        """Load cached probe results from disk."""
+        try:
+            with open(self.cache_path) as f:
+                data = json.load(f)
+            self.media = data.get("media", {})
+            self.files = data.get("files", {})
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError as e:
+            logger.error(f"Ignoring corrupt probe cache {self.cache_path}: {e}")
+
+    def write(self, data: str):
+        """Atomically replace the probe cache file (runs in a worker thread)."""
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.cache_path)
+
+    async def save(self):
+        """Write the probe cache to disk if it changed."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        # Serialize on the loop so probes finishing meanwhile can't change the dicts mid-dump
+        data = json.dumps({"media": dict(self.media), "files": dict(self.files)}, separators=(",", ":"))
+        try:
+            await asyncio.to_thread(self.write, data)
+        except OSError as e:
+            self._dirty = True
+            logger.error(f"Saving the probe cache failed: {e}")
+
+    async def file_key(self, path: str) -> str:
+        """
+        Return the content key of a local file, hashing only if it changed.
+        """
+        st = os.stat(path)
+        cached = self.files.get(path)
+        if cached and cached["size"] == st.st_size and cached["mtime_ns"] == st.st_mtime_ns:
+            return cached["key"]
+
+        key = await asyncio.to_thread(hash_file, path)
+        self.files[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "key": key}
+        self._dirty = True
+        return key
+
+    def remember_file(self, path: str, key: str):
+        """
+        Record the content key of a file whose hash is already known, e.g. from ingest.
+        """
+        st = os.stat(path)
+        self.files[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "key": key}
+        self._dirty = True
+
+    async def probe(self, source: str, key: str) -> Optional[dict]:
+        """
+        Probe a file path or URL, reusing any cached result for its content key.
+
+        Args:
+            source: Local path or URL that ffprobe can read
+            key: Content hash or ETag identifying the bytes at `source`
+
+        Returns:
+            Media metadata, or None if the source could not be probed
+        """
+        if key in self.media:
+            return self.media[key]
+
+        # Concurrent requests for the same content share one ffprobe run
+        if key in self._inflight:
+            return await self._inflight[key]
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._run_ffprobe(source)
+            if result is not None:
+                self.media[key] = result
+                self._dirty = True
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved when no one else is waiting
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def probe_file(self, path: str) -> Optional[dict]:
+        """Probe a local file by content hash."""
+        try:
+            key = await self.file_key(path)
+        except OSError as e:
+            logger.error(f"Cannot probe {path}: {e}")
+            return None
+        return await self.probe(path, key)
+
+    async def probe_many(self, sources: Iterable[Tuple[str, Optional[str]]]) -> List[Optional[dict]]:
+        """
+        Probe many sources in parallel and persist the cache afterwards.
+
+        Args:
+            sources: (path_or_url, etag) pairs; local files pass None as etag
+
+        Returns:
+            Results in the same order as `sources`
+        """
+        async def probe_one(source: str, etag: Optional[str]):
+            if etag is None:
+                return await self.probe_file(source)
+            return await self.probe(source, f"etag:{etag}")
+
+        results = await asyncio.gather(
+            *(probe_one(source, etag) for source, etag in sources),
+            return_exceptions=True
+        )
+        await self.save()
+        return [None if isinstance(result, BaseException) else result for result in results]
+
+    async def _run_ffprobe(self, source: str) -> Optional[dict]:
+        if self._ffprobe_missing:
+            return None
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        async with self._semaphore:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    FFPROBE_BIN, "-v", "error", "-print_format", "json",
+                    "-show_format", "-show_streams", source,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+            except FileNotFoundError:
+                logger.error(f"{FFPROBE_BIN} not found in PATH, media probing disabled")
+                self._ffprobe_missing = True
+                return None
+
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), PROBE_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                logger.error(f"ffprobe timed out on {source}")
+                return None
+
+        if process.returncode != 0:
+            logger.error(f"ffprobe failed on {source}: {stderr.decode(errors='replace').strip()}")
+            return None
+
+        try:
+            return parse_ffprobe_output(stdout)
+        except (ValueError, TypeError) as e:
+            logger.error(f"Unreadable ffprobe output for {source}: {e}")
+            return None
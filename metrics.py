@@ -0,0 +1,274 @@
+"""
+Minimal Prometheus-compatible metrics.
+
+Metrics are module-level objects created once at import. Recording a value
+is a lock-protected update of a pre-allocated counter, with no allocation
+or string formatting; everything is rendered to the text exposition format
+only when /metrics is scraped. Values that are cheap to read but expensive
+to track continuously (connected clients, queue depths) are collected by
+callbacks at scrape time instead.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# How often the event-loop lag probe runs
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Default latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class Counter:
+    """Monotonic counter."""
+    __slots__ = ("value", "_lock")
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        yield f"{name}{labels} {_format_value(self.value)}"
+
+class Gauge(Counter):
+    """Value that can go up and down."""
+    __slots__ = ()
+    kind = "gauge"
+
+    def set(self, value: float):
+        self.value = value
+
+class Histogram:
+    """Cumulative histogram with fixed upper bounds."""
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+    kind = "histogram"
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        inner = labels[1:-1] + "," if labels else ""
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{inner}le="{_format_value(float(bound))}"}} {cumulative}'
+        yield f"{name}_sum{labels} {_format_value(self.sum)}"
+        yield f"{name}_count{labels} {self.count}"
+
+class Family:
+    """
+    A named metric, optionally split by labels.
+
+    Children are created on first use of a label combination and reused
+    afterwards, so hot paths should look them up once and keep them.
+    """
+
+    def __init__(self, name: str, help: str, factory: Callable, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.factory = factory
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], object] = {}
+        self.kind = factory().kind
+        if not self.labelnames:
+            self.children[()] = factory()
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, self.factory())
+        return child
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, child in list(self.children.items()):
+            yield from child.samples(self.name, _format_labels(self.labelnames, values))
+
+    # Unlabelled families proxy to their single child
+    def inc(self, amount: float = 1.0):
+        self.children[()].inc(amount)
+
+    def set(self, value: float):
+        self.children[()].set(value)
+
+    def observe(self, value: float):
+        self.children[()].observe(value)
+
+class Registry:
+    def __init__(self):
+        self.families: List[Family] = []
+        self.collectors: List[Callable[[], None]] = []
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Family:
+        return self._register(Family(name, help, Counter, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Family:
+        return self._register(Family(name, help, Gauge, labelnames))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS, labelnames: Sequence[str] = ()) -> Family:
+        return self._register(Family(name, help, lambda: Histogram(buckets), labelnames))
+
+    def add_collector(self, collector: Callable[[], None]):
+        """Register a callback that refreshes gauges right before each scrape."""
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+        lines = []
+        for family in self.families:
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, family: Family) -> Family:
+        self.families.append(family)
+        return family
+
+REGISTRY = Registry()
+
+# Broadcast
+SSE_CLIENTS = REGISTRY.gauge("channels_sse_clients", "Connected SSE clients")
+WEBSOCKET_CLIENTS = REGISTRY.gauge("channels_websocket_clients", "Connected WebSocket clients")
+ACTIVE_HUBS = REGISTRY.gauge("channels_active_hubs", "Channels with at least one connected client")
+# Queue depths are sampled at scrape time, bucketed like a histogram
+QUEUE_DEPTH_BOUNDS = (0, 1, 2, 4, 8, 16, 32, 64)
+SUBSCRIBERS_BY_QUEUE_DEPTH = REGISTRY.gauge(
+    "channels_subscribers_by_queue_depth", "Clients with at most `le` frames waiting in their buffer",
+    labelnames=("le",)
+)
+SUBSCRIBER_QUEUE_DEPTH_MAX = REGISTRY.gauge("channels_subscriber_queue_depth_max", "Deepest client buffer")
+QUEUED_FRAMES = REGISTRY.gauge("channels_queued_frames", "Frames waiting in all client buffers")
+BROADCASTS = REGISTRY.counter("channels_broadcasts_total", "Frames fanned out by broadcast hubs")
+FANOUT_SECONDS = REGISTRY.histogram("channels_broadcast_fanout_seconds", "Time to queue one frame for every subscriber of a hub")
+SUBSCRIBER_DROPS = REGISTRY.counter("channels_subscriber_drops_total", "Deliveries to slow clients that were skipped or evicted")
+SUBSCRIBER_EVICTIONS = REGISTRY.counter("channels_subscriber_evictions_total", "Slow clients disconnected by the evict policy")
+
+# Scheduling
+SCHEDULER_DRIFT_SECONDS = REGISTRY.histogram(
+    "channels_scheduler_drift_seconds", "Delay between a switch's planned and actual time",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+)
+SCHEDULER_CHANNELS = REGISTRY.gauge("channels_scheduled_channels", "Channels known to the scheduler")
+LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "channels_event_loop_lag_seconds", "How late the event loop ran a timer",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+LOOP_LAG_LAST = REGISTRY.gauge("channels_event_loop_lag_last_seconds", "Most recent event loop lag sample")
+
+# Uploads
+UPLOAD_BYTES = REGISTRY.histogram(
+    "channels_upload_size_bytes", "Size of accepted uploads",
+    buckets=(1 << 20, 4 << 20, 16 << 20, 64 << 20, 256 << 20, 1 << 30, 4 << 30),
+    labelnames=("target",)
+)
+UPLOAD_SECONDS = REGISTRY.histogram(
+    "channels_upload_duration_seconds", "Time to store an upload",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0),
+    labelnames=("target",)
+)
+UPLOAD_FAILURES = REGISTRY.counter("channels_upload_failures_total", "Uploads that could not be stored")
+UPLOAD_REJECTIONS = REGISTRY.counter("channels_upload_rejections_total", "Uploads turned away because every upload slot was taken")
+UPLOAD_QUEUE_DEPTH = REGISTRY.gauge("channels_upload_queue_depth", "Received uploads waiting for a job worker")
+
+# S3
+S3_REQUEST_SECONDS = REGISTRY.histogram(
+    "channels_s3_request_seconds", "Latency of S3 API calls", labelnames=("operation",)
+)
+S3_REQUEST_ERRORS = REGISTRY.counter("channels_s3_request_errors_total", "S3 API calls that failed", labelnames=("operation",))
+S3_PROXY_REQUESTS = REGISTRY.counter(
+    "channels_s3_proxy_requests_total", "Proxied S3 object requests by cache result", labelnames=("result",)
+)
+S3_PROXY_FILL_SECONDS = REGISTRY.histogram(
+    "channels_s3_proxy_fill_seconds", "Time to copy an object from S3 into the proxy cache",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+)
+S3_PROXY_CACHE_BYTES = REGISTRY.gauge("channels_s3_proxy_cache_bytes", "Size of the S3 proxy cache after the last fill")
+
+def sample_queue_depths(depths: Iterable[int]):
+    """Refresh the queue depth gauges from the current client buffer sizes."""
+    counts = [0] * (len(QUEUE_DEPTH_BOUNDS) + 1)
+    deepest = total = 0
+    for depth in depths:
+        counts[bisect_left(QUEUE_DEPTH_BOUNDS, depth)] += 1
+        total += depth
+        if depth > deepest:
+            deepest = depth
+    cumulative = 0
+    for bound, count in zip(QUEUE_DEPTH_BOUNDS + (float("inf"),), counts):
+        cumulative += count
+        SUBSCRIBERS_BY_QUEUE_DEPTH.labels(_format_value(float(bound))).set(cumulative)
+    SUBSCRIBER_QUEUE_DEPTH_MAX.set(deepest)
+    QUEUED_FRAMES.set(total)
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """Measure how late a periodic timer fires until cancelled."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - expected)
+        LOOP_LAG_SECONDS.observe(lag)
+        LOOP_LAG_LAST.set(lag)
+
+def instrument_s3_client(client):
+    """Time every API call a boto3 client makes, including managed transfers."""
+    def before_call(model, context, **kwargs):
+        context["metrics_operation"] = model.name
+        context["metrics_started"] = time.perf_counter()
+
+    def after_call(http_response, model, context, **kwargs):
+        started = context.get("metrics_started")
+        if started is not None:
+            S3_REQUEST_SECONDS.labels(model.name).observe(time.perf_counter() - started)
+        if http_response.status_code >= 300:
+            S3_REQUEST_ERRORS.labels(model.name).inc()
+
+    def after_call_error(context, **kwargs):
+        # Network failures never produce a response
+        S3_REQUEST_ERRORS.labels(context.get("metrics_operation", "unknown")).inc()
+
+    events = client.meta.events
+    events.register("before-call.s3", before_call)
+    events.register("after-call.s3", after_call)
+    events.register("after-call-error.s3", after_call_error)
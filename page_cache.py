@@ -0,0 +1,227 @@
+"""
+Pre-rendered, precompressed page responses.
+
+The HTML pages carry no per-request data, so each template is rendered once
+and kept as identity, gzip and (when the optional `brotli` package is
+installed) brotli bodies, each with its own strong ETag. A request gets the
+smallest variant its Accept-Encoding allows, with `Vary: Accept-Encoding`,
+or a 304 when its If-None-Match names that variant. Pages are cached by
+browsers for PAGE_CACHE_MAX_AGE seconds and revalidated by ETag after
+that; a route can override the Cache-Control header, as /ambient does to
+keep its per-request preload hint fresh. Each template file is re-checked at most every
+PAGE_CHECK_INTERVAL seconds and the page rendered again (in a thread) when
+it changes, so edits go live without a restart.
+
+Small text files served from disk, like HLS playlists, are negotiated the
+same way (see video_files.serve_file).
+"""
+import os
+import gzip
+import asyncio
+import time
+import hashlib
+import logging
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response
+from jinja2 import Environment
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only gzip is offered
+    brotli = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Page settings
+PAGE_CACHE_MAX_AGE = int(os.getenv("PAGE_CACHE_MAX_AGE", "3600"))
+PAGE_CHECK_INTERVAL = float(os.getenv("PAGE_CHECK_INTERVAL", "1.0"))
+
+# Bodies smaller than this aren't worth compressing
+MIN_COMPRESS_BYTES = 256
+# Moderate levels: nearly the ratio of the maximum ones at a fraction of the CPU
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+COMPRESSIBLE_TYPES = (
+    "application/json", "application/javascript", "application/vnd.apple.mpegurl",
+    "application/x-mpegurl", "image/svg+xml",
+)
+
+def compressible(content_type: str) -> bool:
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+def parse_accept_encoding(header: Optional[str]) -> Dict[str, float]:
+    """Map each coding in an Accept-Encoding header to its q-value."""
+    accepted = {}
+    for item in (header or "").split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding.lower()] = q
+    return accepted
+
+class CompressedBody:
+    """
+    One response body in every encoding worth sending. Compressing is CPU
+    work; build these in a worker thread.
+    """
+    __slots__ = ("variants",)
+
+    def __init__(self, body: bytes, tag: Optional[str] = None):
+        """
+        Args:
+            body: The uncompressed body
+            tag: Opaque ETag value for the identity body (without quotes);
+                defaults to a hash of the body. Compressed variants append
+                their encoding to it.
+        """
+        tag = tag or hashlib.blake2b(body, digest_size=12).hexdigest()
+        # encoding -> (body, etag)
+        self.variants: Dict[str, Tuple[bytes, str]] = {"identity": (body, f'"{tag}"')}
+        if len(body) < MIN_COMPRESS_BYTES:
+            return
+        # mtime=0 so every worker produces the same bytes
+        candidates = {"gzip": gzip.compress(body, GZIP_LEVEL, mtime=0)}
+        if brotli is not None:
+            candidates["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+        for encoding, data in candidates.items():
+            if len(data) < len(body):
+                self.variants[encoding] = (data, f'"{tag}-{encoding}"')
+
+    def select(self, accept_encoding: Optional[str]) -> Tuple[str, bytes, str]:
+        """
+        Pick the smallest variant the client accepts.
+
+        Returns:
+            (encoding, body, etag); the identity body when nothing else is
+            acceptable
+        """
+        accepted = parse_accept_encoding(accept_encoding)
+        best = "identity"
+        for encoding, (data, _) in self.variants.items():
+            if accepted.get(encoding, accepted.get("*", 0.0)) > 0 and len(data) < len(self.variants[best][0]):
+                best = encoding
+        return (best, *self.variants[best])
+
+def respond(request: Request, body: CompressedBody, media_type: str, headers: Dict[str, str]) -> Response:
+    """
+    Send the variant of a body negotiated for a request, or a 304.
+
+    Args:
+        headers: Extra response headers, e.g. Cache-Control
+    """
+    encoding, data, etag = body.select(request.headers.get("accept-encoding"))
+    headers = {**headers, "etag": etag}
+    if len(body.variants) > 1:
+        headers["vary"] = "Accept-Encoding"
+    if encoding != "identity":
+        headers["content-encoding"] = encoding
+        headers.pop("accept-ranges", None)  # Ranges are only served uncompressed
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        if "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags):
+            return Response(status_code=304, headers=headers)
+    if request.method == "HEAD":
+        headers["content-length"] = str(len(data))
+        return Response(media_type=media_type, headers=headers)
+    return Response(content=data, media_type=media_type, headers=headers)
+
+class Page:
+    __slots__ = ("signature", "context", "body", "checked_at")
+
+    def __init__(self, signature: Tuple[int, int, int], context: dict, body: CompressedBody):
+        self.signature = signature
+        self.context = context
+        self.body = body
+        self.checked_at = time.monotonic()
+
+class PageCache:
+    """
+    Rendered templates, re-rendered when their file changes.
+    """
+
+    def __init__(
+        self,
+        env: Environment,
+        directory: str,
+        max_age: int = PAGE_CACHE_MAX_AGE,
+        check_interval: float = PAGE_CHECK_INTERVAL
+    ):
+        """
+        Args:
+            env: Jinja environment that loads templates from `directory`
+            directory: Template directory, for checking files for changes
+            max_age: Seconds browsers may use a page before revalidating it
+            check_interval: Seconds between checks of a template file
+        """
+        self.env = env
+        self.directory = directory
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self._pages: Dict[str, Page] = {}
+
+    async def get(self, name: str, context: dict) -> CompressedBody:
+        """The rendered page, rendering it if it is new or its template changed."""
+        page = self._pages.get(name)
+        now = time.monotonic()
+        if page is not None and page.context == context and now - page.checked_at < self.check_interval:
+            return page.body
+
+        st = await asyncio.to_thread(os.stat, os.path.join(self.directory, name))
+        signature = (st.st_size, st.st_mtime_ns, st.st_ino)
+        if page is not None and page.context == context and page.signature == signature:
+            page.checked_at = now
+            return page.body
+
+        try:
+            body = await asyncio.to_thread(self._render, name, context)
+        except Exception as e:
+            if page is None:
+                raise
+            # Keep serving the last good render until the template is fixed
+            logger.error(f"Re-rendering {name} failed, serving the previous version: {e}")
+            page.signature = signature
+            page.checked_at = now
+            return page.body
+
+        if self._pages.get(name) is not page:
+            return self._pages[name].body  # Rendered by a concurrent request meanwhile
+        self._pages[name] = Page(signature, context, body)
+        sizes = ", ".join(f"{encoding} {len(data)}" for encoding, (data, _) in body.variants.items())
+        logger.info(f"Rendered {name} ({sizes} bytes)")
+        return body
+
+    def _render(self, name: str, context: dict) -> CompressedBody:
+        return CompressedBody(self.env.get_template(name).render(context).encode("utf-8"))
+
+    async def response(
+        self,
+        request: Request,
+        name: str,
+        context: Optional[dict] = None,
+        headers: Optional[Dict[str, str]] = None
+    ) -> Response:
+        """
+        Serve a page.
+
+        Args:
+            context: Template variables; the same for every request
+            headers: Extra response headers, overriding the default
+                Cache-Control if they set one
+        """
+        body = await self.get(name, context or {})
+        headers = {"cache-control": f"public, max-age={self.max_age}", **(headers or {})}
+        return respond(request, body, "text/html", headers)
@@ -0,0 +1,242 @@
+"""
+Weighted random playlist ordering.
+
+A Playlist holds one integer weight per item in a Fenwick (binary indexed)
+tree, so adding, removing and reweighting an item and drawing the next one
+are all O(log n): a draw picks a random number below the total weight and
+walks the tree down to the item whose cumulative weight range contains it.
+Removed items leave a zero-weight slot that the next added item reuses.
+
+On top of the weights, a playlist applies:
+
+- a recency boost: items added as new are weighted `boost` times higher
+  for `boost_seconds`
+- a no-repeat window: the last `no_repeat` drawn items can't be drawn
+  again (the window shrinks to half the playlist, so small playlists still
+  shuffle)
+
+Draws come from the playlist's own random.Random, so a seeded playlist
+fed the same changes produces the same order.
+"""
+import time
+import random
+from collections import deque
+from typing import Callable, Deque, Dict, Generic, Hashable, Iterable, List, Optional, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+
+class FenwickTree:
+    """
+    Prefix sums over a growable list of integers.
+    """
+
+    def __init__(self, values: Iterable[int] = ()):
+        # 1-based: tree[i] holds the sum of values (i - lowbit(i), i]
+        self.tree = [0]
+        self.tree.extend(values)
+        n = len(self.tree) - 1
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                self.tree[parent] += self.tree[i]
+        self.total = self.prefix(n)
+
+    def __len__(self) -> int:
+        return len(self.tree) - 1
+
+    def append(self, value: int):
+        """Add a value at the end."""
+        n = len(self.tree)
+        # The new node covers (n - lowbit(n), n]: earlier values plus this one
+        self.tree.append(value + self.prefix(n - 1) - self.prefix(n - (n & -n)))
+        self.total += value
+
+    def add(self, index: int, delta: int):
+        """Add `delta` to the value at 0-based `index`."""
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+        self.total += delta
+
+    def prefix(self, count: int) -> int:
+        """Sum of the first `count` values."""
+        total = 0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+    def find(self, target: int) -> int:
+        """
+        The 0-based index whose cumulative range contains `target`, i.e. the
+        first index where the prefix sum exceeds it.
+
+        Args:
+            target: 0 <= target < total
+        """
+        index = 0
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            node = index + step
+            if node < len(self.tree) and self.tree[node] <= target:
+                index = node
+                target -= self.tree[node]
+            step >>= 1
+        return index
+
+class Playlist(Generic[K]):
+    """
+    Items with weights, drawn at random in proportion to them.
+    """
+
+    def __init__(
+        self,
+        items: Iterable[Tuple[K, int]] = (),
+        no_repeat: int = 0,
+        boost: float = 1.0,
+        boost_seconds: float = 0.0,
+        rng: Optional[random.Random] = None,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        """
+        Args:
+            items: Initial (item, weight) pairs; items are hashable keys
+            no_repeat: How many of the last drawn items can't be drawn again
+            boost: Weight multiplier for new items
+            boost_seconds: How long new items keep their boost
+            rng: Source of randomness; seed it for a reproducible order
+            clock: Returns the current time in seconds
+        """
+        self.no_repeat = no_repeat
+        self.boost = boost
+        self.boost_seconds = boost_seconds
+        self.rng = rng or random.Random()
+        self.clock = clock
+        self._keys: List[Optional[K]] = []
+        self._weights: List[int] = []  # Weight of each item as given
+        self._slots: Dict[K, int] = {}
+        self._free: List[int] = []
+        for key, weight in items:
+            self._slots[key] = len(self._keys)
+            self._keys.append(key)
+            self._weights.append(weight)
+        self._tree = FenwickTree(self._weights)
+        self._boosted: Dict[K, float] = {}  # Item -> boost expiry
+        self._boosts: Deque[Tuple[float, K]] = deque()  # (expiry, item) in expiry order
+        self._held: Dict[K, int] = {}  # Item -> draw number, while in the no-repeat window
+        self._recent: Deque[Tuple[K, int]] = deque()
+        self._draws = 0
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._slots
+
+    @property
+    def total(self) -> int:
+        """Total weight of the items that can be drawn now."""
+        return self._tree.total
+
+    def add(self, key: K, weight: int, new: bool = False):
+        """
+        Add an item, or reweight it if it is already in the playlist.
+
+        Args:
+            new: Give the item the recency boost
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+                self._keys[slot] = key
+                self._weights[slot] = 0
+            else:
+                slot = len(self._keys)
+                self._keys.append(key)
+                self._weights.append(0)
+                self._tree.append(0)
+            self._slots[key] = slot
+        before = self._effective(slot, key)
+        if new and self.boost != 1.0 and self.boost_seconds > 0:
+            expiry = self.clock() + self.boost_seconds
+            self._boosted[key] = expiry
+            self._boosts.append((expiry, key))
+        self._weights[slot] = weight
+        self._tree.add(slot, self._effective(slot, key) - before)
+
+    def remove(self, key: K):
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            return
+        self._tree.add(slot, -self._effective(slot, key))
+        self._keys[slot] = None
+        self._weights[slot] = 0
+        self._free.append(slot)
+        self._boosted.pop(key, None)
+        self._held.pop(key, None)
+
+    def set_weight(self, key: K, weight: int):
+        """Change an item's weight; unknown items are ignored."""
+        slot = self._slots.get(key)
+        if slot is None:
+            return
+        before = self._effective(slot, key)
+        self._weights[slot] = weight
+        self._tree.add(slot, self._effective(slot, key) - before)
+
+    def weight(self, key: K) -> Optional[int]:
+        """An item's weight as given, or None if it is not in the playlist."""
+        slot = self._slots.get(key)
+        return None if slot is None else self._weights[slot]
+
+    def draw(self) -> Optional[K]:
+        """
+        Pick the next item at random in proportion to its weight.
+
+        Returns:
+            The item, or None if no item has any weight
+        """
+        self._expire_boosts()
+        window = min(self.no_repeat, len(self._slots) // 2)
+        while len(self._recent) > window or (self._tree.total <= 0 and self._recent):
+            self._release(*self._recent.popleft())
+        if self._tree.total <= 0:
+            return None
+
+        slot = self._tree.find(self.rng.randrange(self._tree.total))
+        key = self._keys[slot]
+        if window > 0:
+            self._draws += 1
+            self._tree.add(slot, -self._effective(slot, key))
+            self._held[key] = self._draws
+            self._recent.append((key, self._draws))
+        return key
+
+    def _effective(self, slot: int, key: K) -> int:
+        """The weight an item is drawn with now."""
+        if key in self._held:
+            return 0
+        if key in self._boosted:
+            return round(self._weights[slot] * self.boost)
+        return self._weights[slot]
+
+    def _release(self, key: K, draw: int):
+        """Let an item leave the no-repeat window."""
+        if self._held.get(key) != draw:
+            return  # Removed, or drawn again after being re-added
+        del self._held[key]
+        slot = self._slots[key]
+        self._tree.add(slot, self._effective(slot, key))
+
+    def _expire_boosts(self):
+        now = self.clock()
+        while self._boosts and self._boosts[0][0] <= now:
+            expiry, key = self._boosts.popleft()
+            if self._boosted.get(key) != expiry:
+                continue  # Removed, or boosted again since
+            slot = self._slots[key]
+            before = self._effective(slot, key)
+            del self._boosted[key]
+            self._tree.add(slot, self._effective(slot, key) - before)
@@ -1,15 +1,40 @@
 """
 Generate sample videos for testing the synchronized video streaming platform.
-This script creates simple MP4 files with colored backgrounds and text.
+
+With no arguments this recreates the three default clips in `static/`. With
+`--count` it builds a synthetic corpus instead: clips with mixed durations,
+resolutions, frame rates, codecs and containers, drawn from a seeded random
+generator so the same seed always describes the same corpus. Clips are
+encoded in parallel, one single-threaded ffmpeg per core, and written to
+`static/`, `uploads/` or an S3 bucket (a local stand-in such as moto or
+MinIO works via S3_ENDPOINT_URL). A JSON manifest records what each file
+should probe as, for verifying catalog loading and probing at scale.
+
+Examples:
+    python reset_sample_videos.py
+    python reset_sample_videos.py --count 2000 --seed 7 --target uploads
+    python reset_sample_videos.py --count 500 --target s3 --prefix corpus/ --verify
 """
 
 import os
-import subprocess
 import sys
+import json
 import time
+import random
+import hashlib
 import logging
+import argparse
 import platform
+import tempfile
+import subprocess
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, NamedTuple, Optional, Set
+
+from media_probe import parse_ffprobe_output
+
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+FFPROBE_BIN = os.getenv("FFPROBE_BIN", "ffprobe")
 
 # Function to clear terminal screen
 def clear_screen():
@@ -24,12 +49,12 @@ class ClearScreenHandler(logging.Handler):
     def __init__(self):
         super().__init__()
         self.first_emit = True
-    
+
     def emit(self, record):
         if self.first_emit:
             clear_screen()
             self.first_emit = False
-        
+
         # Format the message
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', '%H:%M:%S')
         message = formatter.format(record)
@@ -44,11 +69,60 @@ for handler in logger.handlers[:]:
 # Add our custom handler
 logger.addHandler(ClearScreenHandler())
 
+class Profile(NamedTuple):
+    """An encoding profile and what ffprobe reports for its output."""
+    ext: str
+    video_args: List[str]
+    audio_args: Optional[List[str]]  # None: the container gets no audio track
+    codec: str
+    audio_codec: Optional[str]
+    format: str
+
+MP4_FORMAT = "mov,mp4,m4a,3gp,3g2,mj2"
+MATROSKA_FORMAT = "matroska,webm"
+
+# Encoders are tuned for speed; fixtures need variety, not quality
+PROFILES = {
+    "h264-mp4": Profile(".mp4", ["-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-movflags", "+faststart"], ["-c:a", "aac", "-b:a", "96k"], "h264", "aac", MP4_FORMAT),
+    "h264-mov": Profile(".mov", ["-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p"], ["-c:a", "aac", "-b:a", "96k"], "h264", "aac", MP4_FORMAT),
+    "h264-mkv": Profile(".mkv", ["-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p"], ["-c:a", "libopus", "-b:a", "64k"], "h264", "opus", MATROSKA_FORMAT),
+    "vp9-webm": Profile(".webm", ["-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8", "-b:v", "0", "-crf", "40", "-pix_fmt", "yuv420p"], ["-c:a", "libopus", "-b:a", "64k"], "vp9", "opus", MATROSKA_FORMAT),
+    "mpeg4-avi": Profile(".avi", ["-c:v", "mpeg4", "-q:v", "6"], None, "mpeg4", None, "avi"),
+    "hevc-mp4": Profile(".mp4", ["-c:v", "libx265", "-preset", "ultrafast", "-tag:v", "hvc1", "-pix_fmt", "yuv420p", "-x265-params", "log-level=error:pools=1", "-movflags", "+faststart"], ["-c:a", "aac", "-b:a", "96k"], "hevc", "aac", MP4_FORMAT),
+    "av1-mkv": Profile(".mkv", ["-c:v", "libaom-av1", "-usage", "realtime", "-cpu-used", "8", "-crf", "45", "-pix_fmt", "yuv420p"], ["-c:a", "libopus", "-b:a", "64k"], "av1", "opus", MATROSKA_FORMAT),
+}
+DEFAULT_PROFILES = "h264-mp4,h264-mov,h264-mkv,vp9-webm,mpeg4-avi"
+DEFAULT_RESOLUTIONS = "426x240,640x360,854x480,1280x720,1920x1080"
+FRAME_RATES = (24, 25, 30)
+PATTERNS = ("color", "testsrc2", "smptebars")
+
+# Expected duration tolerance when verifying: audio priming and frame rounding
+DURATION_TOLERANCE = 0.15
+
+class ClipSpec(NamedTuple):
+    name: str
+    profile: str
+    duration: int
+    width: int
+    height: int
+    fps: int
+    pattern: str
+    color: str
+    tone: Optional[int]  # Sine frequency of the audio track, None for silent clips
+    label: Optional[str]
+
+# The original three samples
+DEFAULT_CLIPS = [
+    ClipSpec("default1.mp4", "h264-mp4", 10, 640, 360, 25, "color", "blue", None, "Sample Video 1"),
+    ClipSpec("default2.mp4", "h264-mp4", 10, 640, 360, 25, "color", "red", None, "Sample Video 2"),
+    ClipSpec("default3.mp4", "h264-mp4", 10, 640, 360, 25, "color", "green", None, "Sample Video 3"),
+]
+
 def check_ffmpeg():
     """Check if ffmpeg is installed."""
     logger.info("Checking if ffmpeg is installed...")
     try:
-        result = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        result = subprocess.run([FFMPEG_BIN, '-version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         version = result.stdout.decode('utf-8').split('\n')[0]
         logger.info(f"Found ffmpeg: {version}")
         return True
@@ -56,70 +130,219 @@ def check_ffmpeg():
         logger.error("ffmpeg not found in PATH")
         return False
 
-def generate_video(output_path, duration, color, text, index, total):
-    """Generate a simple video with ffmpeg."""
-    start_time = time.time()
-    
-    logger.info(f"[{index}/{total}] Starting generation of {output_path}")
-    logger.info(f"  - Duration: {duration}s, Color: {color}, Text: '{text}'")
-    
-    # Check if file already exists
-    if os.path.exists(output_path):
-        logger.info(f"  - File already exists, will be overwritten")
-    
-    command = [
-        'ffmpeg', '-y',
-        '-f', 'lavfi', 
-        '-i', f'color=c={color}:s=640x360:d={duration}',
-        '-vf', f"drawtext=text='{text}':fontsize=60:fontcolor=white:x=(w-text_w)/2:y=(h-text_h)/2",
-        '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+def ffmpeg_capabilities() -> Set[str]:
+    """Names of the encoders and filters this ffmpeg build has."""
+    names = set()
+    for kind in ("-encoders", "-filters"):
+        result = subprocess.run([FFMPEG_BIN, "-hide_banner", kind], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        for line in result.stdout.decode("utf-8", "replace").splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                names.add(fields[1])
+    return names
+
+def plan_corpus(count: int, seed: int, profiles: List[str], resolutions: List[tuple],
+                min_duration: int, max_duration: int, audio_ratio: float) -> List[ClipSpec]:
+    """
+    Describe a corpus. Every draw comes from one generator seeded with `seed`,
+    before anything is encoded, so the plan doesn't depend on job scheduling.
+    """
+    rng = random.Random(seed)
+    clips = []
+    for i in range(count):
+        profile = rng.choice(profiles)
+        width, height = rng.choice(resolutions)
+        clips.append(ClipSpec(
+            name=f"corpus_{seed}_{i:05d}{PROFILES[profile].ext}",
+            profile=profile,
+            duration=rng.randint(min_duration, max_duration),
+            width=width,
+            height=height,
+            fps=rng.choice(FRAME_RATES),
+            pattern=rng.choice(PATTERNS),
+            color=f"0x{rng.randrange(0x1000000):06x}",
+            tone=rng.randrange(220, 1760) if rng.random() < audio_ratio else None,
+            label=f"#{i} seed {seed}",
+        ))
+    return clips
+
+def build_command(clip: ClipSpec, output_path: str, drawtext: bool) -> List[str]:
+    """ffmpeg command line for one clip. Output is bit-exact for a given ffmpeg build."""
+    profile = PROFILES[clip.profile]
+    size = f"{clip.width}x{clip.height}"
+    if clip.pattern == "color":
+        source = f"color=c={clip.color}:s={size}:r={clip.fps}:d={clip.duration}"
+    else:
+        source = f"{clip.pattern}=s={size}:r={clip.fps}:d={clip.duration}"
+
+    command = [FFMPEG_BIN, '-y', '-v', 'error', '-f', 'lavfi', '-i', source]
+    has_audio = clip.tone is not None and profile.audio_args is not None
+    if has_audio:
+        command += ['-f', 'lavfi', '-i', f'sine=frequency={clip.tone}:sample_rate=48000:d={clip.duration}']
+    if clip.label and drawtext:
+        fontsize = max(clip.height // 6, 12)
+        command += ['-vf', f"drawtext=text='{clip.label}':fontsize={fontsize}:fontcolor=white:x=(w-text_w)/2:y=(h-text_h)/2"]
+    command += profile.video_args
+    command += profile.audio_args if has_audio else ['-an']
+    # One thread per job: parallelism comes from running one job per core
+    command += [
+        '-threads', '1', '-t', str(clip.duration),
+        '-map_metadata', '-1', '-fflags', '+bitexact', '-flags:v', '+bitexact', '-flags:a', '+bitexact',
         output_path
     ]
-    
-    # Show the command being executed
-    logger.debug(f"  - Executing: {' '.join(command)}")
-    
-    # Run the command and capture output
-    process = subprocess.Popen(
-        command, 
-        stdout=subprocess.PIPE, 
-        stderr=subprocess.PIPE,
-        universal_newlines=True
+    return command
+
+def expected_metadata(clip: ClipSpec) -> dict:
+    """What ffprobe should report for a clip, in the catalog's field names."""
+    profile = PROFILES[clip.profile]
+    has_audio = clip.tone is not None and profile.audio_args is not None
+    return {
+        "duration": clip.duration,
+        "width": clip.width,
+        "height": clip.height,
+        "fps": clip.fps,
+        "codec": profile.codec,
+        "audio_codec": profile.audio_codec if has_audio else None,
+        "format": profile.format,
+    }
+
+def hash_file(path: str) -> str:
+    """SHA-256 content key, in the same form as catalog content hashes."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+def verify_file(path: str, expected: dict) -> List[str]:
+    """Probe a generated file and list how it differs from the manifest entry."""
+    result = subprocess.run(
+        [FFPROBE_BIN, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    probed = parse_ffprobe_output(result.stdout) if result.returncode == 0 else None
+    if probed is None:
+        return ["not readable by ffprobe"]
+    problems = []
+    if abs(probed["duration"] - expected["duration"]) > DURATION_TOLERANCE:
+        problems.append(f"duration {probed['duration']} != {expected['duration']}")
+    for field in ("width", "height", "codec", "audio_codec", "format"):
+        if probed[field] != expected[field]:
+            problems.append(f"{field} {probed[field]} != {expected[field]}")
+    return problems
+
+def generate_video(clip: ClipSpec, output_dir: str, drawtext: bool, verify: bool, upload=None) -> dict:
+    """
+    Encode one clip (runs in a worker thread), then hash, verify and upload it.
+
+    Returns:
+        The clip's manifest entry
+
+    Raises:
+        RuntimeError if ffmpeg fails or verification finds a mismatch
+    """
+    output_path = os.path.join(output_dir, clip.name)
+    tmp_path = os.path.join(output_dir, f".{clip.name}.part{PROFILES[clip.profile].ext}")
+    started = time.time()
+    result = subprocess.run(
+        build_command(clip, tmp_path, drawtext),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
     )
-    
-    # Print progress dots
-    sys.stdout.write(f"  - Processing: ")
-    sys.stdout.flush()
-    
-    while process.poll() is None:
-        sys.stdout.write(".")
-        sys.stdout.flush()
-        time.sleep(0.5)
-    
-    sys.stdout.write("\n")
-    
-    # Get the result
-    stdout, stderr = process.communicate()
-    
-    if process.returncode == 0:
-        elapsed_time = time.time() - start_time
-        file_size = os.path.getsize(output_path) / (1024 * 1024)  # Size in MB
-        
-        logger.info(f"  - ✅ Generated successfully in {elapsed_time:.2f}s")
-        logger.info(f"  - File size: {file_size:.2f} MB")
-        logger.info(f"  - Saved to: {os.path.abspath(output_path)}")
+    if result.returncode != 0:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise RuntimeError(result.stderr.decode("utf-8", "replace").strip() or f"ffmpeg exited with {result.returncode}")
+    # Renamed into place so the app's directory watcher only sees complete files
+    os.replace(tmp_path, output_path)
+
+    entry = {
+        "name": clip.name,
+        "profile": clip.profile,
+        **expected_metadata(clip),
+        "size": os.path.getsize(output_path),
+        "content_hash": hash_file(output_path),
+        "encode_seconds": round(time.time() - started, 3),
+    }
+    if verify:
+        problems = verify_file(output_path, entry)
+        if problems:
+            os.remove(output_path)
+            raise RuntimeError("; ".join(problems))
+    if upload is not None:
+        entry["url"] = upload(output_path, clip)
+        os.remove(output_path)
     else:
-        logger.error(f"  - ❌ Failed to generate video")
-        logger.error(f"  - Error: {stderr}")
-    
-    return process.returncode == 0
+        entry["url"] = f"/{os.path.basename(os.path.normpath(output_dir))}/{clip.name}"
+    return entry
 
-def main():
+def s3_uploader(prefix: str):
+    """Upload function for the s3 target, using the app's S3 settings."""
+    import s3_utils  # Only the s3 target needs boto3
+
+    if not all([s3_utils.AWS_ACCESS_KEY_ID, s3_utils.AWS_SECRET_ACCESS_KEY, s3_utils.S3_BUCKET_NAME]):
+        logger.error("S3 credentials not configured; set them in .env (and S3_ENDPOINT_URL for a local stand-in)")
+        sys.exit(1)
+    client = s3_utils.get_s3_client()
+    content_types = {".mp4": "video/mp4", ".mov": "video/quicktime", ".mkv": "video/x-matroska", ".webm": "video/webm", ".avi": "video/x-msvideo"}
+
+    def upload(path: str, clip: ClipSpec) -> str:
+        key = f"{prefix}{clip.name}"
+        client.upload_file(path, s3_utils.S3_BUCKET_NAME, key, ExtraArgs={
+            "ContentType": content_types.get(PROFILES[clip.profile].ext, "video/mp4"),
+            "ACL": "public-read",
+        })
+        return s3_utils.get_object_url(key)
+    return upload
+
+def parse_resolutions(value: str) -> List[tuple]:
+    try:
+        return [tuple(int(n) for n in size.lower().split("x")) for size in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected WIDTHxHEIGHT[,...], got {value!r}")
+
+def parse_durations(value: str) -> tuple:
+    low, _, high = value.partition("-")
+    try:
+        low, high = int(low), int(high or low)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected MIN-MAX seconds, got {value!r}")
+    if not 1 <= low <= high:
+        raise argparse.ArgumentTypeError(f"Expected 1 <= MIN <= MAX, got {value!r}")
+    return low, high
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate sample videos or a synthetic test corpus.")
+    parser.add_argument("--count", type=int, help="Generate a corpus of this many clips instead of the three defaults")
+    parser.add_argument("--seed", type=int, default=0, help="Corpus seed; the same seed describes the same corpus (default 0)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Parallel ffmpeg jobs (default: all cores)")
+    parser.add_argument("--target", choices=("static", "uploads", "s3"), default="static", help="Where to write the clips (default static)")
+    parser.add_argument("--prefix", default="", help="Key prefix for the s3 target")
+    parser.add_argument("--profiles", default=DEFAULT_PROFILES, help=f"Codec/container profiles to mix, from {','.join(PROFILES)} (default {DEFAULT_PROFILES})")
+    parser.add_argument("--resolutions", type=parse_resolutions, default=parse_resolutions(DEFAULT_RESOLUTIONS), help=f"Resolutions to mix (default {DEFAULT_RESOLUTIONS})")
+    parser.add_argument("--durations", type=parse_durations, default=(5, 60), help="Duration range in seconds (default 5-60)")
+    parser.add_argument("--audio-ratio", type=float, default=0.7, help="Share of clips with an audio track (default 0.7)")
+    parser.add_argument("--manifest", default="corpus_manifest.json", help="Manifest path (default corpus_manifest.json)")
+    parser.add_argument("--verify", action="store_true", help="ffprobe every clip and fail on metadata that differs from the manifest")
+    args = parser.parse_args(argv)
+
+    args.profiles = [name.strip() for name in args.profiles.split(",") if name.strip()]
+    unknown = [name for name in args.profiles if name not in PROFILES]
+    if unknown:
+        parser.error(f"Unknown profiles: {', '.join(unknown)}")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
+def main(argv=None):
     """Main function to generate sample videos."""
+    args = parse_args(argv)
+
     logger.info("=" * 60)
     logger.info("Starting sample video generation")
     logger.info("=" * 60)
-    
+
     # Check ffmpeg
     if not check_ffmpeg():
         logger.error("Error: ffmpeg is not installed. Please install ffmpeg to generate sample videos.")
@@ -127,42 +350,98 @@ def main():
         logger.info("On Ubuntu/Debian: sudo apt-get install ffmpeg")
         logger.info("On Windows: Download from https://ffmpeg.org/download.html")
         sys.exit(1)
-    
-    # Create static directory if it doesn't exist
-    if not os.path.exists('static'):
-        logger.info("Creating 'static' directory")
-        os.makedirs('static', exist_ok=True)
+
+    if args.count is None:
+        clips = DEFAULT_CLIPS
     else:
-        logger.info("'static' directory already exists")
-    
-    # Generate sample videos
-    videos = [
-        ('static/default1.mp4', 10, 'blue', 'Sample Video 1'),
-        ('static/default2.mp4', 10, 'red', 'Sample Video 2'),
-        ('static/default3.mp4', 10, 'green', 'Sample Video 3'),
-    ]
-    
-    logger.info(f"Will generate {len(videos)} sample videos")
-    
+        clips = plan_corpus(args.count, args.seed, args.profiles, args.resolutions, *args.durations, args.audio_ratio)
+
+    # Fail before encoding anything if this ffmpeg build lacks an encoder
+    capabilities = ffmpeg_capabilities()
+    missing = set()
+    for profile in (PROFILES[name] for name in {clip.profile for clip in clips}):
+        encoders = [profile.video_args[profile.video_args.index("-c:v") + 1]]
+        if profile.audio_args:
+            encoders.append(profile.audio_args[profile.audio_args.index("-c:a") + 1])
+        missing.update(encoder for encoder in encoders if encoder not in capabilities)
+    if missing:
+        logger.error(f"This ffmpeg build lacks encoders: {', '.join(sorted(missing))}; choose other --profiles")
+        sys.exit(1)
+    drawtext = "drawtext" in capabilities
+    if not drawtext:
+        logger.warning("ffmpeg has no drawtext filter (built without freetype), clips will not be labeled")
+
+    # Create the output directory if it doesn't exist
+    upload = None
+    if args.target == "s3":
+        upload = s3_uploader(args.prefix)
+        output_dir = tempfile.mkdtemp(prefix="corpus_")
+    else:
+        output_dir = args.target
+        os.makedirs(output_dir, exist_ok=True)
+
+    logger.info(f"Will generate {len(clips)} videos into {args.target} with {args.jobs} parallel jobs")
+
     start_time = time.time()
-    success_count = 0
-    
-    for i, (output_path, duration, color, text) in enumerate(videos, 1):
-        if generate_video(output_path, duration, color, text, i, len(videos)):
-            success_count += 1
-    
+    entries = []
+    failures = 0
+    executor = ThreadPoolExecutor(max_workers=args.jobs)
+    try:
+        futures = {
+            executor.submit(generate_video, clip, output_dir, drawtext, args.verify, upload): clip
+            for clip in clips
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            clip = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                failures += 1
+                logger.error(f"[{done}/{len(clips)}] ❌ {clip.name}: {e}")
+                continue
+            entries.append(entry)
+            logger.info(
+                f"[{done}/{len(clips)}] ✅ {clip.name}: {entry['duration']}s {entry['width']}x{entry['height']} "
+                f"{entry['codec']}, {entry['size'] / (1024 * 1024):.2f} MB in {entry['encode_seconds']:.2f}s"
+            )
+    finally:
+        # Ctrl-C: drop queued clips instead of encoding them all first
+        executor.shutdown(wait=True, cancel_futures=True)
+        if upload is not None:
+            for name in os.listdir(output_dir):
+                os.remove(os.path.join(output_dir, name))
+            os.rmdir(output_dir)
+
     total_time = time.time() - start_time
-    
+
+    # Manifest entries follow the plan's order, whatever order jobs finished in
+    order = {clip.name: i for i, clip in enumerate(clips)}
+    entries.sort(key=lambda entry: order[entry["name"]])
+    manifest = {
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "seed": args.seed if args.count is not None else None,
+        "target": args.target,
+        "count": len(entries),
+        "total_bytes": sum(entry["size"] for entry in entries),
+        "videos": entries,
+    }
+    tmp_path = f"{args.manifest}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, args.manifest)
+
     logger.info("=" * 60)
-    logger.info(f"Generation complete: {success_count}/{len(videos)} videos created successfully")
-    logger.info(f"Total time: {total_time:.2f} seconds")
+    logger.info(f"Generation complete: {len(entries)}/{len(clips)} videos created successfully")
+    logger.info(f"Total time: {total_time:.2f} seconds ({manifest['total_bytes'] / (1024 * 1024):.1f} MB)")
+    logger.info(f"Manifest: {os.path.abspath(args.manifest)}")
     logger.info("=" * 60)
-    
-    if success_count == len(videos):
+
+    if not failures:
         logger.info("All sample videos generated successfully!")
         logger.info("You can now run the main application with: python main.py")
     else:
-        logger.warning(f"Some videos failed to generate ({len(videos) - success_count} failures)")
+        logger.warning(f"Some videos failed to generate ({failures} failures)")
+        sys.exit(1)
 
 if __name__ == "__main__":
     try:
@@ -172,4 +451,4 @@ if __name__ == "__main__":
         sys.exit(1)
     except Exception as e:
         logger.exception(f"Unexpected error: {e}")
-        sys.exit(1) 
\ No newline at end of file
+        sys.exit(1)
@@ -0,0 +1,392 @@
+"""
+Read-through disk cache in front of S3 videos.
+
+With S3_PROXY_MODE enabled, clients are given `/s3/{key}` URLs instead of
+bucket URLs, and objects are copied from S3 into a local cache directory on
+first use and served from disk with the same range and validator support
+as local videos. Cached files are named after the object key and ETag, so a
+changed object is fetched again rather than served stale.
+
+Each object is fetched from S3 once, as a single GET streamed into a
+`.part` file. A request for an object that isn't cached yet joins that fill
+and is served from the growing file as soon as the bytes it asks for have
+arrived, so the first viewers never wait for the whole download. Fills are
+shared: within a worker concurrent ones wait on the same future, and across
+workers sharing the directory the download holds an flock on a per-object
+lock file. The object's S3 ETag is kept in a `.meta` file next to it and
+sent for both the partial and the cached copy. The cache is trimmed to
+S3_PROXY_CACHE_SIZE_MB by deleting the least recently used files, with
+recency tracked in file mtimes so every worker sees the same order.
+"""
+import os
+import json
+import time
+import fcntl
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import threading
+from urllib.parse import quote
+from typing import AsyncIterator, Dict, Iterable, Optional, Set, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+import metrics
+import s3_utils
+import page_cache
+import video_files
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Proxy settings
+S3_PROXY_MODE = os.getenv("S3_PROXY_MODE", "false").lower() == "true"
+S3_PROXY_CACHE_SIZE_MB = int(os.getenv("S3_PROXY_CACHE_SIZE_MB", "2048"))
+# How many upcoming videos to copy into the cache before they go on air
+S3_PROXY_WARM_AHEAD = int(os.getenv("S3_PROXY_WARM_AHEAD", "2"))
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+S3_PROXY_DIR = os.path.join(CACHE_DIR, "s3")
+
+# Refresh a cached file's mtime at most this often while it is being served
+TOUCH_INTERVAL = 60.0
+# Read size when copying an object from S3
+FILL_CHUNK_BYTES = 256 * 1024
+# How often readers of a fill in progress look for more data
+FILL_POLL_INTERVAL = 0.05
+# Readers give up on a fill that has made no progress for this long
+FILL_STALL_TIMEOUT = 30.0
+# Files next to the cached objects that are not objects themselves
+SIDECAR_SUFFIXES = (".lock", ".part", ".meta", ".tmp")
+
+def cache_name(key: str, etag: Optional[str]) -> str:
+    """File name for an object version, keeping the key's extension for its content type."""
+    digest = hashlib.blake2b(f"{key}\0{etag or ''}".encode("utf-8"), digest_size=16).hexdigest()
+    return digest + os.path.splitext(key)[1].lower()
+
+def client_url(url: Optional[str]) -> Optional[str]:
+    """The URL clients should use for a video or playlist URL."""
+    if not S3_PROXY_MODE or not url:
+        return url
+    key = s3_utils.key_for_url(url)
+    return f"/s3/{quote(key)}" if key is not None else url
+
+def read_meta(path: str) -> Optional[dict]:
+    """Read an object's sidecar metadata (blocking)."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def write_meta(path: str, meta: dict):
+    """Write an object's sidecar metadata atomically (blocking)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, path)
+
+def remove_files(paths: Iterable[str]):
+    """Delete files that may already be gone (blocking)."""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def open_fill(path: str) -> Optional[int]:
+    """
+    Open an object's partial file, or the finished one if the fill is done
+    (blocking).
+
+    Returns:
+        A descriptor the caller closes, or None if neither exists
+    """
+    for candidate in (f"{path}.part", path):
+        try:
+            return os.open(candidate, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+    return None
+
+def read_fill(fd: int, offset: int, length: int) -> Optional[bytes]:
+    """
+    Read up to `length` bytes at `offset` from a file that may still be
+    filling (blocking).
+
+    Returns:
+        The bytes available so far (empty if none yet), or None if the fill
+        failed and its partial file was removed
+    """
+    st = os.fstat(fd)
+    if st.st_size > offset:
+        return os.pread(fd, min(length, st.st_size - offset), offset)
+    if st.st_nlink == 0:
+        return None
+    return b""
+
+class S3Proxy:
+    """
+    Size-bounded LRU cache of S3 objects on local disk.
+    """
+
+    def __init__(self, root: str = S3_PROXY_DIR, max_bytes: int = S3_PROXY_CACHE_SIZE_MB * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        # name -> the S3 ETag of a cached object
+        self._etags: Dict[str, Optional[str]] = {}
+        self._touched: Dict[str, float] = {}
+        self._evict_lock = threading.Lock()
+
+    async def respond(self, request: Request, key: str, etag: Optional[str]) -> Optional[Response]:
+        """
+        Serve an object version from the cache, joining its fill if it
+        isn't cached yet.
+
+        Args:
+            request: The incoming GET or HEAD request
+            key: The S3 object key
+            etag: The object's ETag from the catalog, or None for immutable
+                objects such as packaged HLS segments
+
+        Returns:
+            The response, or None if S3 could not be read
+        """
+        name = cache_name(key, etag)
+        path = os.path.join(self.root, name)
+        if os.path.exists(path):
+            metrics.S3_PROXY_REQUESTS.labels("hit").inc()
+            self._touch(name, path)
+            return await self._serve_cached(request, name)
+
+        future = self.fill(key, etag)
+        meta = await self._wait_for_meta(path, future)
+        if meta is None:
+            # Another worker may have finished the copy before this one looked
+            if future.done() and future.result() and os.path.exists(path):
+                return await self._serve_cached(request, name)
+            return None
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        # Small text bodies and multipart ranges are served once the copy is done
+        if page_cache.compressible(content_type) or len(self._ranges(request, meta) or ()) > 1:
+            if not await future:
+                return None
+            return await self._serve_cached(request, name)
+        return await self._serve_filling(request, path, meta, content_type)
+
+    def fill(self, key: str, etag: Optional[str]) -> asyncio.Future:
+        """
+        Start copying an object version into the cache, or join the copy
+        already in progress.
+
+        Returns:
+            A future resolving to whether the object is now cached
+        """
+        name = cache_name(key, etag)
+        future = self._inflight.get(name)
+        if future is not None:
+            metrics.S3_PROXY_REQUESTS.labels("coalesced").inc()
+            return future
+
+        metrics.S3_PROXY_REQUESTS.labels("miss").inc()
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[name] = future
+        task = asyncio.create_task(self._run_fill(key, name, future))
+        self._tasks.add(task)
+        task.add_done_callback(self._fill_done)
+        return future
+
+    def warm(self, objects: Iterable[Tuple[str, Optional[str]]]):
+        """Start filling the cache with (key, etag) objects in the background."""
+        for key, etag in objects:
+            name = cache_name(key, etag)
+            if name in self._inflight or os.path.exists(os.path.join(self.root, name)):
+                continue
+            self.fill(key, etag)
+
+    def evict(self, keep: Optional[str] = None):
+        """Delete the least recently used files until the cache fits."""
+        with self._evict_lock:
+            files = []
+            total = 0
+            with os.scandir(self.root) as entries:
+                for entry in entries:
+                    if entry.name.endswith(SIDECAR_SUFFIXES) or entry.name == keep:
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue  # Evicted by another worker
+                    files.append((st.st_mtime, entry.name, st.st_size))
+                    total += st.st_size
+            if keep is not None:
+                try:
+                    total += os.path.getsize(os.path.join(self.root, keep))
+                except FileNotFoundError:
+                    pass
+
+            evicted = 0
+            for _, name, size in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                # Responses already reading a removed file keep their open descriptors
+                path = os.path.join(self.root, name)
+                remove_files((path, f"{path}.meta", f"{path}.lock"))
+                self._etags.pop(name, None)
+                self._touched.pop(name, None)
+                total -= size
+                evicted += 1
+            metrics.S3_PROXY_CACHE_BYTES.set(total)
+            if evicted:
+                logger.info(f"Evicted {evicted} objects from the S3 proxy cache, now {total} bytes")
+
+    async def _run_fill(self, key: str, name: str, future: asyncio.Future):
+        success = False
+        try:
+            started = time.perf_counter()
+            success = await s3_utils.run_in_s3_executor(self._fill, key, os.path.join(self.root, name))
+            if success:
+                metrics.S3_PROXY_FILL_SECONDS.observe(time.perf_counter() - started)
+                await asyncio.to_thread(self.evict, keep=name)
+        finally:
+            del self._inflight[name]
+            future.set_result(success)
+
+    def _fill(self, key: str, path: str) -> bool:
+        """
+        Copy an object into the cache unless another worker already has
+        (runs in a thread). The metadata is written before the body, so
+        readers can start on the partial file right away.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        part_path = f"{path}.part"
+        meta_path = f"{path}.meta"
+        with open(f"{path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(path):
+                    return True
+                # Left behind by a worker that died mid-fill
+                remove_files((meta_path,))
+                try:
+                    with open(part_path, "wb") as part:
+                        result = s3_utils.get_object_or_raise(key)
+                        body = result["Body"]
+                        try:
+                            write_meta(meta_path, {"etag": result.get("ETag"), "size": result["ContentLength"]})
+                            for chunk in body.iter_chunks(FILL_CHUNK_BYTES):
+                                part.write(chunk)
+                        finally:
+                            body.close()
+                    os.replace(part_path, path)
+                except Exception as e:
+                    logger.error(f"Caching S3 object {key} failed: {str(e)}")
+                    remove_files((part_path, meta_path))
+                    return False
+                logger.info(f"Cached S3 object {key} ({os.path.getsize(path)} bytes)")
+                return True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    async def _wait_for_meta(self, path: str, future: asyncio.Future) -> Optional[dict]:
+        """
+        Wait until a fill has its object's metadata.
+
+        Returns:
+            The metadata, or None if the fill failed or stalled
+        """
+        deadline = time.monotonic() + FILL_STALL_TIMEOUT
+        while True:
+            meta = await asyncio.to_thread(read_meta, f"{path}.meta")
+            if meta is not None or future.done() or time.monotonic() > deadline:
+                return meta
+            await asyncio.wait([future], timeout=FILL_POLL_INTERVAL)
+
+    async def _serve_cached(self, request: Request, name: str) -> Response:
+        if name not in self._etags:
+            meta = await asyncio.to_thread(read_meta, os.path.join(self.root, f"{name}.meta"))
+            self._etags[name] = meta.get("etag") if meta else None
+        return await video_files.serve_file(request, self.root, name, etag=self._etags[name])
+
+    @staticmethod
+    def _ranges(request: Request, meta: dict) -> Optional[list]:
+        """The ranges requested of an object, as for video_files.serve_file."""
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if not range_header or (if_range is not None and if_range != meta["etag"]):
+            return None
+        return video_files.parse_range_header(range_header, meta["size"])
+
+    async def _serve_filling(self, request: Request, path: str, meta: dict, content_type: str) -> Optional[Response]:
+        """Serve a full or single-range request from an object that is still being copied."""
+        size = meta["size"]
+        headers = {
+            "accept-ranges": "bytes",
+            "cache-control": f"public, max-age={video_files.VIDEO_CACHE_MAX_AGE}",
+        }
+        if meta["etag"]:
+            headers["etag"] = meta["etag"]
+            if_none_match = request.headers.get("if-none-match")
+            if if_none_match is not None and video_files.etag_matches(if_none_match, meta["etag"]):
+                return Response(status_code=304, headers=headers)
+
+        ranges = self._ranges(request, meta)
+        if ranges is not None and not ranges:
+            headers["content-range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+        if ranges:
+            start, end = ranges[0]
+            status_code = 206
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+        else:
+            start, end = 0, size - 1
+            status_code = 200
+        headers["content-length"] = str(end - start + 1)
+        if request.method == "HEAD" or end < start:
+            return Response(status_code=status_code, headers=headers, media_type=content_type)
+
+        fd = await asyncio.to_thread(open_fill, path)
+        if fd is None:
+            return None
+        return StreamingResponse(
+            self._tail(fd, path, start, end), status_code=status_code, headers=headers, media_type=content_type
+        )
+
+    @staticmethod
+    async def _tail(fd: int, path: str, start: int, end: int) -> AsyncIterator[bytes]:
+        """Stream a byte range of a file as the fill writes it."""
+        try:
+            offset = start
+            progressed = time.monotonic()
+            while offset <= end:
+                chunk = await asyncio.to_thread(read_fill, fd, offset, min(video_files.CHUNK_SIZE, end + 1 - offset))
+                if chunk is None:
+                    raise OSError(f"Fill of {path} failed mid-response")
+                if not chunk:
+                    if time.monotonic() - progressed > FILL_STALL_TIMEOUT:
+                        raise TimeoutError(f"Fill of {path} stalled mid-response")
+                    await asyncio.sleep(FILL_POLL_INTERVAL)
+                    continue
+                progressed = time.monotonic()
+                offset += len(chunk)
+                yield chunk
+        finally:
+            os.close(fd)
+
+    def _touch(self, name: str, path: str):
+        now = time.monotonic()
+        if now - self._touched.get(name, 0.0) < TOUCH_INTERVAL:
+            return
+        self._touched[name] = now
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def _fill_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Filling the S3 proxy cache failed: {task.exception()}")
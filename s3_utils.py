@@ -2,11 +2,19 @@
 Utility functions for AWS S3 operations.
 """
 import os
+import asyncio
 import logging
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
-from typing import Optional, BinaryIO, Tuple, List
+from typing import Callable, Optional, Tuple, List
+
+import metrics
 
 # Load environment variables
 load_dotenv()
@@ -25,64 +33,119 @@ S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # Optional, for custom endpoints
 MAX_UPLOAD_SIZE_MB = int(os.getenv("MAX_UPLOAD_SIZE_MB", "100"))
 ALLOWED_VIDEO_EXTENSIONS = os.getenv("ALLOWED_VIDEO_EXTENSIONS", ".mp4,.webm,.mov,.avi,.mkv").split(",")
 
+# Key prefix for packaged HLS renditions, kept out of the video listing
+S3_PACKAGED_PREFIX = os.getenv("S3_PACKAGED_PREFIX", "packaged/")
+
+# Object metadata holding an upload's content hash, for deduplicating uploads
+CONTENT_HASH_METADATA = "content-sha256"
+
+# Transfer settings (S3 requires multipart parts of at least 5 MB)
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "20"))
+S3_PART_SIZE_MB = max(5, int(os.getenv("S3_PART_SIZE_MB", "8")))
+S3_UPLOAD_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", "4"))
+
+# Shared client and the thread pool that runs blocking S3 calls off the event loop
+_s3_client = None
+_s3_client_lock = threading.Lock()
+_s3_executor = ThreadPoolExecutor(max_workers=S3_MAX_POOL_CONNECTIONS, thread_name_prefix="s3")
+
 def get_s3_client():
     """
-    Create and return an S3 client.
+    Return the shared S3 client, creating it on first use.
+
+    boto3 clients are thread-safe, so one client and its connection pool
+    are reused for every call instead of being rebuilt each time.
     """
-    try:
-        # Create S3 client
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            region_name=AWS_REGION,
-            endpoint_url=S3_ENDPOINT_URL
-        )
-        return s3_client
-    except Exception as e:
-        logger.error(f"Failed to create S3 client: {e}")
-        raise
+    global _s3_client
+    if _s3_client is not None:
+        return _s3_client
+
+    with _s3_client_lock:
+        if _s3_client is None:
+            try:
+                # Create S3 client
+                client = boto3.client(
+                    's3',
+                    aws_access_key_id=AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                    region_name=AWS_REGION,
+                    endpoint_url=S3_ENDPOINT_URL,
+                    config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+                )
+                metrics.instrument_s3_client(client)
+                _s3_client = client
+            except Exception as e:
+                logger.error(f"Failed to create S3 client: {e}")
+                raise
+    return _s3_client
+
+def get_object_url(key: str) -> str:
+    """
+    Build the public URL for an object in the bucket.
+    """
+    if S3_ENDPOINT_URL:
+        # Custom endpoint
+        return f"{S3_ENDPOINT_URL}/{S3_BUCKET_NAME}/{key}"
+    # Standard AWS S3 URL format
+    return f"https://{S3_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{key}"
+
+def key_for_url(url: str) -> Optional[str]:
+    """
+    Return the object key behind a URL built by get_object_url, or None for other URLs.
+    """
+    prefix = get_object_url("")
+    if url.startswith(prefix) and len(url) > len(prefix):
+        return url[len(prefix):]
+    return None
+
+async def run_in_s3_executor(func, *args, **kwargs):
+    """
+    Run a blocking S3 call on the S3 thread pool without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_s3_executor, lambda: func(*args, **kwargs))
 
-def upload_file_to_s3(file_obj: BinaryIO, filename: str, content_type: str) -> Tuple[bool, str]:
+async def upload_directory_to_s3(local_dir: str, prefix: str) -> Tuple[bool, str]:
     """
-    Upload a file to S3 bucket.
+    Upload every file under a local directory to S3, concurrently.
     
     Args:
-        file_obj: File-like object to upload
-        filename: Name to give the file in S3
-        content_type: MIME type of the file
+        local_dir: Directory to upload
+        prefix: Key prefix the directory's relative paths are placed under
         
     Returns:
-        Tuple of (success, url_or_error_message)
+        Tuple of (success, prefix_url_or_error_message)
     """
     if not all([AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_BUCKET_NAME]):
         return False, "S3 credentials not configured"
     
-    try:
-        s3_client = get_s3_client()
-        
-        # Upload the file
-        s3_client.upload_fileobj(
-            file_obj,
-            S3_BUCKET_NAME,
-            filename,
-            ExtraArgs={
-                'ContentType': content_type,
-                'ACL': 'public-read'  # Make the file publicly accessible
-            }
-        )
-        
-        # Generate the URL for the uploaded file
-        if S3_ENDPOINT_URL:
-            # Custom endpoint
-            url = f"{S3_ENDPOINT_URL}/{S3_BUCKET_NAME}/{filename}"
-        else:
-            # Standard AWS S3 URL format
-            url = f"https://{S3_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{filename}"
-        
-        logger.info(f"Successfully uploaded {filename} to S3")
-        return True, url
+    s3_client = get_s3_client()
+    semaphore = asyncio.Semaphore(S3_MAX_POOL_CONNECTIONS)
+    
+    async def upload_one(path: str, key: str):
+        async with semaphore:
+            await run_in_s3_executor(
+                s3_client.upload_file,
+                path,
+                S3_BUCKET_NAME,
+                key,
+                ExtraArgs={
+                    'ContentType': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                    'ACL': 'public-read'
+                }
+            )
+    
+    uploads = []
+    for root, _, files in os.walk(local_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            key = f"{prefix}/{os.path.relpath(path, local_dir)}"
+            uploads.append(upload_one(path, key))
     
+    try:
+        await asyncio.gather(*uploads)
+        logger.info(f"Successfully uploaded {len(uploads)} files to S3 under {prefix}/")
+        return True, get_object_url(prefix)
     except ClientError as e:
         error_message = f"S3 upload error: {str(e)}"
         logger.error(error_message)
@@ -92,50 +155,119 @@ def upload_file_to_s3(file_obj: BinaryIO, filename: str, content_type: str) -> T
         logger.error(error_message)
         return False, error_message
 
-def list_videos_from_s3() -> List[dict]:
+def list_s3_videos_or_raise() -> List[dict]:
     """
-    List all videos in the S3 bucket.
+    List all videos in the S3 bucket, raising on any S3 error.
+    
+    Pages through the whole bucket with continuation tokens, so buckets with
+    more than 1000 objects are listed completely.
     
     Returns:
         List of dictionaries with video information
     """
-    if not all([AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_BUCKET_NAME]):
-        logger.error("S3 credentials not configured")
-        return []
+    s3_client = get_s3_client()
     
-    try:
-        s3_client = get_s3_client()
-        
-        # List objects in the bucket
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME)
-        
-        videos = []
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                key = obj['Key']
-                # Check if it's a video file
-                if any(key.lower().endswith(ext) for ext in ALLOWED_VIDEO_EXTENSIONS):
-                    # Generate URL
-                    if S3_ENDPOINT_URL:
-                        url = f"{S3_ENDPOINT_URL}/{S3_BUCKET_NAME}/{key}"
-                    else:
-                        url = f"https://{S3_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{key}"
-                    
-                    videos.append({
-                        "url": url,
-                        "key": key,
-                        "size": obj['Size'],
-                        "last_modified": obj['LastModified'].isoformat()
-                    })
+    # List objects in the bucket, one page at a time
+    paginator = s3_client.get_paginator('list_objects_v2')
+    
+    videos = []
+    for page in paginator.paginate(Bucket=S3_BUCKET_NAME):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            if key.startswith(S3_PACKAGED_PREFIX):
+                continue
+            # Check if it's a video file
+            if any(key.lower().endswith(ext) for ext in ALLOWED_VIDEO_EXTENSIONS):
+                videos.append({
+                    "url": get_object_url(key),
+                    "key": key,
+                    "etag": obj['ETag'].strip('"'),
+                    "size": obj['Size'],
+                    "last_modified": obj['LastModified'].isoformat()
+                })
+    
+    return videos
+
+def upload_path_to_s3(
+    path: str,
+    key: str,
+    content_type: str,
+    callback: Optional[Callable[[int], None]] = None,
+    content_hash: Optional[str] = None
+) -> Tuple[bool, str]:
+    """
+    Upload a local file, as concurrent multipart parts for large files.
+    
+    Args:
+        path: Local file to upload
+        key: The S3 object key
+        content_type: MIME type of the file
+        callback: Called from the transfer threads with the bytes sent per chunk
+        content_hash: "sha256:<hex>" of the file, stored as object metadata
         
-        return videos
+    Returns:
+        Tuple of (success, url_or_error_message)
+    """
+    if not all([AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_BUCKET_NAME]):
+        return False, "S3 credentials not configured"
     
-    except ClientError as e:
-        logger.error(f"S3 list error: {str(e)}")
-        return []
+    extra_args = {'ContentType': content_type, 'ACL': 'public-read'}
+    if content_hash is not None:
+        extra_args['Metadata'] = {CONTENT_HASH_METADATA: content_hash}
+    try:
+        get_s3_client().upload_file(
+            path,
+            S3_BUCKET_NAME,
+            key,
+            ExtraArgs=extra_args,
+            Callback=callback,
+            Config=TransferConfig(
+                multipart_chunksize=S3_PART_SIZE_MB * 1024 * 1024,
+                max_concurrency=S3_UPLOAD_CONCURRENCY
+            )
+        )
+        logger.info(f"Successfully uploaded {key} to S3")
+        return True, get_object_url(key)
     except Exception as e:
-        logger.error(f"Unexpected error listing S3 objects: {str(e)}")
-        return []
+        error_message = f"S3 upload error for {key}: {str(e)}"
+        logger.error(error_message)
+        return False, error_message
+
+def get_object_or_raise(key: str, **params) -> dict:
+    """
+    GET an object, raising on any S3 error.
+
+    Args:
+        key: The S3 object key
+        **params: Extra request parameters, e.g. Range or IfNoneMatch
+
+    Returns:
+        The S3 response; the caller must close its 'Body'
+    """
+    return get_s3_client().get_object(Bucket=S3_BUCKET_NAME, Key=key, **params)
+
+def get_object_etag(key: str) -> Optional[str]:
+    """
+    Return the ETag of an object in the bucket, or None if it cannot be read.
+    """
+    try:
+        response = get_s3_client().head_object(Bucket=S3_BUCKET_NAME, Key=key)
+        return response['ETag'].strip('"')
+    except ClientError as e:
+        logger.error(f"S3 head error for {key}: {str(e)}")
+        return None
+
+def get_object_content_hash(key: str) -> Optional[str]:
+    """
+    Return the content hash stored with an object on upload, or None if it
+    has none or cannot be read.
+    """
+    try:
+        response = get_s3_client().head_object(Bucket=S3_BUCKET_NAME, Key=key)
+        return response.get('Metadata', {}).get(CONTENT_HASH_METADATA)
+    except ClientError as e:
+        logger.error(f"S3 head error for {key}: {str(e)}")
+        return None
 
 def is_valid_video_file(filename: str) -> bool:
     """
@@ -0,0 +1,347 @@
+"""
+Shared playback state and coordination backends.
+
+A backend elects a single schedule leader, carries broadcast messages for
+every channel to every worker, and keeps channel definitions consistent
+across workers. `memory` keeps everything
+in-process (one worker), `file` coordinates any number of workers on one
+machine through a shared state directory.
+"""
+import os
+import json
+import fcntl
+import asyncio
+import logging
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional, Tuple
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Backend settings
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_DIR = os.getenv("STATE_DIR", ".state")
+STATE_POLL_INTERVAL = float(os.getenv("STATE_POLL_INTERVAL", "0.05"))
+STATE_LOG_MAX_BYTES = int(os.getenv("STATE_LOG_MAX_BYTES", str(4 * 1024 * 1024)))
+
+# Channel used to tell every worker that channel definitions changed
+CONTROL_CHANNEL = "_control"
+# Channel carrying coalesced like totals from every worker
+LIKES_CHANNEL = "_likes"
+
+class InProcessBackend:
+    """
+    Default backend for a single worker. This process is always the leader.
+    """
+
+    def __init__(self):
+        # channel -> latest broadcast message
+        self.current: Dict[str, str] = {}
+        self._listeners = set()
+        self._channels: Dict[str, Optional[List[str]]] = {}
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def try_acquire_leadership(self) -> bool:
+        return True
+
+    async def publish(self, channel: str, message: str):
+        """Publish a broadcast message on a channel to every listener."""
+        self.current[channel] = message
+        for listener in self._listeners:
+            listener.put_nowait((channel, message))
+
+    async def listen(self) -> AsyncIterator[Tuple[str, str]]:
+        """Yield every (channel, message) published after the call."""
+        queue = asyncio.Queue()
+        self._listeners.add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._listeners.discard(queue)
+
+    async def load_channels(self) -> Dict[str, Optional[List[str]]]:
+        return dict(self._channels)
+
+    async def save_channel(self, channel: str, urls: Optional[List[str]]):
+        self._channels[channel] = urls
+
+    async def delete_channel(self, channel: str):
+        self._channels.pop(channel, None)
+
+class FileBackend:
+    """
+    Coordinates workers on one machine through files in a shared directory.
+
+    The leader holds an exclusive flock on `leader.lock` for as long as its
+    process lives, so a crashed leader is replaced by the next worker that
+    polls. Broadcasts are appended as `channel message` lines to
+    `events.log`, which every worker tails within one poll interval. When the
+    log grows past STATE_LOG_MAX_BYTES the leader replaces it with a new
+    segment: a `#base N` header giving the log position where the segment
+    begins, then the latest message of every channel as `=channel message`
+    snapshot lines.
+
+    Rotation and followers' appends share `events.lock`, so the old segment
+    is complete once replaced. A tailing worker reads it to the end before
+    moving on, and skips the new segment's snapshot when its own position
+    matches the base; only a worker that missed a whole segment applies it.
+    """
+
+    def __init__(self, state_dir: str = STATE_DIR, poll_interval: float = STATE_POLL_INTERVAL):
+        self.state_dir = state_dir
+        self.poll_interval = poll_interval
+        self.current: Dict[str, str] = {}
+        self._lock_fd: Optional[int] = None
+        self._log_fd: Optional[int] = None
+        # (file, inode, base, offset) of the segment start() read, for listen() to continue
+        self._tail: Optional[Tuple[BinaryIO, int, int, int]] = None
+        self._log_path = os.path.join(state_dir, "events.log")
+        self._channels_path = os.path.join(state_dir, "channels.json")
+
+    async def start(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        # Catch up on the current segment so joining clients get the latest state
+        try:
+            f = open(self._log_path, "rb")
+        except FileNotFoundError:
+            return
+        base, offset = self._read_header(f)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # Partial write; listen() picks it up once complete
+            self._apply_line(line)
+            offset += len(line)
+        f.seek(offset)
+        self._tail = (f, os.fstat(f.fileno()).st_ino, base, offset)
+
+    async def close(self):
+        if self._tail is not None:
+            self._tail[0].close()
+            self._tail = None
+        if self._log_fd is not None:
+            os.close(self._log_fd)
+            self._log_fd = None
+        if self._lock_fd is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    async def try_acquire_leadership(self) -> bool:
+        """Try to take the leader lock without blocking."""
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(os.path.join(self.state_dir, "leader.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        logger.info(f"Worker {os.getpid()} elected schedule leader")
+        return True
+
+    async def publish(self, channel: str, message: str):
+        """
+        Append a broadcast message to the shared event log.
+
+        A single O_APPEND write per message keeps lines from different
+        workers from interleaving.
+        """
+        self.current[channel] = message
+        line = f"{channel} {message}\n".encode("utf-8")
+
+        # Followers only publish rare control messages; reopening each time
+        # means they never write into a segment the leader has rotated away
+        if self._lock_fd is None:
+            with self._locked("events.lock"):
+                fd = os.open(self._log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, line)
+                finally:
+                    os.close(fd)
+            return
+
+        if self._log_size() > STATE_LOG_MAX_BYTES:
+            self._rotate_log()
+        if self._log_fd is None:
+            self._log_fd = os.open(self._log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self._log_fd, line)
+
+    async def listen(self) -> AsyncIterator[Tuple[str, str]]:
+        """
+        Tail the event log and yield each new (channel, message), exactly
+        once across rotations.
+        """
+        # Continue where start() stopped; base + offset is the log position read up to
+        f, inode, base, offset = self._tail or (None, None, 0, 0)
+        self._tail = None
+        replay_snapshot = False
+        pending = b""
+        try:
+            while True:
+                try:
+                    st = os.stat(self._log_path)
+                except FileNotFoundError:
+                    st = None
+                # A rotated log is a new inode. The old segment is complete,
+                # so finish it before switching.
+                if st is not None and st.st_ino != inode:
+                    if f is not None:
+                        events, pending, read = self._read_lines(f, pending, replay_snapshot)
+                        offset += read
+                        for event in events:
+                            yield event
+                        f.close()
+                    position = base + offset
+                    f = open(self._log_path, "rb")
+                    base, offset = self._read_header(f)
+                    # The snapshot restates what we already have, unless we missed a segment
+                    replay_snapshot = base != position
+                    if replay_snapshot and inode is not None:
+                        logger.warning(f"Missed events between log positions {position} and {base}, resyncing")
+                    inode = st.st_ino
+                    pending = b""
+
+                if f is not None:
+                    events, pending, read = self._read_lines(f, pending, replay_snapshot)
+                    offset += read
+                    for event in events:
+                        yield event
+
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            if f is not None:
+                f.close()
+
+    async def load_channels(self) -> Dict[str, Optional[List[str]]]:
+        return await asyncio.to_thread(self._update_channels, None, None, False)
+
+    async def save_channel(self, channel: str, urls: Optional[List[str]]):
+        await asyncio.to_thread(self._update_channels, channel, urls, False)
+
+    async def delete_channel(self, channel: str):
+        await asyncio.to_thread(self._update_channels, channel, None, True)
+
+    def _read_lines(self, f: BinaryIO, pending: bytes, snapshot: bool) -> Tuple[List[Tuple[str, str]], bytes, int]:
+        """
+        Apply the complete lines appended to a segment since the last read.
+
+        Returns:
+            (events, partial last line, bytes read)
+        """
+        data = f.read()
+        if not data:
+            return [], pending, 0
+        lines = (pending + data).split(b"\n")
+        pending = lines.pop()
+        events = []
+        for line in lines:
+            parsed = self._apply_line(line, snapshot)
+            if parsed:
+                events.append(parsed)
+        return events, pending, len(data)
+
+    def _apply_line(self, line: bytes, snapshot: bool = True) -> Optional[Tuple[str, str]]:
+        """
+        Args:
+            snapshot: Apply a rotated segment's `=` snapshot lines too
+        """
+        if line.startswith(b"#"):
+            return None  # Segment header
+        if line.startswith(b"="):
+            if not snapshot:
+                return None
+            line = line[1:]
+        channel, _, message = line.decode("utf-8").rstrip("\n").partition(" ")
+        if not message:
+            return None
+        self.current[channel] = message
+        return channel, message
+
+    def _log_size(self) -> int:
+        try:
+            return os.stat(self._log_path).st_size
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _read_header(f: BinaryIO) -> Tuple[int, int]:
+        """
+        Read a segment's `#base N` header.
+
+        Returns:
+            (base position, header length); (0, 0) for the first segment,
+            which has no header
+        """
+        line = f.readline()
+        if line.startswith(b"#base ") and line.endswith(b"\n"):
+            return int(line[6:]), len(line)
+        f.seek(0)
+        return 0, 0
+
+    def _rotate_log(self):
+        """Start a new log segment seeded with the latest message per channel."""
+        with self._locked("events.lock"):
+            try:
+                with open(self._log_path, "rb") as f:
+                    base = self._read_header(f)[0] + os.fstat(f.fileno()).st_size
+            except FileNotFoundError:
+                base = 0
+            tmp_path = f"{self._log_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(f"#base {base}\n")
+                for channel, message in self.current.items():
+                    f.write(f"={channel} {message}\n")
+            os.replace(tmp_path, self._log_path)
+        if self._log_fd is not None:
+            os.close(self._log_fd)
+            self._log_fd = None
+
+    def _update_channels(self, channel: Optional[str], urls: Optional[List[str]], delete: bool) -> Dict[str, Optional[List[str]]]:
+        with self._locked("channels.lock"):
+            channels = self._read_json(self._channels_path) or {}
+            if channel is not None:
+                if delete:
+                    channels.pop(channel, None)
+                else:
+                    channels[channel] = urls
+                self._write_json(self._channels_path, channels)
+            return channels
+
+    def _locked(self, name: str):
+        lock = open(os.path.join(self.state_dir, name), "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock  # Closing the file releases the lock
+
+    @staticmethod
+    def _read_json(path: str):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    @staticmethod
+    def _write_json(path: str, data):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+def create_backend(name: str = STATE_BACKEND):
+    """
+    Create the configured state backend.
+
+    Args:
+        name: "memory" or "file"
+    """
+    if name == "memory":
+        return InProcessBackend()
+    if name == "file":
+        return FileBackend()
+    raise ValueError(f"Unknown state backend: {name}")
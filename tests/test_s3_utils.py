@@ -0,0 +1,77 @@
+"""
+S3 transfer tests against moto's in-process S3.
+"""
+import os
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+import s3_utils
+
+BUCKET = "channels-test"
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setattr(s3_utils, "AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setattr(s3_utils, "AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setattr(s3_utils, "AWS_REGION", "us-east-1")
+    monkeypatch.setattr(s3_utils, "S3_BUCKET_NAME", BUCKET)
+    monkeypatch.setattr(s3_utils, "S3_ENDPOINT_URL", None)
+    # The shared client is created inside the mock
+    monkeypatch.setattr(s3_utils, "_s3_client", None)
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+def test_upload_path_to_s3_multipart(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(s3_utils, "S3_PART_SIZE_MB", 5)
+    data = os.urandom(11 * 1024 * 1024)
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(data)
+    sent = []
+
+    success, url = s3_utils.upload_path_to_s3(
+        str(path), "uploads/clip.mp4", "video/mp4", callback=sent.append, content_hash="sha256:abc"
+    )
+
+    assert success
+    assert url == f"https://{BUCKET}.s3.us-east-1.amazonaws.com/uploads/clip.mp4"
+    assert sum(sent) == len(data)
+    head = s3.head_object(Bucket=BUCKET, Key="uploads/clip.mp4")
+    # Multipart ETags end in the part count: 5 + 5 + 1 MB
+    assert head["ETag"].endswith('-3"')
+    assert head["ContentType"] == "video/mp4"
+    assert head["Metadata"] == {s3_utils.CONTENT_HASH_METADATA: "sha256:abc"}
+    assert s3.get_object(Bucket=BUCKET, Key="uploads/clip.mp4")["Body"].read() == data
+
+def test_upload_path_to_s3_reports_failure(s3, tmp_path):
+    success, message = s3_utils.upload_path_to_s3(str(tmp_path / "missing.mp4"), "missing.mp4", "video/mp4")
+
+    assert not success
+    assert "missing.mp4" in message
+
+def test_list_s3_videos_or_raise_pages_through_bucket(s3):
+    keys = [f"videos/{i:04d}.mp4" for i in range(1005)]
+    for key in keys:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b"x")
+    s3.put_object(Bucket=BUCKET, Key="notes.txt", Body=b"x")
+    s3.put_object(Bucket=BUCKET, Key=f"{s3_utils.S3_PACKAGED_PREFIX}job/master.mp4", Body=b"x")
+
+    videos = s3_utils.list_s3_videos_or_raise()
+
+    assert sorted(video["key"] for video in videos) == keys
+    first = next(video for video in videos if video["key"] == keys[0])
+    assert first["url"] == s3_utils.get_object_url(keys[0])
+    assert first["size"] == 1
+    assert not first["etag"].startswith('"')
+
+def test_list_s3_videos_or_raise_raises_on_missing_bucket(s3, monkeypatch):
+    monkeypatch.setattr(s3_utils, "S3_BUCKET_NAME", "no-such-bucket")
+
+    with pytest.raises(ClientError):
+        s3_utils.list_s3_videos_or_raise()
@@ -0,0 +1,358 @@
+"""
+Poster frames and seek-preview sprite sheets.
+
+Thumbnails are rendered by ffmpeg in a bounded pool of subprocesses and kept
+in a content-addressed disk cache: files are named after the video's content
+hash (or S3 ETag), so a video is rendered once however many URLs point at
+it, and changed content gets new URLs that are safe to cache forever. The
+cache is kept under THUMB_CACHE_SIZE_MB by evicting the least recently
+served videos; evicted thumbnails are rendered again on their next request.
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Thumbnail settings
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+THUMBS_ENABLED = os.getenv("THUMBS_ENABLED", "true").lower() == "true"
+THUMB_CONCURRENCY = int(os.getenv("THUMB_CONCURRENCY", "2"))
+THUMB_TIMEOUT = float(os.getenv("THUMB_TIMEOUT", "120"))
+THUMB_CACHE_SIZE_MB = int(os.getenv("THUMB_CACHE_SIZE_MB", "256"))
+POSTER_WIDTH = int(os.getenv("POSTER_WIDTH", "640"))
+SPRITE_TILE_WIDTH = int(os.getenv("SPRITE_TILE_WIDTH", "160"))
+# Sprite sheet grid as COLUMNSxROWS
+SPRITE_GRID = os.getenv("SPRITE_GRID", "5x5")
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+THUMBS_DIR = os.path.join(CACHE_DIR, "thumbs")
+
+# Names of the files in the cache directory
+THUMB_NAME_PATTERN = re.compile(r"^([0-9a-f]{20})(_sprite)?\.jpg$")
+
+def thumb_id_for(key: str) -> str:
+    """Stable 20-character file name stem for a content key."""
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=10).hexdigest()
+
+def _even(value: float) -> int:
+    return max(2, int(round(value / 2)) * 2)
+
+def sprite_layout(
+    duration: float,
+    width: Optional[int],
+    height: Optional[int],
+    grid: str = SPRITE_GRID,
+    tile_width: int = SPRITE_TILE_WIDTH
+) -> dict:
+    """
+    Geometry of a video's sprite sheet.
+
+    Tiles are evenly spaced over the video, so the tile for playback time t
+    is floor(t / interval), read left to right and top to bottom.
+    """
+    columns, _, rows = grid.partition("x")
+    columns, rows = int(columns), int(rows)
+    aspect = height / width if width and height else 9 / 16
+    return {
+        "columns": columns,
+        "rows": rows,
+        "tile_width": tile_width,
+        "tile_height": _even(tile_width * aspect),
+        "interval": round(duration / (columns * rows), 3),
+    }
+
+def build_poster_command(source: str, output: str, duration: float, width: int = POSTER_WIDTH) -> List[str]:
+    # A frame a little way in is more representative than the often black first one
+    offset = min(1.0, duration * 0.1) if duration else 0.0
+    return [
+        FFMPEG_BIN, "-y", "-v", "error",
+        "-ss", f"{offset:.3f}", "-i", source,
+        "-frames:v", "1", "-vf", f"scale={width}:-2", "-q:v", "3",
+        "-f", "image2", output,
+    ]
+
+def build_sprite_command(source: str, output: str, layout: dict) -> List[str]:
+    width, height = layout["tile_width"], layout["tile_height"]
+    filters = ",".join([
+        f"fps=1/{max(layout['interval'], 0.001)}",
+        f"scale={width}:{height}:force_original_aspect_ratio=decrease",
+        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2",
+        f"tile={layout['columns']}x{layout['rows']}",
+    ])
+    return [
+        FFMPEG_BIN, "-y", "-v", "error", "-i", source, "-an",
+        "-vf", filters, "-frames:v", "1", "-q:v", "5",
+        "-f", "image2", output,
+    ]
+
+def remove_files(paths: List[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+class Thumbnailer:
+    """
+    Renders thumbnails on demand and keeps them in a size-bounded cache.
+    """
+
+    def __init__(
+        self,
+        file_key: Callable[[str], Awaitable[str]],
+        root: str = THUMBS_DIR,
+        concurrency: int = THUMB_CONCURRENCY,
+        max_bytes: int = THUMB_CACHE_SIZE_MB * 1024 * 1024
+    ):
+        """
+        Args:
+            file_key: Returns the content key of a local file
+            root: Cache directory
+            concurrency: Maximum number of ffmpeg processes
+            max_bytes: Cache size above which thumbnails are evicted
+        """
+        self.file_key = file_key
+        self.root = root
+        self.concurrency = concurrency
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root, "index.json")
+        # thumb ID -> {"source", "duration", "width", "height", "bytes", "used"};
+        # entries outlive their files so evicted thumbnails can be re-rendered
+        self.entries: Dict[str, dict] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._dirty = False
+        self._ffmpeg_missing = False
+        self.load()
+
+    def load(self):
+        """Load the cache index from disk."""
+        try:
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError as e:
+            logger.error(f"Ignoring corrupt thumbnail index {self.index_path}: {e}")
+
+    def write(self, data: str):
+        """Atomically replace the index file (runs in a worker thread)."""
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.index_path)
+
+    async def save(self):
+        """Write the cache index to disk if it changed."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        # Serialize on the loop so renders finishing meanwhile can't change the entries mid-dump
+        data = json.dumps(self.entries, separators=(",", ":"))
+        try:
+            await asyncio.to_thread(self.write, data)
+        except OSError as e:
+            self._dirty = True
+            logger.error(f"Saving the thumbnail index failed: {e}")
+
+    def paths(self, thumb_id: str) -> Tuple[str, str]:
+        """Poster and sprite sheet paths for a thumb ID."""
+        return (
+            os.path.join(self.root, f"{thumb_id}.jpg"),
+            os.path.join(self.root, f"{thumb_id}_sprite.jpg"),
+        )
+
+    def fields(self, thumb_id: str) -> dict:
+        """Catalog fields referencing a rendered video's thumbnails."""
+        entry = self.entries[thumb_id]
+        layout = sprite_layout(entry["duration"], entry["width"], entry["height"])
+        return {
+            "poster_url": f"/thumbs/{thumb_id}.jpg",
+            "sprite": {"url": f"/thumbs/{thumb_id}_sprite.jpg", **layout},
+        }
+
+    async def render(
+        self,
+        source: str,
+        key: str,
+        duration: float,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+        local_copy: Optional[str] = None
+    ) -> Optional[dict]:
+        """
+        Render a video's poster and sprite sheet unless they are cached.
+
+        Args:
+            source: Local path or URL that ffmpeg can read
+            key: Content hash or ETag identifying the bytes at `source`
+            duration: Video duration in seconds, for spacing the sprite tiles
+            width: Video width, if known, for the tile aspect ratio
+            height: Video height, if known
+            local_copy: Temporary local copy of a remote `source` to render
+                from now; `source` is kept for re-rendering evicted files
+
+        Returns:
+            Catalog fields (see `fields`), or None if rendering failed
+        """
+        thumb_id = thumb_id_for(key)
+        entry = self.entries.get(thumb_id)
+        if entry is None or (entry["duration"], entry["width"], entry["height"]) != (duration, width, height):
+            entry = {"source": source, "duration": duration, "width": width, "height": height, "bytes": 0, "used": 0}
+            self.entries[thumb_id] = entry
+            self._dirty = True
+        entry["source"] = source
+        if not await self._ensure(thumb_id, local_copy):
+            return None
+        return self.fields(thumb_id)
+
+    async def render_many(
+        self,
+        videos: Iterable[Tuple[str, Optional[str], float, Optional[int], Optional[int]]],
+        local_copies: Optional[Dict[str, str]] = None
+    ) -> List[Optional[dict]]:
+        """
+        Render many videos in parallel, then trim and persist the cache.
+
+        Args:
+            videos: (path_or_url, etag, duration, width, height); local files pass None as etag
+            local_copies: Local copies to render remote sources from, by source
+
+        Returns:
+            Results in the same order as `videos`
+        """
+        async def render_one(source: str, etag: Optional[str], duration: float, width, height):
+            key = await self.file_key(source) if etag is None else f"etag:{etag}"
+            return await self.render(source, key, duration, width, height, (local_copies or {}).get(source))
+
+        if not THUMBS_ENABLED:
+            return [None for _ in videos]
+        results = await asyncio.gather(
+            *(render_one(*video) for video in videos),
+            return_exceptions=True
+        )
+        await self.evict()
+        await self.save()
+        return [None if isinstance(result, BaseException) else result for result in results]
+
+    async def path_for(self, name: str) -> Optional[str]:
+        """
+        Local path of a cached thumbnail file, re-rendering it if it was evicted.
+
+        Returns:
+            The path, or None for unknown names
+        """
+        match = THUMB_NAME_PATTERN.match(name)
+        if match is None or match.group(1) not in self.entries:
+            return None
+        if not await self._ensure(match.group(1)):
+            return None
+        return os.path.join(self.root, name)
+
+    async def evict(self):
+        """Delete the least recently used thumbnails until the cache fits."""
+        # Victims are picked and marked on the loop; only the unlinks run in a thread
+        rendered = [
+            (entry["used"], thumb_id) for thumb_id, entry in self.entries.items()
+            if entry["bytes"] and thumb_id not in self._inflight
+        ]
+        total = sum(self.entries[thumb_id]["bytes"] for _, thumb_id in rendered)
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for _, thumb_id in sorted(rendered):
+            if total <= self.max_bytes:
+                break
+            entry = self.entries[thumb_id]
+            victims.extend(self.paths(thumb_id))
+            total -= entry["bytes"]
+            entry["bytes"] = 0
+        self._dirty = True
+        await asyncio.to_thread(remove_files, victims)
+        logger.info(f"Evicted thumbnails of {len(victims) // 2} videos, cache now {total} bytes")
+
+    async def _ensure(self, thumb_id: str, local_copy: Optional[str] = None) -> bool:
+        """Make sure both files of a thumb ID exist; concurrent calls share one render."""
+        entry = self.entries[thumb_id]
+        entry["used"] = time.time()
+        if entry["bytes"] and all(os.path.exists(path) for path in self.paths(thumb_id)):
+            return True
+
+        if thumb_id in self._inflight:
+            return await self._inflight[thumb_id]
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[thumb_id] = future
+        try:
+            entry["bytes"] = await self._render_files(thumb_id, entry, local_copy or entry["source"])
+            self._dirty = True
+            future.set_result(bool(entry["bytes"]))
+            return bool(entry["bytes"])
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved when no one else is waiting
+            raise
+        finally:
+            del self._inflight[thumb_id]
+
+    async def _render_files(self, thumb_id: str, entry: dict, source: str) -> int:
+        """Render the poster and sprite sheet from `source`, returning their total size or 0."""
+        os.makedirs(self.root, exist_ok=True)
+        poster_path, sprite_path = self.paths(thumb_id)
+        layout = sprite_layout(entry["duration"], entry["width"], entry["height"])
+        jobs = (
+            (poster_path, lambda output: build_poster_command(source, output, entry["duration"])),
+            (sprite_path, lambda output: build_sprite_command(source, output, layout)),
+        )
+        total = 0
+        for path, command in jobs:
+            # Render next to the final path and publish by rename
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            rendered = await self._run_ffmpeg(command(tmp_path), source)
+            if not rendered or not os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except FileNotFoundError:
+                    pass
+                return 0
+            os.replace(tmp_path, path)
+            total += os.path.getsize(path)
+        return total
+
+    async def _run_ffmpeg(self, command: List[str], source: str) -> bool:
+        if self._ffmpeg_missing:
+            return False
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        async with self._semaphore:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *command,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE
+                )
+            except FileNotFoundError:
+                logger.error(f"{FFMPEG_BIN} not found in PATH, thumbnails disabled")
+                self._ffmpeg_missing = True
+                return False
+
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), THUMB_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                logger.error(f"ffmpeg timed out rendering thumbnails for {source}")
+                return False
+
+        if process.returncode != 0:
+            logger.error(f"Thumbnail rendering failed for {source}: {stderr.decode(errors='replace').strip()}")
+            return False
+        return True
@@ -0,0 +1,224 @@
+"""
+Background upload jobs with admission control.
+
+POST /uploads only receives the body: ingest streams it into a staging file,
+hashing and size-checking it on the way, and the request is answered with a
+job ID as soon as the last byte is on disk. Storing the file (to S3 or into
+uploads/), probing, thumbnails and the catalog append run afterwards in
+UPLOAD_WORKERS job workers fed by a queue. A new upload is only admitted
+while fewer than UPLOAD_WORKERS + UPLOAD_QUEUE_SIZE uploads are being
+received, waiting or stored; beyond that it is turned away before its body
+is read, so a burst of uploads can't take over the event loop, the S3 pool
+or the disk that playback depends on.
+
+Clients follow a job by polling it or over SSE; every status change and
+transfer progress step wakes the job's watchers.
+"""
+import os
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+import metrics
+import s3_utils
+from ingest import IngestedUpload
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Job settings
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "2"))
+UPLOAD_QUEUE_SIZE = int(os.getenv("UPLOAD_QUEUE_SIZE", "16"))
+# Finished jobs kept for status requests
+UPLOAD_JOB_HISTORY = int(os.getenv("UPLOAD_JOB_HISTORY", "256"))
+# Transfer progress is published at most this often
+PROGRESS_INTERVAL = 0.25
+
+FINISHED_STATUSES = ("ready", "failed")
+
+class UploadBusy(Exception):
+    """Every upload slot is taken; the client should retry later."""
+
+class UploadJobs:
+    """
+    Queue of uploads waiting to be stored and added to the catalog.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[dict, IngestedUpload], Awaitable[dict]],
+        workers: int = UPLOAD_WORKERS,
+        queue_size: int = UPLOAD_QUEUE_SIZE,
+        history: int = UPLOAD_JOB_HISTORY
+    ):
+        """
+        Args:
+            process: Stores an upload and returns the fields to set on its
+                finished job; exceptions fail the job
+            workers: Uploads stored concurrently
+            queue_size: Uploads allowed to wait beyond those being stored
+            history: Finished jobs kept for status requests
+        """
+        self.process = process
+        self.workers = workers
+        self.queue_size = queue_size
+        self.history = history
+        self.jobs: "OrderedDict[str, dict]" = OrderedDict()
+        # content hash -> ID of the job storing it
+        self.pending: Dict[str, str] = {}
+        self.admitted = 0  # Receiving, queued or being stored
+        self._changed: Dict[str, asyncio.Event] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._closed = False
+
+    def start(self):
+        """Start the job workers."""
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        """Stop the workers and discard staged uploads that were never stored."""
+        self._closed = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        while self._queue is not None and not self._queue.empty():
+            job, upload = self._queue.get_nowait()
+            await upload.sink.abort()
+            self.update(job, status="failed", error="Server shut down before the upload was stored")
+        # Release SSE watchers
+        for event in self._changed.values():
+            event.set()
+
+    def admit(self, target: str) -> dict:
+        """
+        Reserve a slot for an upload that is about to be received.
+
+        Raises:
+            UploadBusy when every slot is taken
+        """
+        if self._closed or self.admitted >= self.workers + self.queue_size:
+            metrics.UPLOAD_REJECTIONS.inc()
+            raise UploadBusy(f"{self.admitted} uploads in progress, try again shortly")
+        self.admitted += 1
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "status": "receiving",
+            "target": target,
+            "filename": None,
+            "size": None,
+            "bytes_stored": 0,
+            "progress": 0.0,
+            "created_at": now,
+            "updated_at": now,
+        }
+        self.jobs[job["id"]] = job
+        self._trim()
+        return job
+
+    def release(self, job: dict, status: str, **fields):
+        """Finish an upload that won't be queued: it failed to arrive or is a duplicate."""
+        self.admitted -= 1
+        self.update(job, status=status, **fields)
+
+    def submit(self, job: dict, upload: IngestedUpload):
+        """Queue a received upload for storing."""
+        self.pending[upload.content_hash] = job["id"]
+        self.update(job, status="queued", filename=upload.filename, size=upload.size)
+        self._queue.put_nowait((job, upload))
+        metrics.UPLOAD_QUEUE_DEPTH.set(self._queue.qsize())
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self.jobs.get(job_id)
+
+    def update(self, job: dict, **fields):
+        """Change a job and wake everyone watching it."""
+        job.update(fields, updated_at=time.time())
+        if job["size"]:
+            job["progress"] = round(min(job["bytes_stored"] / job["size"], 1.0), 4)
+        event = self._changed.pop(job["id"], None)
+        if event is not None:
+            event.set()
+
+    async def watch(self, job_id: str, keepalive: float = 15.0) -> AsyncIterator[Optional[dict]]:
+        """
+        Yield a job on every change until it finishes, or None after
+        `keepalive` seconds without one.
+        """
+        job = self.jobs.get(job_id)
+        while job is not None:
+            event = self._changed.setdefault(job_id, asyncio.Event())
+            yield job
+            if job["status"] in FINISHED_STATUSES or self._closed:
+                return
+            try:
+                await asyncio.wait_for(event.wait(), keepalive)
+            except asyncio.TimeoutError:
+                yield None
+
+    async def transfer(self, job: dict, func: Callable, *args):
+        """
+        Run a blocking transfer on the S3 pool, publishing its progress.
+
+        Args:
+            job: The job to report progress on
+            func: Blocking call taking *args and then a callback that is
+                passed the number of bytes sent each time a chunk goes out
+
+        Returns:
+            Whatever `func` returns
+        """
+        sent = [0]
+        lock = threading.Lock()
+
+        def on_progress(n: int):
+            with lock:  # Called from several transfer threads at once
+                sent[0] += n
+
+        future = asyncio.ensure_future(s3_utils.run_in_s3_executor(func, *args, on_progress))
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=PROGRESS_INTERVAL)
+            if sent[0] != job["bytes_stored"]:
+                self.update(job, bytes_stored=sent[0])
+            if done:
+                return future.result()
+
+    def _trim(self):
+        """Forget the oldest finished jobs beyond the history size."""
+        excess = len(self.jobs) - self.history - self.admitted
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self.jobs.items() if job["status"] in FINISHED_STATUSES][:excess]:
+            del self.jobs[job_id]
+            self._changed.pop(job_id, None)
+
+    async def _worker(self):
+        while True:
+            job, upload = await self._queue.get()
+            metrics.UPLOAD_QUEUE_DEPTH.set(self._queue.qsize())
+            started = time.perf_counter()
+            self.update(job, status="storing")
+            try:
+                result = await self.process(job, upload)
+                self.update(job, status="ready", bytes_stored=upload.size, **result)
+                metrics.UPLOAD_BYTES.labels(job["target"]).observe(upload.size)
+                metrics.UPLOAD_SECONDS.labels(job["target"]).observe(time.perf_counter() - started)
+            except asyncio.CancelledError:
+                await upload.sink.abort()
+                self.update(job, status="failed", error="Server shut down before the upload was stored")
+                raise
+            except Exception as e:
+                await upload.sink.abort()
+                self.update(job, status="failed", error=str(e))
+                metrics.UPLOAD_FAILURES.inc()
+                logger.error(f"Upload job {job['id']} ({upload.filename}) failed: {e}")
+            finally:
+                self.pending.pop(upload.content_hash, None)
+                self.admitted -= 1
+                self._queue.task_done()
@@ -0,0 +1,442 @@
+"""
+Range-aware video file serving.
+
+Serves files from the video directories with single and multi-range
+support, strong ETag / Last-Modified validators and 304 handling. Stat
+results are cached, so repeat requests for the same file skip the stat
+syscall, and the leading `ftyp`+`moov` header of fast-start MP4s is kept in
+memory because every viewer asks for it at the moment of a broadcast
+switch. Everything that touches the disk (stat, open, reads) runs in worker
+threads, so a cold file or a slow disk never stalls the event loop. Small
+text files such as HLS playlists are kept compressed in memory and sent in
+the encoding the client accepts.
+"""
+import os
+import stat
+import time
+import uuid
+import struct
+import asyncio
+import logging
+import mimetypes
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+
+import page_cache
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Serving settings
+STAT_CACHE_TTL = float(os.getenv("STAT_CACHE_TTL", "1.0"))
+STAT_CACHE_SIZE = int(os.getenv("STAT_CACHE_SIZE", "1024"))
+MOOV_CACHE_MAX_BYTES = int(os.getenv("MOOV_CACHE_MAX_BYTES", str(4 * 1024 * 1024)))
+MOOV_CACHE_SIZE_MB = int(os.getenv("MOOV_CACHE_SIZE_MB", "64"))
+VIDEO_CACHE_MAX_AGE = int(os.getenv("VIDEO_CACHE_MAX_AGE", "300"))
+TEXT_COMPRESS_MAX_BYTES = int(os.getenv("TEXT_COMPRESS_MAX_BYTES", str(1024 * 1024)))
+TEXT_CACHE_SIZE = 256
+
+CHUNK_SIZE = 256 * 1024
+MAX_RANGES = 32
+
+class FileInfo:
+    """
+    Cached stat result for one file.
+    """
+    __slots__ = ("path", "size", "mtime_ns", "ino", "etag", "last_modified", "content_type", "checked_at")
+
+    def __init__(self, path: str, st: os.stat_result):
+        self.path = path
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.ino = st.st_ino
+        self.etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}-{st.st_ino:x}"'
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.checked_at = time.monotonic()
+
+    def matches(self, st: os.stat_result) -> bool:
+        return (self.size, self.mtime_ns, self.ino) == (st.st_size, st.st_mtime_ns, st.st_ino)
+
+# path -> FileInfo, least recently used first
+_file_cache: "OrderedDict[str, FileInfo]" = OrderedDict()
+# etag -> leading ftyp+moov bytes of fast-start MP4s
+_moov_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_moov_cache_bytes = 0
+# etag -> compressed variants of small text files
+_text_cache: "OrderedDict[str, page_cache.CompressedBody]" = OrderedDict()
+
+def stat_file(path: str) -> Optional[os.stat_result]:
+    """stat a regular file, or None if there is none (blocking)."""
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return st if stat.S_ISREG(st.st_mode) else None
+
+async def get_file_info(path: str) -> Optional[FileInfo]:
+    """
+    Return cached file metadata, re-validating with stat (in a thread) at
+    most once per TTL.
+    """
+    info = _file_cache.get(path)
+    now = time.monotonic()
+    if info is not None and now - info.checked_at < STAT_CACHE_TTL:
+        _file_cache.move_to_end(path)
+        return info
+
+    st = await asyncio.to_thread(stat_file, path)
+    if st is None:
+        _file_cache.pop(path, None)
+        return None
+
+    if info is not None and info.matches(st):
+        info.checked_at = now
+        _file_cache.move_to_end(path)
+        return info
+
+    info = FileInfo(path, st)
+    _file_cache[path] = info
+    _file_cache.move_to_end(path)
+    while len(_file_cache) > STAT_CACHE_SIZE:
+        _file_cache.popitem(last=False)
+    return info
+
+def open_file(info: FileInfo) -> Optional[int]:
+    """
+    Open the file an entry describes (blocking).
+
+    Returns:
+        A descriptor the caller closes, or None if the path now holds
+        another file than the one whose headers were sent
+    """
+    try:
+        fd = os.open(info.path, os.O_RDONLY)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if not info.matches(os.fstat(fd)):
+        os.close(fd)
+        return None
+    return fd
+
+def read_range(fd: int, start: int, length: int) -> bytes:
+    """Read exactly `length` bytes at `start` (blocking)."""
+    chunks = []
+    while length > 0:
+        chunk = os.pread(fd, length, start)
+        if not chunk:
+            raise EOFError("File shrank while being served")
+        chunks.append(chunk)
+        start += len(chunk)
+        length -= len(chunk)
+    return b"".join(chunks)
+
+def find_moov_end(fd: int, size: int) -> Optional[int]:
+    """
+    Walk top-level MP4 boxes and return the offset just past `moov` (blocking).
+
+    Returns None if the file is not a fast-start MP4 (media data comes first)
+    or the header is larger than MOOV_CACHE_MAX_BYTES.
+    """
+    offset = 0
+    limit = min(size, MOOV_CACHE_MAX_BYTES)
+    while offset + 8 <= limit:
+        header = os.pread(fd, 16, offset)
+        if len(header) < 8:
+            return None
+        box_size, box_type = struct.unpack_from(">I4s", header)
+        if box_size == 1:
+            if offset + 16 > limit or len(header) < 16:
+                return None
+            box_size = struct.unpack_from(">Q", header, 8)[0]
+        if box_size < 8:
+            return None
+        if box_type == b"moov":
+            end = offset + box_size
+            return end if end <= limit else None
+        if box_type == b"mdat":
+            return None
+        offset += box_size
+    return None
+
+def read_moov_header(fd: int, size: int) -> Optional[bytes]:
+    """The ftyp+moov header of a fast-start MP4, or None (blocking)."""
+    end = find_moov_end(fd, size)
+    return read_range(fd, 0, end) if end else None
+
+async def get_moov_header(info: FileInfo, fd: int) -> Optional[bytes]:
+    """
+    Return the cached ftyp+moov header of a fast-start MP4, loading it once.
+    """
+    global _moov_cache_bytes
+    if info.content_type != "video/mp4" or info.size == 0:
+        return None
+
+    header = _moov_cache.get(info.etag)
+    if header is not None:
+        _moov_cache.move_to_end(info.etag)
+        return header
+    if info.etag in _moov_cache:
+        return None
+
+    header = await asyncio.to_thread(read_moov_header, fd, info.size)
+    _moov_cache[info.etag] = header
+    if header:
+        _moov_cache_bytes += len(header)
+        while _moov_cache_bytes > MOOV_CACHE_SIZE_MB * 1024 * 1024:
+            evicted = _moov_cache.popitem(last=False)[1]
+            _moov_cache_bytes -= len(evicted) if evicted else 0
+    return header
+
+def read_text_body(info: FileInfo, etag: Optional[str] = None) -> Optional[page_cache.CompressedBody]:
+    """Read and compress a small text file (blocking)."""
+    fd = open_file(info)
+    if fd is None:
+        return None
+    try:
+        data = read_range(fd, 0, info.size)
+    finally:
+        os.close(fd)
+    return page_cache.CompressedBody(data, (etag or info.etag).strip('"'))
+
+async def get_text_body(info: FileInfo, etag: Optional[str] = None) -> Optional[page_cache.CompressedBody]:
+    """
+    Return the cached compressed variants of a small text file, building them
+    once in a thread.
+
+    Returns:
+        None if the file was replaced since it was stat'ed
+    """
+    body = _text_cache.get(info.etag)
+    if body is not None:
+        _text_cache.move_to_end(info.etag)
+        return body
+    body = await asyncio.to_thread(read_text_body, info, etag)
+    if body is None:
+        return None
+    _text_cache[info.etag] = body
+    while len(_text_cache) > TEXT_CACHE_SIZE:
+        _text_cache.popitem(last=False)
+    return body
+
+def parse_range_header(header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parse a `Range: bytes=...` header into sorted, merged (start, end) pairs.
+
+    Returns:
+        Inclusive byte ranges, None if the header should be ignored, or an
+        empty list if no range is satisfiable
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        start_text, dash, end_text = part.strip().partition("-")
+        if not dash:
+            return None
+        try:
+            if start_text:
+                start = int(start_text)
+                end = int(end_text) if end_text else size - 1
+            else:
+                # Suffix range: the last N bytes
+                length = int(end_text)
+                start, end = max(size - length, 0), size - 1
+                if length == 0:
+                    continue
+        except ValueError:
+            return None
+        if start > end and end_text and start_text:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    # Merge overlapping and adjacent ranges
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header names `etag` (weak comparison)."""
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+def is_not_modified(request: Request, info: FileInfo, etag: Optional[str] = None) -> bool:
+    """
+    Evaluate If-None-Match / If-Modified-Since against the file validators.
+
+    Args:
+        etag: ETag sent instead of the file's own
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag or info.etag)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return info.mtime_ns // 1_000_000_000 <= since
+    return False
+
+def range_is_fresh(request: Request, info: FileInfo, etag: Optional[str] = None) -> bool:
+    """Evaluate If-Range: a stale validator means the full file must be sent."""
+    if_range = request.headers.get("if-range")
+    if if_range is None:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == (etag or info.etag)
+    return etag is None and if_range == info.last_modified
+
+class VideoFileResponse(Response):
+    """
+    Sends a list of body parts, each either literal bytes or a file range.
+    """
+
+    def __init__(self, info: FileInfo, parts: list, status_code: int, headers: dict, send_body: bool = True):
+        super().__init__(status_code=status_code, headers=headers)
+        self.info = info
+        self.parts = parts
+        self.send_body = send_body
+
+    async def __call__(self, scope, receive, send):
+        if not self.send_body or not self.parts:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        # Open before the status goes out, so a file replaced since it was
+        # stat'ed can still be answered with a retryable error
+        fd = await asyncio.to_thread(open_file, self.info)
+        if fd is None:
+            _file_cache.pop(self.info.path, None)
+            response = Response(status_code=503, headers={"retry-after": "0", "cache-control": "no-store"})
+            await response(scope, receive, send)
+            return
+
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            header = await get_moov_header(self.info, fd)
+            for part in self.parts:
+                if isinstance(part, bytes):
+                    await send({"type": "http.response.body", "body": part, "more_body": True})
+                    continue
+
+                start, end = part
+                # Serve whatever falls inside the cached MP4 header from memory
+                if header and start < len(header):
+                    cached_end = min(end + 1, len(header))
+                    await send({"type": "http.response.body", "body": header[start:cached_end], "more_body": True})
+                    start = cached_end
+
+                for offset in range(start, end + 1, CHUNK_SIZE):
+                    length = min(CHUNK_SIZE, end + 1 - offset)
+                    chunk = await asyncio.to_thread(read_range, fd, offset, length)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            os.close(fd)
+
+async def serve_file(request: Request, directory: str, path: str, etag: Optional[str] = None) -> Response:
+    """
+    Serve a file from `directory` honouring validators and Range requests.
+
+    Args:
+        request: The incoming GET or HEAD request
+        directory: Root directory the file must live under
+        path: Path of the file relative to `directory`
+        etag: For a copy of an origin object, the origin's ETag to send
+            instead of the file's own (and no Last-Modified)
+    """
+    root = os.path.abspath(directory)
+    full_path = os.path.abspath(os.path.join(root, path))
+    if not full_path.startswith(root + os.sep):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    info = await get_file_info(full_path)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    headers = {
+        "etag": etag or info.etag,
+        "last-modified": info.last_modified,
+        "accept-ranges": "bytes",
+        "cache-control": f"public, max-age={VIDEO_CACHE_MAX_AGE}",
+    }
+    if etag is not None:
+        del headers["last-modified"]
+    send_body = request.method != "HEAD"
+
+    if (
+        0 < info.size <= TEXT_COMPRESS_MAX_BYTES
+        and page_cache.compressible(info.content_type)
+        and "range" not in request.headers
+    ):
+        body = await get_text_body(info, etag)
+        if body is None:
+            _file_cache.pop(full_path, None)
+            raise HTTPException(status_code=503, detail="File changed, try again", headers={"Retry-After": "0"})
+        return page_cache.respond(request, body, info.content_type, headers)
+
+    if is_not_modified(request, info, etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    ranges = None
+    if range_header and range_is_fresh(request, info, etag):
+        ranges = parse_range_header(range_header, info.size)
+
+    if ranges is None:
+        headers["content-type"] = info.content_type
+        headers["content-length"] = str(info.size)
+        return VideoFileResponse(info, [(0, info.size - 1)] if info.size else [], 200, headers, send_body)
+
+    if not ranges:
+        headers["content-range"] = f"bytes */{info.size}"
+        return Response(status_code=416, headers=headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["content-type"] = info.content_type
+        headers["content-range"] = f"bytes {start}-{end}/{info.size}"
+        headers["content-length"] = str(end - start + 1)
+        return VideoFileResponse(info, ranges, 206, headers, send_body)
+
+    # Multiple ranges go out as multipart/byteranges
+    boundary = uuid.uuid4().hex
+    parts = []
+    length = 0
+    for start, end in ranges:
+        part_header = (
+            f"--{boundary}\r\n"
+            f"Content-Type: {info.content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{info.size}\r\n\r\n"
+        ).encode("latin-1")
+        parts.append(part_header)
+        parts.append((start, end))
+        parts.append(b"\r\n")
+        length += len(part_header) + (end - start + 1) + 2
+    closing = f"--{boundary}--\r\n".encode("latin-1")
+    parts.append(closing)
+    length += len(closing)
+
+    headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+    headers["content-length"] = str(length)
+    return VideoFileResponse(info, parts, 206, headers, send_body)